@@ -0,0 +1,278 @@
+"""
+Adaptive timestep: run the early, intervention-free years at a coarser timestep
+
+run_adaptive() runs a copy of the sim at a coarse timestep (quarterly by
+default) from the start year to a switch year, then copies its population,
+networks and results into the usual monthly sim, and runs that to the end. By
+default the switch year is the first year in which any intervention is active;
+for the default interventions this is 1991, when HIV testing starts scaling up
+(ART starts in 2001 and PrEP in 2005), not 2004.
+
+Only the modules that use the sim's timestep are coarsened: the networks,
+demographics and interventions. The HIV module sets its own monthly timestep,
+so it still steps monthly throughout. Parts of the model that assume a monthly
+timestep are rescaled:
+    - while running coarse, partnership durations (which stisim draws in months
+      but decrements once per network timestep) and coital acts per
+      partnership (drawn per network timestep but applied on every HIV
+      timestep) are divided by the timestep ratio, and the per-timestep
+      probability of a pair forming is compounded over it;
+    - at the switch, every time index (ti_*), duration state (dur_*) and
+      network edge duration is converted to the monthly timesteps of the
+      module it belongs to.
+
+The monthly sim is made and initialized as usual, then overwritten by the
+coarse sim's state at the switch: initialization builds its timeline, result
+arrays and step plan for the monthly timestep, so it can't be skipped.
+Initializing takes about 0.75 s whatever the number of agents (it's mostly
+module and data setup, so a small throwaway population wouldn't save it),
+compared to about 30 s for a 10,000-agent run from 1985 to 2025.
+
+The speedup is small, since the HIV module, which takes most of the time,
+still steps monthly, and with the default switch only 1985-1990 run coarse.
+Measured at 10,000 agents, averaged over 3 seeds: 1.05x for 1985-1995
+(quarterly), and 1.01x (quarterly) or 0.99x (yearly) for 1985-2025.
+
+Run this file to compare the yearly calibration targets of adaptive runs
+against all-monthly runs, and the speedup.
+"""
+
+# %% Imports and settings
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+import stisim as sti
+
+fine_dt = 1/12  # The model's usual (monthly) timestep, in years
+
+
+def first_activity(sim):
+    """ First year in which any of an initialized sim's interventions is active (the sim's stop year if none are) """
+    years = [sim.t.yearvec[-1]]
+    for intv in sim.interventions.values():
+        if isinstance(intv, sti.HIVTest):
+            prob = np.broadcast_to(intv.test_prob_data, np.shape(intv.years))
+            years += list(np.asarray(intv.years)[prob > 0][:1])
+        elif isinstance(intv, sti.Prep):
+            years += list(np.asarray(intv.pars.years)[np.asarray(intv.pars.coverage) > 0][:1])
+        elif isinstance(intv, sti.ART):
+            years += list(sim.t.yearvec[np.asarray(intv.coverage) > 0][:1])
+        elif hasattr(intv, 'start') and sc.isnumber(intv.start):  # E.g. PartnerNotification
+            years.append(intv.start)
+        else:  # Unknown intervention: assume it's active from the start
+            years.append(sim.t.yearvec[0])
+    return float(np.floor(min(years)))
+
+
+def coarsen(sim, factor):
+    """ Rescale the parts of an initialized sim's sexual network that assume a monthly timestep, for a timestep factor times as long """
+    nw = sim.networks.structuredsexual
+    for key in ['stable_dur_pars', 'casual_dur_pars']:  # Drawn in months but counted in timesteps
+        for pars in nw.pars[key].values():
+            for row in pars:
+                row[:] = [ss.months(p.months/factor) if isinstance(p, ss.dur) else p/factor for p in row]
+    p = nw.pars.p_pair_form.pars.p  # Probability per timestep
+    nw.pars.p_pair_form.set(p=1 - (1 - p)**factor)
+    acts = nw.pars.acts  # Drawn per network timestep, but applied on every (monthly) HIV timestep
+    acts.set(mean=acts.pars.mean/factor, std=acts.pars.std/factor)
+    return sim
+
+
+def fast_forward(sim, year):
+    """ Move an initialized sim, and each of its modules, to the start of the timestep at a given year, without running anything """
+    ti = np.flatnonzero(np.isclose(sim.t.yearvec, year))[0]
+    sim.t.ti = ti
+    for mod in sim.modules:
+        mod.t.ti = np.searchsorted(mod.t.yearvec, year)
+    sim.loop.index = next(i for i, entry in enumerate(sim.loop.plan) if entry.ti == ti)
+    return sim
+
+
+def run_until(sim, year):
+    """
+    Run an initialized sim up to a given year, including every step of modules with a shorter timestep than the sim
+
+    Unlike sim.run(until=year), this doesn't stop as soon as the sim's own timestep ends, since e.g. a monthly
+    HIV module in a yearly sim still has 11 steps to take at that point.
+    """
+    loop = sim.loop
+    while loop.index < len(loop.plan) and loop.plan[loop.index].time.years < year - 1e-6:
+        loop.run_one_step()
+    return sim
+
+
+def get_factor(coarse, fine):
+    """ Number of fine timesteps per coarse timestep, for a pair of sims or modules """
+    return int(round(coarse.t.dt_year/fine.t.dt_year))
+
+
+def transplant(coarse, fine):
+    """
+    Copy the population, network edges and results of a coarse sim into a fine one with the same start
+
+    The coarse sim must have been run (but not finalized) up to the point the fine one has been
+    fast-forwarded to. Time indices and durations counted in timesteps are converted to the fine
+    timesteps of the module they belong to (modules such as HIV that set their own timestep are
+    unchanged); results are spread over the fine timesteps, with flows divided evenly between them.
+    """
+    src, dst = coarse.people, fine.people
+    fine_mods = {mod.name: mod for mod in fine.modules}
+    pairs = [(coarse, fine)] + [(mod, fine_mods[mod.name]) for mod in coarse.modules]
+    factors = {fmod.name if fmod is not fine else None: get_factor(cmod, fmod) for cmod, fmod in pairs}
+
+    # Agent states, including the UIDs and RNG slots
+    arrs = {**dict(src.states), 'uid': src.uid, 'slot': src.slot, 'parent': src.parent}
+    for name, arr in arrs.items():
+        new = dst.states[name] if name in dst.states else getattr(dst, name)
+        modname, _, key = name.rpartition('.')
+        raw = arr.raw.copy()
+        if key.startswith(('ti_', 'dur_')):
+            raw = raw*factors[modname or None]
+        new.raw = raw.astype(new.raw.dtype)
+        new.len_used = arr.len_used
+        new.len_tot = arr.len_tot
+    dst.auids = src.auids.copy()
+
+    # Network edges
+    for name, nw in coarse.networks.items():
+        newnw = fine.networks[name]
+        for key, arr in nw.edges.items():
+            arr = arr*factors[name] if key == 'dur' else arr.copy()
+            newnw.edges[key] = arr.astype(newnw.meta[key]) if key in newnw.meta else arr
+        if hasattr(nw, 'relationship_durs'):  # Only used by the relationship duration analyzer
+            newnw.relationship_durs = sc.dcp(nw.relationship_durs)
+            for rels in newnw.relationship_durs.values():
+                for rel in rels:
+                    rel['start'] *= factors[name]
+                    rel['dur'] *= factors[name]
+
+    # Results so far; they're scaled to the population size when the fine sim is finalized
+    for cmod, fmod in pairs:
+        factor = factors[fmod.name if fmod is not fine else None]
+        for key, res in cmod.results.items():
+            new = fmod.results.get(key)
+            if not isinstance(res, ss.Result) or not isinstance(new, ss.Result) or key == 'timevec':
+                continue
+            vals = np.repeat(res.values[:cmod.ti], factor, axis=0)
+            if (new.summarize_by or new.summary_method()) == 'sum':  # Flows, e.g. new infections
+                vals = vals/factor
+            new.values[:len(vals)] = vals
+
+    # Stratified results, which are counts of the HIV module's state at each timestep rather than flows over it
+    if 'strata' in coarse.analyzers:
+        cstrata, fstrata = coarse.analyzers.strata, fine.analyzers.strata
+        vals = np.repeat(cstrata.data[:cstrata.ti], factors['strata'], axis=0)
+        fstrata.data[:len(vals)] = vals
+    return fine
+
+
+def run_adaptive(coarse_dt=0.25, switch=None, **kwargs):
+    """
+    Make and run a sim that uses a coarse timestep up to the switch year and a monthly one after it
+
+    Args:
+        coarse_dt (float): timestep before the switch, in years; must divide a year into whole months (e.g. 0.25 or 1)
+        switch (float): year to switch to monthly timesteps (default: the first year any intervention is active)
+        kwargs (dict): passed to make_sim()
+
+    Returns:
+        sim (Sim): a monthly sim, with results for every month, whose timesteps before the switch were run coarsely
+
+    **Example**::
+
+        sim = run_adaptive(coarse_dt=1, switch=1995, stop=2030)
+        df = sim.to_df(resample='year', use_years=True)
+    """
+    from hiv_model import make_sim
+    factor = coarse_dt/fine_dt
+    if not np.isclose(factor, round(factor)) or not np.isclose(1/coarse_dt, round(1/coarse_dt)):
+        errormsg = f'The coarse timestep must be a whole number of months dividing a year, not {coarse_dt}'
+        raise ValueError(errormsg)
+    factor = round(factor)
+
+    sim = make_sim(**kwargs)
+    if not sim.initialized:
+        sim.init()
+    switch = np.floor(sc.ifelse(switch, first_activity(sim)))
+    if switch > sim.t.yearvec[0] and switch < sim.t.yearvec[-1]:  # Otherwise, run all-monthly
+        coarse = make_sim(**kwargs, dt=coarse_dt)
+        if not coarse.initialized:
+            coarse.init()
+        coarse = coarsen(coarse, factor)
+        run_until(coarse, switch)
+        fast_forward(sim, switch)
+        transplant(coarse, sim)
+    sim.switch = switch
+    sim.run()
+    return sim
+
+
+def validate(n_agents=10e3, n_seeds=5, stop=2025, coarse_dt=0.25, switch=None, tol=0.05):
+    """
+    Compare adaptive runs against all-monthly runs across several seeds
+
+    Calibration targets are compared as the difference in the seed-averaged yearly values, relative to
+    the monthly values and averaged over the data years; a target passes if this is below tol. For
+    reference, the same difference between the monthly runs and monthly runs with another set of seeds
+    is reported as the noise.
+
+    Returns:
+        targets (DataFrame): relative difference and noise of each calibration target, and whether it passes
+        trajectories (DataFrame): seed-averaged yearly targets for each mode
+        perf (DataFrame): run time of each mode and the speedup
+    """
+    from hiv_model import make_sim
+    from utils import get_targets
+
+    dfs = sc.objdict()
+    perf = sc.objdict()
+    for mode in ['monthly', 'adaptive', 'reseeded']:
+        runs = []
+        times = []
+        for seed in range(n_seeds):
+            if mode == 'reseeded':
+                seed += n_seeds
+            kwargs = dict(seed=seed, n_agents=n_agents, stop=stop, verbose=-1)
+            t0 = sc.tic()
+            if mode in ['monthly', 'reseeded']:
+                sim = make_sim(**kwargs)
+                sim.run()
+            else:
+                sim = run_adaptive(coarse_dt=coarse_dt, switch=switch, **kwargs)
+            times.append(sc.toc(t0, output=True))
+            runs.append(get_targets(sim))
+        dfs[mode] = pd.concat(runs).groupby(level=0).mean()
+        perf[mode] = dict(run_time=np.mean(times))
+
+    def compare(df):
+        return ((df - dfs.monthly).abs()/dfs.monthly.abs()).replace([np.inf, -np.inf], np.nan).mean()
+
+    reldiff = compare(dfs.adaptive)
+    targets = pd.DataFrame(dict(reldiff=reldiff, noise=compare(dfs.reseeded), passed=reldiff < tol))
+    trajectories = pd.concat(dfs, axis=1)
+    perf = pd.DataFrame(perf).T.loc[['monthly', 'adaptive']]
+    perf['speedup'] = perf.loc['monthly', 'run_time']/perf.run_time
+    return targets, trajectories, perf
+
+
+if __name__ == '__main__':
+
+    # SETTINGS
+    debug = False
+    n_seeds = [10, 2][debug]
+    coarse_dt = 0.25  # Quarterly; use 1 for yearly
+    switch = None  # Year to switch to monthly; None to use the first year any intervention is active
+    tol = 0.05  # Maximum relative change in calibration targets
+
+    targets, trajectories, perf = validate(n_seeds=n_seeds, coarse_dt=coarse_dt, switch=switch, tol=tol)
+
+    sc.heading('Calibration targets, adaptive vs monthly')
+    print(targets)
+    sc.heading('Speed')
+    print(perf)
+    if not targets.passed.all():
+        print(f'Targets outside tolerance of {tol:.0%}: {sc.strjoin(targets.index[~targets.passed])}')
+    trajectories.to_csv('results/adaptive_validation.csv')
+
+    print('Done!')
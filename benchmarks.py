@@ -0,0 +1,275 @@
+"""
+Benchmark suite for the HIV model pipeline
+
+Times sim construction, full runs at several agent counts, a single partner
+notification step on synthetic networks, the ensemble post-processing
+reductions, and a short calibration. Each run is saved as JSON in
+results/benchmarks/, and compared against the median of previous runs on the
+same machine; any benchmark slower than that by more than the threshold is
+reported as a regression.
+
+Run as a script; everything runs offline from the files in data/ and results/.
+"""
+
+# Additions to handle numpy multithreading
+import os
+os.environ.update(
+    OMP_NUM_THREADS='1',
+    OPENBLAS_NUM_THREADS='1',
+    NUMEXPR_NUM_THREADS='1',
+    MKL_NUM_THREADS='1',
+)
+
+# %% Imports and settings
+import json
+import functools
+import socket
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+import stisim as sti
+
+benchfolder = 'results/benchmarks'
+
+
+def timeit(fn, repeats=3, setup=None):
+    """ Time fn() over several repeats, calling setup() (untimed) before each, and return timing stats in seconds """
+    times = []
+    for r in range(repeats):
+        args = setup() if setup is not None else None
+        t0 = sc.tic()
+        fn(args) if setup is not None else fn()
+        times.append(sc.toc(t0, output=True))
+    return dict(min=float(np.min(times)), median=float(np.median(times)), repeats=repeats)
+
+
+def bench_make_sim(n_agents=10e3, repeats=3):
+    """ Time make_sim(), including initialization and applying the calibration parameters """
+    from hiv_model import make_sim
+    return timeit(lambda: make_sim(n_agents=n_agents, verbose=-1), repeats=repeats)
+
+
+def bench_run(n_agents=10e3, stop=2030, repeats=1):
+    """ Time a full run from 1985, excluding construction """
+    from hiv_model import make_sim
+    setup = lambda: make_sim(n_agents=n_agents, stop=stop, verbose=-1)
+    return timeit(lambda sim: sim.run(), setup=setup, repeats=repeats)
+
+
+def make_pn_sim(n_agents=10e3, degree=2, n_index=100, seed=1):
+    """
+    Make an initialized sim whose sexual networks are replaced by random networks of a given mean degree,
+    with n_index agents diagnosed on the current step, ready for PartnerNotification.step()
+    """
+    from hiv_model import make_sim
+    from run_pn_scens import make_pn_pars
+    pn_pars = make_pn_pars(pnc=0.5, pnp=0.1, pac=0.5, pap=0.2, start=0)
+    sim = make_sim(n_agents=n_agents, pn_pars=pn_pars, use_calib=False, verbose=-1, seed=seed)
+    sim.init()
+
+    rng = np.random.default_rng(seed)
+    people = sim.people
+    males = people.male.uids
+    females = people.female.uids
+    n_edges = int(len(people)*degree/2)
+    for nw in [sim.networks.structuredsexual, sim.networks.priorpartners]:
+        for key, dtype in nw.meta.items():
+            nw.edges[key] = np.zeros(n_edges, dtype=dtype)
+        nw.edges.p1 = ss.uids(rng.choice(males, n_edges))
+        nw.edges.p2 = ss.uids(rng.choice(females, n_edges))
+
+    hiv = sim.diseases.hiv
+    index = ss.uids(rng.choice(people.auids, n_index, replace=False))
+    hiv.diagnosed[index] = True
+    hiv.ti_diagnosed[index] = sim.ti
+    return sim
+
+
+def bench_pn_step(n_agents=10e3, degree=2, n_index=100, repeats=5):
+    """ Time one PartnerNotification.step() on a synthetic network, including the partner ledger update and CSR build """
+    setup = lambda: make_pn_sim(n_agents=n_agents, degree=degree, n_index=n_index)  # A fresh sim each repeat, so the ledger isn't cached
+    return timeit(lambda sim: sim.interventions.notify_partners.step(), setup=setup, repeats=repeats)
+
+
+@functools.lru_cache
+def make_ensemble_sim(stop=1995):
+    """ A single short run, used as the template for synthetic ensembles """
+    from hiv_model import make_sim
+    sim = make_sim(stop=stop, verbose=-1)
+    sim.run()
+    sim.shrink(die=False)
+    return sim
+
+
+def make_ensemble(template, n_sims=50):
+    """ Copy a run n_sims times, labeled as the scenario and parameter sets used by process_scens() and save_stats() """
+    scens = ['Base', 'PN - low', 'PN - med', 'PN - high']
+    sims = []
+    for i in range(n_sims):
+        sim = sc.dcp(template)
+        sim.par_idx = i
+        sim.parset = i
+        sim.pn_scen = scens[i % len(scens)]
+        sims.append(sim)
+    return sims
+
+
+def bench_reductions(n_sims=50, repeats=3):
+    """ Time process_scens() and save_stats() on a synthetic ensemble """
+    from run_pn_scens import process_scens
+    from hiv_model import save_stats
+    sims = make_ensemble(make_ensemble_sim(), n_sims=n_sims)
+    tmpdir = sc.path(benchfolder) / 'tmp'
+    os.makedirs(tmpdir, exist_ok=True)
+    out = dict(
+        process_scens=timeit(lambda: process_scens(sims), repeats=repeats),
+        save_stats=timeit(lambda: save_stats(sims, resfolder=tmpdir), repeats=repeats),
+    )
+    return out
+
+
+def bench_calibration(n_trials=4, stop=2000, repeats=1):
+    """ Time a short serial calibration """
+    from hiv_model import make_sim, make_sim_pars
+
+    def run():
+        sim = make_sim(stop=stop, verbose=-1, use_calib=False)
+        data = pd.read_csv('data/zambia_hiv_calib.csv')
+        data = data.loc[data.time <= stop]
+        calib = sti.Calibration(
+            calib_pars=dict(hiv_beta_m2f=dict(low=0.008, high=0.02, guess=0.012)),
+            build_fn=make_sim_pars,
+            sim=sim,
+            data=data,
+            total_trials=n_trials, n_workers=1,
+            die=True, reseed=False, storage=None, verbose=False,
+        )
+        calib.calibrate(load=False)
+        return calib
+
+    return timeit(run, repeats=repeats)
+
+
+def get_env():
+    """ Details of the machine and code versions, used to match runs for comparison """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    env = dict(
+        host=socket.gethostname(),
+        platform=platform.platform(),
+        cpu=platform.processor(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        starsim=ss.__version__,
+        stisim=sti.__version__,
+        commit=commit,
+    )
+    return env
+
+
+def run_benchmarks(quick=False, die=False):
+    """
+    Run the full suite, returning a flat dict of benchmark name: timing stats
+
+    If die is False, a benchmark that raises an exception is recorded with its error instead of stopping the suite.
+    """
+    agent_counts = [5e3, 10e3] if quick else [5e3, 10e3, 20e3, 50e3]
+    pn_sizes = [(10e3, 2)] if quick else [(10e3, 2), (10e3, 8), (100e3, 2), (100e3, 8)]
+    stop = 1995 if quick else 2030
+
+    benchmarks = sc.objdict()
+    benchmarks['make_sim'] = lambda: bench_make_sim()
+    for n_agents in agent_counts:
+        benchmarks[f'run_{n_agents:.0f}_agents_{stop}'] = lambda n_agents=n_agents: bench_run(n_agents=n_agents, stop=stop)
+    for n_agents, degree in pn_sizes:
+        benchmarks[f'pn_step_{n_agents:.0f}_agents_degree_{degree}'] = lambda n_agents=n_agents, degree=degree: bench_pn_step(n_agents=n_agents, degree=degree)
+    benchmarks['reductions'] = lambda: bench_reductions(n_sims=8 if quick else 50)
+    benchmarks['calibration'] = lambda: bench_calibration(n_trials=2 if quick else 4)
+
+    out = sc.objdict()
+    for name, fn in benchmarks.items():
+        print(f'Running benchmark {name}...')
+        try:
+            timings = fn()
+        except Exception as E:
+            if die:
+                raise E
+            print(f'Benchmark {name} failed: {E}')
+            timings = dict(error=str(E))
+        if name == 'reductions' and 'error' not in timings:
+            out.update(timings)  # One entry per reduction
+        else:
+            out[name] = timings
+    return out
+
+
+def save_benchmarks(timings, folder=benchfolder):
+    """ Save a benchmark run to a timestamped JSON file """
+    record = dict(date=sc.getdate(dateformat='%Y-%m-%dT%H:%M:%S'), env=get_env(), timings=timings)
+    os.makedirs(folder, exist_ok=True)
+    filename = sc.path(folder) / f"bench_{sc.getdate(dateformat='%Y%m%d_%H%M%S')}.json"
+    with open(filename, 'w') as f:
+        json.dump(record, f, indent=2)
+    return filename
+
+
+def load_history(folder=benchfolder, host=None):
+    """ Load previous benchmark runs as a long DataFrame, optionally only those from one host """
+    rows = []
+    for filename in sorted(sc.path(folder).glob('bench_*.json')):
+        with open(filename) as f:
+            record = json.load(f)
+        if host is not None and record['env']['host'] != host:
+            continue
+        for name, stats in record['timings'].items():
+            if 'error' in stats:
+                continue
+            rows.append(dict(date=record['date'], commit=record['env'].get('commit'), benchmark=name, time=stats['min']))
+    return pd.DataFrame(rows, columns=['date', 'commit', 'benchmark', 'time'])
+
+
+def compare(timings, history, threshold=0.2, n_recent=5):
+    """
+    Compare a benchmark run against the median of the n_recent previous runs of each benchmark
+
+    Returns a DataFrame with the ratio of the current to the baseline time, and whether it's a regression
+    (slower than the baseline by more than threshold, e.g. 0.2 = 20%).
+    """
+    rows = []
+    for name, stats in timings.items():
+        if 'error' in stats:
+            rows.append(dict(benchmark=name, time=np.nan, baseline=np.nan, ratio=np.nan, regression=False))
+            continue
+        prev = history.loc[history.benchmark == name].sort_values('date').time.values[-n_recent:]
+        baseline = np.median(prev) if len(prev) else np.nan
+        ratio = stats['min']/baseline
+        rows.append(dict(benchmark=name, time=stats['min'], baseline=baseline, ratio=ratio, regression=bool(ratio > 1 + threshold)))
+    return pd.DataFrame(rows).set_index('benchmark')
+
+
+if __name__ == '__main__':
+
+    # SETTINGS
+    quick = False  # If True, use fewer and smaller benchmarks
+    threshold = 0.2  # Report benchmarks more than this much slower than the recent median as regressions
+    do_save = True
+
+    history = load_history(host=socket.gethostname())
+    timings = run_benchmarks(quick=quick)
+    df = compare(timings, history, threshold=threshold)
+
+    sc.heading('Benchmark results')
+    print(df.to_string(float_format='{:.3f}'.format))
+    if df.regression.any():
+        print(f'\nRegressions (>{threshold:.0%} slower): {sc.strjoin(df.index[df.regression])}')
+
+    if do_save:
+        filename = save_benchmarks(timings)
+        print(f'Saved to {filename}')
+
+    print('Done!')
@@ -0,0 +1,164 @@
+"""
+Shared result block: yearly results of an ensemble in one memory-mapped array
+
+A ResultBlock is a (scenario, run, year, metric) array of floats in a .npy file
+that the parent creates and every worker maps. When a worker finishes a sim,
+it resamples the results it needs to yearly values (with NumPy, the same way
+as sim.to_df(resample='year')) and writes them into its own slice of the
+block, so no result arrays are pickled back to the parent and no per-sim
+DataFrames are built. The parent then computes summary statistics directly
+on the block; describe() gives the same layout as
+df.groupby(['timevec', 'scenario']).describe().
+
+The coordinates (scenario labels, runs, years and metric names) are stored
+next to the array in a .json file, so a block can be reopened later.
+
+**Example**::
+
+    block = ResultBlock('results/pn_scens.npy', scenarios=['Base', 'PN'], runs=range(10),
+                        years=range(1985, 2052), metrics=['hiv.new_infections', 'hiv.prevalence'])
+    block.write('PN', 3, sim)  # In a worker, after running the sim
+    df_stats = block.describe()  # In the parent, once every sim has been written
+"""
+
+# %% Imports and settings
+import os
+import json
+import warnings
+import numpy as np
+import pandas as pd
+import sciris as sc
+from utils import percentiles as default_percentiles
+
+dims = ['scenarios', 'runs', 'years', 'metrics']
+
+
+def yearly(sim, name, years):
+    """ Yearly values of a result at the given years, summarized over each year as in sim.to_df(resample='year') """
+    from reducers import get_result
+    res, mod = get_result(sim, name)
+    how = res.summarize_by or res.summary_method()
+    year = np.floor(np.asarray(mod.t.yearvec)[:len(res.values)] + 1e-9)
+    inds = np.searchsorted(years, year)
+    ok = (inds < len(years)) & (years[np.minimum(inds, len(years) - 1)] == year)
+    inds, values = inds[ok], np.asarray(res.values, dtype=float)[ok]
+
+    out = np.full(len(years), np.nan)
+    counts = np.bincount(inds, minlength=len(years))
+    has = counts > 0
+    if how == 'last':
+        out[inds] = values  # Later timesteps overwrite earlier ones
+    else:
+        totals = np.bincount(inds, weights=values, minlength=len(years))
+        out[has] = totals[has] if how == 'sum' else totals[has]/counts[has]
+    return out
+
+
+class ResultBlock:
+    """
+    Memory-mapped (scenario, run, year, metric) array of yearly results, written by workers and summarized by the parent
+
+    Args:
+        filename (str): .npy file for the array; the coordinates go in the same file with a .json extension
+        scenarios (list): scenario labels
+        runs (list): run labels, e.g. parameter sets or seeds
+        years (list): years to keep
+        metrics (list): results to keep, e.g. 'hiv.new_infections' or 'n_alive'
+
+    If the coordinates are given, a new block filled with NaN is created (replacing any existing one); if not, an
+    existing block is opened.
+    """
+    def __init__(self, filename, scenarios=None, runs=None, years=None, metrics=None):
+        self.filename = str(filename)
+        self.coordfile = os.path.splitext(self.filename)[0] + '.json'
+        coords = dict(scenarios=scenarios, runs=runs, years=years, metrics=metrics)
+        if all(v is None for v in coords.values()):
+            with open(self.coordfile) as f:
+                coords = json.load(f)
+        elif any(v is None for v in coords.values()):
+            errormsg = f'To create a block, give all of {sc.strjoin(dims)}'
+            raise ValueError(errormsg)
+        else:
+            coords = {k: [v.item() if isinstance(v, np.generic) else v for v in sc.tolist(vals)] for k, vals in coords.items()}
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            data = np.lib.format.open_memmap(self.filename, mode='w+', dtype=np.float64, shape=tuple(len(coords[d]) for d in dims))
+            data[:] = np.nan
+            data.flush()
+            del data
+            with open(self.coordfile, 'w') as f:
+                json.dump(coords, f)
+
+        for k, v in coords.items():
+            setattr(self, k, v)
+        self._data = None
+        return
+
+    def __getstate__(self):
+        """ Send only the filename and coordinates to workers, which map the file themselves """
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    @property
+    def shape(self):
+        return tuple(len(getattr(self, d)) for d in dims)
+
+    @property
+    def data(self):
+        """ The memory-mapped array """
+        if self._data is None:
+            self._data = np.load(self.filename, mmap_mode='r+')
+        return self._data
+
+    def index(self, dim, label):
+        """ Index of a scenario or run, from its label or index """
+        labels = getattr(self, dim)
+        if label in labels:
+            return labels.index(label)
+        elif isinstance(label, (int, np.integer)) and 0 <= label < len(labels):
+            return int(label)
+        errormsg = f'"{label}" is not one of the {dim}: {labels}'
+        raise KeyError(errormsg)
+
+    def write(self, scenario, run, sim):
+        """ Resample a finished sim's results to yearly values and write them to the block """
+        years = np.array(self.years, dtype=float)
+        values = np.column_stack([yearly(sim, metric, years) for metric in self.metrics])
+        self.data[self.index('scenarios', scenario), self.index('runs', run)] = values
+        self.data.flush()
+        return
+
+    def missing(self):
+        """ (scenario, run) pairs that haven't been written yet """
+        empty = np.isnan(self.data).all(axis=(2, 3))
+        return [(self.scenarios[s], self.runs[r]) for s, r in zip(*np.nonzero(empty))]
+
+    def describe(self, percentiles=default_percentiles):
+        """
+        Statistics across runs, in the layout of df.groupby(['timevec', 'scenario']).describe(percentiles=percentiles)
+
+        Rows are (year, scenario), sorted; columns are (metric, statistic). Runs that weren't written are left out.
+        """
+        data = np.moveaxis(np.asarray(self.data), 1, -1)  # scenario, year, metric, run
+        percentiles = sorted(set(percentiles) | {0.5})
+        with warnings.catch_warnings():  # All-NaN slices give NaN statistics, as in describe()
+            warnings.simplefilter('ignore', RuntimeWarning)
+            stats = dict(
+                count=np.sum(~np.isnan(data), axis=-1).astype(float),
+                mean=np.nanmean(data, axis=-1),
+                std=np.nanstd(data, axis=-1, ddof=1),
+                min=np.nanmin(data, axis=-1),
+                **{f'{p:.0%}': q for p, q in zip(percentiles, np.nanquantile(data, percentiles, axis=-1))},
+                max=np.nanmax(data, axis=-1),
+            )
+        labels = list(stats.keys())
+        values = np.stack([stats[label] for label in labels], axis=-1)  # scenario, year, metric, statistic
+        values = np.moveaxis(values, 0, 1).reshape(len(self.years)*len(self.scenarios), -1)  # (year, scenario) rows
+        index = pd.MultiIndex.from_product([self.years, self.scenarios], names=['timevec', 'scenario'])
+        columns = pd.MultiIndex.from_product([self.metrics, labels])
+        return pd.DataFrame(values, index=index, columns=columns).sort_index()
+
+    def to_df(self):
+        """ Long-format DataFrame of every value, e.g. for plotting individual runs """
+        index = pd.MultiIndex.from_product([self.scenarios, self.runs, self.years], names=['scenario', 'run', 'timevec'])
+        return pd.DataFrame(np.asarray(self.data).reshape(-1, len(self.metrics)), index=index, columns=self.metrics).reset_index()
@@ -0,0 +1,300 @@
+"""
+Content-addressed cache of sim runs
+
+Each run is keyed by a hash of everything that determines its output: the
+make_sim() arguments, the calibration row they select, the partner notification
+parameters, the contents of the data folder, the source of the modules that build
+and run the model (model_modules), and the starsim/stisim versions. A hit returns the stored (shrunken) sim without
+running anything; a miss runs the sim and stores it. The cache is bounded by
+total size and number of entries, evicting the least recently used runs first.
+"""
+
+# %% Imports and settings
+import os
+import json
+import hashlib
+import inspect
+import functools
+import numpy as np
+import sciris as sc
+import starsim as ss
+import stisim as sti
+
+cachefolder = 'results/run_cache'
+skip_args = ['verbose']  # make_sim() arguments that don't affect results
+model_modules = ['hiv_model', 'interventions', 'ledger', 'strata', 'compact', 'utils', 'templates', 'checkpoint']  # Source that runs depend on; run this file to check it's complete
+
+
+def hash_str(string, n=16):
+    """ Short SHA-256 digest of a string """
+    return hashlib.sha256(string.encode()).hexdigest()[:n]
+
+
+def hash_files(paths):
+    """ Hash the contents of a list of files """
+    sha = hashlib.sha256()
+    for path in sorted(paths):
+        sha.update(str(path).encode())
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()[:16]
+
+
+def source_version():
+    """
+    Version of the model code: the source of model_modules plus the starsim and stisim versions
+
+    Only these modules are included, so editing e.g. the plotting or analysis scripts doesn't invalidate every cached
+    run, template and checkpoint; check_model_modules() checks that none is missing.
+    """
+    folder = sc.thisdir(aspath=True)
+    return dict(source=hash_files([folder/f'{name}.py' for name in model_modules]), starsim=ss.__version__, stisim=sti.__version__)
+
+
+def check_model_modules():
+    """ Build and run a short sim in every mode that changes its code path, and raise an error if it used a module of this repo that isn't in model_modules """
+    import sys
+    import tempfile
+    from run_pn_scens import make_pn_pars  # Only makes make_sim() arguments, which are part of the key
+    from templates import make_sim
+    from checkpoint import run_checkpointed
+    folder = sc.thisdir(aspath=True)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pn_pars = make_pn_pars(pnc=0.5, pnp=0.1, pac=0.5, pap=0.2, start=1986)
+        sim = make_sim(folder=tmpdir, n_agents=1e3, stop=1987, pn_pars=pn_pars, precision='compact', verbose=-1)
+        run_checkpointed(sim, folder=f'{tmpdir}/checkpoints', every=1)
+    used = {name for name, mod in list(sys.modules.items()) if getattr(mod, '__file__', None) and sc.path(mod.__file__).parent == folder}
+    used = {name for name in used if not name.startswith('__')}  # The script being run (__main__ and __mp_main__)
+    missing = used - set(model_modules) - {'cache', 'run_pn_scens'}
+    if missing:
+        errormsg = f'Runs depend on {sc.strjoin(sorted(missing))}, which {"is" if len(missing) == 1 else "are"} not in cache.model_modules'
+        raise ValueError(errormsg)
+    return sorted(used)
+
+
+def data_version(datafolder='data'):
+    """ Hash of the contents of every file in the data folder """
+    return hash_files(sc.getfilelist(datafolder, filesonly=True))
+
+
+@functools.lru_cache(maxsize=4)
+def load_calib_df(filename, mtime):
+    """ The calibration parameter table; the file's modification time is part of the key, so a rewritten file is reloaded """
+    return sc.loadobj(filename).df
+
+
+def calib_row(par_idx, filename='results/zam_hiv_calib.obj'):
+    """ The calibration parameters that make_sim() will use for a given index """
+    return load_calib_df(filename, os.path.getmtime(filename)).iloc[par_idx].to_dict()
+
+
+def canonical(obj):
+    """ Convert an object to a JSON-compatible form that only depends on its contents """
+    if obj is None or isinstance(obj, (bool, str)):
+        return obj
+    elif sc.isnumber(obj):
+        return None if np.isnan(obj) else float(obj)
+    elif isinstance(obj, dict):
+        return {str(k): canonical(v) for k, v in sorted(obj.items(), key=lambda kv: str(kv[0]))}
+    elif isinstance(obj, (list, tuple, np.ndarray)):
+        return [canonical(v) for v in obj]
+    elif isinstance(obj, ss.Dist):
+        return dict(dist=type(obj).__name__, pars=canonical(dict(obj.pars)))
+    elif callable(obj) and not hasattr(obj, 'pars'):
+        return getattr(obj, '__qualname__', type(obj).__name__)
+    else:  # e.g. analyzers: identify them by class and parameters
+        pars = getattr(obj, 'pars', None)
+        return dict(cls=type(obj).__name__, pars=canonical(dict(pars)) if pars is not None else None)
+
+
+def sim_key(**kwargs):
+    """
+    Cache key for a sim made by make_sim(**kwargs) and run to completion
+
+    Extra keyword arguments that aren't make_sim() arguments (e.g. shrink) are
+    included in the key as well, so that differently stored runs don't collide.
+    """
+    from hiv_model import make_sim
+    defaults = {k: p.default for k, p in inspect.signature(make_sim).parameters.items()}
+    args = {**defaults, **kwargs}
+    for k in skip_args:
+        args.pop(k, None)
+
+    spec = dict(
+        args=canonical(args),
+        calib=canonical(calib_row(args['par_idx'])) if args['use_calib'] and args['calib_pars'] is None else None,  # Given calib_pars are in args
+        data=data_version(),
+        version=source_version(),
+    )
+    return hash_str(json.dumps(spec, sort_keys=True))
+
+
+class RunCache:
+    """
+    On-disk store of runs, keyed by content hash, with least-recently-used eviction
+
+    Args:
+        folder (str): folder to store runs in
+        max_size (float): maximum total size of the cache in bytes (default 10 GB)
+        max_entries (int): maximum number of runs to keep (default no limit)
+    """
+    def __init__(self, folder=cachefolder, max_size=10e9, max_entries=None):
+        self.folder = sc.path(folder)
+        self.max_size = max_size
+        self.max_entries = max_entries
+        os.makedirs(self.folder, exist_ok=True)
+        return
+
+    def path(self, key):
+        return self.folder / f'{key}.obj'
+
+    def __contains__(self, key):
+        return self.path(key).exists()
+
+    def get(self, key, default=None):
+        """ Load a run, marking it as recently used; returns default on a miss """
+        path = self.path(key)
+        if not path.exists():
+            return default
+        os.utime(path)  # Access time is unreliable on noatime mounts, so use the modification time for LRU
+        return sc.loadobj(path)
+
+    def set(self, key, obj):
+        """ Store a run, then evict old runs if the cache is over its limits """
+        path = self.path(key)
+        tmppath = path.with_suffix(f'.tmp{os.getpid()}')
+        sc.saveobj(tmppath, obj)
+        os.replace(tmppath, path)  # Atomic, so concurrent workers never see partial files
+        self.evict(keep=path)
+        return
+
+    def entries(self):
+        """ List of (path, size, last used) for every stored run, most recently used first """
+        entries = []
+        for path in self.folder.glob('*.obj'):
+            with sc.tryexcept(die=False, verbose=False):  # Another process may have just evicted it
+                stat = path.stat()
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda e: e[2], reverse=True)
+
+    def evict(self, keep=None):
+        """ Remove the least recently used runs until the cache is within its size and entry limits, but never keep (the run just stored) """
+        total = 0
+        for n, (path, size, _) in enumerate(self.entries()):
+            total += size
+            too_many = self.max_entries is not None and n >= self.max_entries
+            too_big = self.max_size is not None and total > self.max_size
+            if (too_many or too_big) and path != keep:
+                with sc.tryexcept(die=False, verbose=False):
+                    path.unlink()
+        return
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            path.unlink()
+        return
+
+
+def run_sim(cache=None, shrink=True, label=None, use_template=True, telemetry=None, block=None, block_index=None, checkpoint_every=None, use_cache=True, store=True, **kwargs):
+    """
+    Make and run a sim with make_sim(**kwargs), or load it from the cache if it's already been run
+
+    Args:
+        cache (RunCache): the cache to use (default: a RunCache in results/run_cache)
+        shrink (bool): whether to shrink the sim before storing it (dropping people, keeping results)
+        label (str): label to give the sim (not part of the key)
+        use_template (bool): start from a stored initialized population (see templates.py); the results are the same
+        telemetry (dict): if running the sim, report its progress with telemetry.add_telemetry(sim, **telemetry)
+        block (ResultBlock): if given, write the sim's yearly results to it at block_index, a (scenario, run) pair (see blocks.py)
+        checkpoint_every (float): if running the sim, save a checkpoint every this many simulated years, and resume from the latest one if an earlier run was interrupted (see checkpoint.py)
+        use_cache (bool): load the sim from the cache if it's there; if False, always run it
+        store (bool): store the sim in the cache after running it; if False, e.g. when only its results in the block are needed, nothing is written to the cache
+        kwargs (dict): passed to make_sim()
+    """
+    if use_template:
+        from templates import make_sim
+    else:
+        from hiv_model import make_sim
+    cache = sc.ifelse(cache, RunCache())
+    key = sim_key(shrink=shrink, **kwargs)
+    sim = cache.get(key) if use_cache else None
+    if sim is None:
+        sim = make_sim(**kwargs)
+        if telemetry is not None:
+            from telemetry import add_telemetry
+            info = {k: v for k, v in kwargs.items() if isinstance(v, (int, float, str)) and k not in skip_args}
+            add_telemetry(sim, info=info, **telemetry)
+        if checkpoint_every:
+            from checkpoint import run_checkpointed, checkpointfolder
+            sim = run_checkpointed(sim, folder=f'{checkpointfolder}/{key}', every=checkpoint_every, resume=True)  # The key identifies the run
+        else:
+            sim.run()
+        if store:
+            if shrink:
+                sim.shrink(die=False)
+            cache.set(key, sim)
+    sim.cache_key = key
+    if label is not None:
+        sim.label = label
+    if block is not None:
+        block.write(*block_index, sim)
+    return sim
+
+
+def store_sim(**kwargs):
+    """ Run a sim into the cache without returning it, so workers don't send sims back to the parent """
+    run_sim(**kwargs)
+    return
+
+
+def run_sims(kwargs_list, cache=None, shrink=True, parallel=True, n_workers=None, mem_budget=None, max_tasks_per_worker=10, use_template=True, telemetry=None,
+             block=None, block_inds=None, checkpoint_every=None, use_cache=True, store=True):
+    """
+    Run a list of sims, each specified by its make_sim() arguments, running only the ones not already cached
+
+    Sims are run in parallel with runners.run_ensemble(); if n_workers is None, the number
+    of workers is chosen to fit within mem_budget; telemetry (True or a log filename) shows their live progress,
+    and checkpoint_every saves checkpoints of each run (see run_sim()). Returns the sims in the same order as kwargs_list.
+
+    If a ResultBlock is given (see blocks.py), each sim's yearly results are written to it at the (scenario, run)
+    pair in block_inds instead: workers write the sims they run, cached sims are written one at a time, and the
+    block is returned rather than the sims. With a block, store=False writes each run only to the block, not to the
+    cache, and use_cache=False runs every sim even if it's cached.
+    """
+    from runners import run_ensemble
+    if block is None and not (use_cache and store):
+        errormsg = 'Without a block to write the results to, the sims are returned from the cache, so use_cache and store must be True'
+        raise ValueError(errormsg)
+    cache = sc.ifelse(cache, RunCache())
+    keys = [sim_key(shrink=shrink, **kwargs) for kwargs in kwargs_list]
+    block_kw = [dict(block=block, block_index=bi) for bi in block_inds] if block is not None else [dict()]*len(kwargs_list)
+    is_miss = [not use_cache or key not in cache for key in keys]
+    misses = [sc.mergedicts(kwargs, bkw) for kwargs, bkw, miss in zip(kwargs_list, block_kw, is_miss) if miss]
+    print(f'Running {len(misses)} of {len(kwargs_list)} sims ({len(kwargs_list)-len(misses)} cached)')
+
+    if len(misses):
+        runkw = dict(cache=cache, shrink=shrink, use_template=use_template, checkpoint_every=checkpoint_every, use_cache=use_cache, store=store)
+        if parallel:
+            run_ensemble(store_sim, [sc.mergedicts(runkw, kwargs) for kwargs in misses], n_workers=n_workers,
+                         mem_budget=mem_budget, max_tasks_per_worker=max_tasks_per_worker, telemetry=telemetry)
+        else:
+            for kwargs in misses:
+                store_sim(**runkw, **kwargs)
+
+    if block is not None:
+        for kwargs, bkw, miss in zip(kwargs_list, block_kw, is_miss):
+            if not miss:
+                run_sim(**kwargs, **bkw, cache=cache, shrink=shrink)
+        return block
+
+    sims = [run_sim(**kwargs, cache=cache, shrink=shrink) for kwargs in kwargs_list]  # All hits now
+    return sims
+
+
+if __name__ == '__main__':
+
+    # Check that the source hashed into the run keys covers every module that runs depend on
+    used = check_model_modules()
+    print(f'Runs use {sc.strjoin(used)}; all are in model_modules')
+    print(f'Source version: {source_version()}')
+    print('Done!')
@@ -0,0 +1,125 @@
+"""
+Periodic checkpoints for long single sims
+
+run_checkpointed() runs a sim in chunks of a few simulated years, saving the
+whole sim after each chunk: agent states, network edges, the state of every
+module and random number stream, and the results so far, together with
+NumPy's global random state (which partnership formation uses). Only the
+latest few checkpoints are kept. If the run is interrupted, resume() (or
+run_checkpointed(..., resume=True)) loads the latest checkpoint and carries on,
+giving exactly the same results as an uninterrupted run.
+
+Checkpoints are compressed pickles, written atomically, so an interruption
+while writing one never leaves a corrupt file. A checkpoint is only valid for
+the same model code, so resuming with different code gives a warning.
+
+cache.run_sim(checkpoint_every=...) keeps the checkpoints of each run in a
+folder named after its cache key, so running the same script again after an
+interruption resumes automatically.
+"""
+
+# %% Imports and settings
+import os
+import glob
+import shutil
+import numpy as np
+import sciris as sc
+import starsim as ss
+
+checkpointfolder = 'results/checkpoints'
+
+
+def checkpoint_files(folder):
+    """ Checkpoints in a folder, oldest first """
+    return sorted(glob.glob(os.path.join(folder, 'checkpoint_*.obj')))
+
+
+def save_checkpoint(sim, folder, keep=2):
+    """ Save a sim mid-run, and remove all but the latest keep checkpoints """
+    from cache import source_version
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f'checkpoint_{sim.ti:06d}.obj')  # By timestep, so they sort in order
+    tmppath = f'{path}.tmp{os.getpid()}'
+    sc.saveobj(tmppath, dict(sim=sim, np_state=np.random.get_state(), version=source_version()))
+    os.replace(tmppath, path)  # Atomic
+    for old in checkpoint_files(folder)[:-keep]:
+        os.remove(old)
+    return path
+
+
+def load_checkpoint(path):
+    """ Load a sim from a checkpoint, ready to carry on running """
+    from cache import source_version
+    state = sc.loadobj(path)
+    if state['version'] != source_version():
+        warnmsg = f'Checkpoint {path} was saved with different model code or package versions; results may differ from an uninterrupted run'
+        ss.warn(warnmsg)
+    np.random.set_state(state['np_state'])
+    return state['sim']
+
+
+def run_checkpointed(sim, folder, every=5, keep=2, resume=False, remove=True):
+    """
+    Run a sim to the end, saving a checkpoint every few simulated years
+
+    Args:
+        sim (Sim): the sim to run (initialized or not)
+        folder (str): folder for the checkpoints; use a separate folder for each sim
+        every (float): simulated years between checkpoints
+        keep (int): number of checkpoints to keep
+        resume (bool): if the folder already has a checkpoint, carry on from the latest one instead of starting sim from the beginning
+        remove (bool): remove the checkpoints once the sim has finished
+
+    Returns:
+        sim (Sim): the finished sim (which is not the one passed in, if it resumed from a checkpoint)
+    """
+    files = checkpoint_files(folder)
+    if resume and len(files):
+        sim = load_checkpoint(files[-1])
+        print(f'Resuming from {files[-1]}')
+    if not sim.initialized:
+        sim.init()
+
+    yearvec = sim.t.yearvec
+    checkpoints = np.arange(yearvec[0] + every, yearvec[-1], every)  # Aligned to the start year, wherever the sim resumed from
+    for until in checkpoints[checkpoints > yearvec[sim.ti] + 1e-9]:
+        sim.run(until=until)
+        save_checkpoint(sim, folder, keep=keep)
+    sim.run()
+
+    if remove:
+        shutil.rmtree(folder, ignore_errors=True)
+    return sim
+
+
+def resume(folder, every=5, keep=2, remove=True):
+    """ Carry on with an interrupted run from the latest checkpoint in a folder, and run it to the end """
+    files = checkpoint_files(folder)
+    if not len(files):
+        errormsg = f'No checkpoints found in {folder}'
+        raise FileNotFoundError(errormsg)
+    return run_checkpointed(None, folder, every=every, keep=keep, resume=True, remove=remove)
+
+
+if __name__ == '__main__':
+
+    # Check that resuming from a checkpoint gives the same results as an uninterrupted run
+    from hiv_model import make_sim
+
+    # SETTINGS
+    stop = 2010
+    every = 5
+    folder = f'{checkpointfolder}/test'
+
+    ref = make_sim(stop=stop, verbose=-1)
+    ref.run()
+
+    sim = make_sim(stop=stop, verbose=-1)
+    sim.run(until=2000)
+    save_checkpoint(sim, folder)  # As if the run was killed after this checkpoint
+    del sim
+    sim = resume(folder, every=every)
+
+    same = all(np.array_equal(r1.values, r2.values, equal_nan=True) for r1, r2 in zip(ref.results.flatten().values(), sim.results.flatten().values()))
+    print(f'Results are {"identical" if same else "DIFFERENT"}')
+    print('Done!')
@@ -0,0 +1,140 @@
+"""
+Compact-state mode: store agent states at reduced precision
+
+set_precision() casts every floating-point agent state (CD4 counts, time
+indices such as ti_diagnosed and ti_exposed, PartnerNotification.ti_notified,
+...) and the floating-point network edge attributes to a given dtype, and
+makes sure agents added later use the same dtype. Time indices stay floating
+point, since the model uses NaN to mean "never"; float32 represents every
+time index exactly. Integer edge attributes (acts) are narrowed to int32.
+Each network's meta dtypes are updated to match, and edges appended later
+(new partnerships) are cast to them, so the edges keep their dtype as the sim
+runs.
+
+Boolean states are kept at one byte per agent: every module indexes and
+assigns them directly as NumPy boolean arrays, so bit-packing them would mean
+unpacking them at every access.
+
+Run this file to compare the calibration targets, memory and speed of the
+compact and full-precision modes.
+"""
+
+# %% Imports and settings
+import functools
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+
+precisions = dict(full=np.float64, compact=np.float32)
+
+
+def set_precision(sim, precision='compact'):
+    """
+    Set the dtype of an initialized sim's floating-point states and network edges
+
+    Args:
+        sim (Sim): an initialized sim
+        precision (str/dtype): 'compact' (float32), 'full' (float64), or a NumPy float dtype
+    """
+    if not sim.initialized:
+        errormsg = 'The sim must be initialized before its precision can be set'
+        raise RuntimeError(errormsg)
+    dtype = np.dtype(precisions.get(precision, precision))
+
+    # Agent states; setting state.dtype means arrays grown for new agents use it too
+    for state in sim.people.states.values():
+        if isinstance(state, ss.FloatArr) and state.raw.dtype != dtype:
+            state.dtype = dtype.type
+            state.raw = state.raw.astype(dtype)
+
+    # Network edges; the meta dtypes are what edges appended later are cast to
+    int_dtype = np.int32 if dtype.itemsize < 8 else np.int64
+    for nw in sim.networks.values():
+        for key, arr in nw.edges.items():
+            if key in ['p1', 'p2']:  # UIDs are always int64
+                continue
+            if np.issubdtype(arr.dtype, np.floating):
+                new_dtype = dtype
+            elif np.issubdtype(arr.dtype, np.integer):
+                new_dtype = np.dtype(int_dtype)
+            else:
+                continue
+            nw.edges[key] = arr.astype(new_dtype)
+            nw.meta[key] = new_dtype.type
+        nw.append = functools.partial(append_typed, nw)  # Otherwise np.concatenate() promotes to the dtype of the new edges
+    return sim
+
+
+def append_typed(nw, edges=None, **kwargs):
+    """ Network.append(), casting the new edges to the network's meta dtypes first """
+    edges = sc.mergedicts(edges, kwargs)
+    for key, value in edges.items():
+        if key in nw.meta and key not in ['p1', 'p2']:
+            edges[key] = np.asarray(value, dtype=nw.meta[key])
+    return type(nw).append(nw, edges)
+
+
+def state_nbytes(sim):
+    """ Memory used by agent states in bytes, by dtype """
+    out = sc.objdict()
+    for state in sim.people.states.values():
+        key = str(state.raw.dtype)
+        out[key] = out.get(key, 0) + state.raw.nbytes
+    out['total'] = sum(out.values())
+    return out
+
+
+def validate(n_agents=10e3, n_seeds=5, stop=2025, tol=0.05):
+    """
+    Compare compact against full precision across several seeds
+
+    Calibration targets are compared as the difference in the seed-averaged yearly values, relative to
+    the full-precision values and averaged over the data years; a target passes if this is below tol.
+
+    Returns:
+        targets (DataFrame): relative difference of each calibration target, and whether it passes
+        perf (DataFrame): state memory and run time of each mode
+    """
+    from hiv_model import make_sim
+    from utils import get_targets
+
+    dfs = sc.objdict()
+    perf = sc.objdict()
+    for precision in precisions.keys():
+        runs = []
+        times = []
+        for seed in range(n_seeds):
+            sim = make_sim(seed=seed, n_agents=n_agents, stop=stop, precision=precision, verbose=-1)
+            nbytes = state_nbytes(sim).total
+            t0 = sc.tic()
+            sim.run()
+            times.append(sc.toc(t0, output=True))
+            runs.append(get_targets(sim))
+        dfs[precision] = pd.concat(runs).groupby(level=0).mean()
+        perf[precision] = dict(state_mb=nbytes/1e6, state_mb_end=state_nbytes(sim).total/1e6, run_time=np.mean(times))
+
+    reldiff = ((dfs.compact - dfs.full).abs()/dfs.full.abs()).replace([np.inf, -np.inf], np.nan).mean()
+    targets = pd.DataFrame(dict(reldiff=reldiff, passed=reldiff < tol))
+    perf = pd.DataFrame(perf).T
+    perf['speedup'] = perf.loc['full', 'run_time']/perf.run_time
+    return targets, perf
+
+
+if __name__ == '__main__':
+
+    # SETTINGS
+    debug = False
+    n_seeds = [10, 2][debug]
+    tol = 0.05  # Maximum relative change in calibration targets
+
+    targets, perf = validate(n_seeds=n_seeds, tol=tol)
+
+    sc.heading('Calibration targets, compact vs full precision')
+    print(targets)
+    sc.heading('Memory and speed')
+    print(perf)
+    if not targets.passed.all():
+        print(f'Targets outside tolerance of {tol:.0%}: {sc.strjoin(targets.index[~targets.passed])}')
+
+    print('Done!')
@@ -0,0 +1,264 @@
+"""
+Incremental figure pipeline
+
+Each figure declares the summaries it needs: the columns and time window of a
+results DataFrame, or a function that extracts a few arrays from a saved sim.
+Summaries are extracted once per results file into a small cache in
+results/summaries/, so each file is loaded at most once however many figures
+use it. A figure is rebuilt only if one of its summaries, its plotting code or
+its settings have changed since it was last built (or its file is missing), and
+stale figures are built in parallel.
+
+Results files are identified by their size and modification time, so rerunning
+a script that rewrites a file (e.g. run_pn_scens.py) marks the figures using it
+as stale. Run this file after a run to bring all the figures up to date.
+"""
+
+# %% Imports and settings
+import os
+import json
+import inspect
+import sciris as sc
+import cache as ca
+
+figfolder = 'figures'
+sumfolder = 'results/summaries'
+manifest_file = f'{figfolder}/manifest.json'
+
+
+def file_stamp(path):
+    """ Identify a file by its size and modification time, without reading it """
+    stat = os.stat(path)
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def code_version(fn):
+    """ Hash of the source of the module defining a function, so figures are rebuilt when their plotting code changes """
+    return ca.hash_files([inspect.getsourcefile(fn)])
+
+
+class Summary:
+    """
+    The part of a results file that a figure needs
+
+    Args:
+        source (str): path to the results file
+        columns (list): DataFrame columns to keep (for columns with several levels, the names in the first level)
+        window (tuple): first and last years to keep, matched against the (first level of the) index
+        extract (func): instead of columns and window, a function that extracts the summary from the loaded object
+    """
+    def __init__(self, source, columns=None, window=None, extract=None):
+        self.source = source
+        self.columns = columns
+        self.window = window
+        self.extract = extract
+        return
+
+    def __repr__(self):
+        return f'Summary({self.source}, columns={self.columns}, window={self.window}, extract={getattr(self.extract, "__qualname__", None)})'
+
+    def key(self):
+        """ Cache key of the summary: its specification plus the current version of the source file """
+        spec = dict(
+            source=self.source,
+            stamp=file_stamp(self.source),
+            columns=self.columns,
+            window=self.window,
+            extract=[self.extract.__qualname__, code_version(self.extract)] if self.extract else None,
+        )
+        return ca.hash_str(json.dumps(spec, sort_keys=True, default=str))
+
+    def path(self):
+        return sc.path(sumfolder) / f'{self.key()}.obj'
+
+    def available(self):
+        return os.path.exists(self.source)
+
+    def from_obj(self, obj):
+        """ Extract the summary from the loaded results file """
+        if self.extract is not None:
+            return self.extract(obj)
+        df = obj
+        if self.columns is not None:
+            df = df.loc[:, df.columns.get_level_values(0).isin(self.columns)]
+        if self.window is not None:
+            years = df.index.get_level_values(0)
+            df = df.loc[(years >= self.window[0]) & (years <= self.window[1])]
+        return df.copy()
+
+    def load(self):
+        return sc.loadobj(self.path())
+
+
+class Figure:
+    """
+    A figure and the summaries it's made from
+
+    Args:
+        name (str): name of the figure
+        plot_fn (func): plotting function; called as plot_fn(**summaries, **kwargs), and saves the figure itself
+        summaries (dict): the Summary passed to plot_fn as each keyword argument
+        filename (str): file that plot_fn saves the figure to
+        kwargs (dict): other arguments to plot_fn
+    """
+    def __init__(self, name, plot_fn, summaries, filename, kwargs=None):
+        self.name = name
+        self.plot_fn = plot_fn
+        self.summaries = summaries
+        self.filename = filename
+        self.kwargs = sc.ifelse(kwargs, dict())
+        return
+
+    def available(self):
+        return all(s.available() for s in self.summaries.values())
+
+    def key(self):
+        """ Key of everything the figure depends on: its summaries, plotting code and settings """
+        spec = dict(
+            summaries={k: s.key() for k, s in self.summaries.items()},
+            code=[self.plot_fn.__qualname__, code_version(self.plot_fn)],
+            kwargs=ca.canonical(self.kwargs),
+        )
+        return ca.hash_str(json.dumps(spec, sort_keys=True))
+
+
+def get_figures():
+    """ All the figures made from results files """
+    from plot_sims import plot_hiv_sims
+    from plot_pn_scens import plot_scens
+    from plot_epi import plot_epi, get_dx_summary
+    from plot_network import plot_network, get_network_summary
+    from utils import percentile_pairs
+
+    calib_cols = ['n_alive', 'hiv_n_infected', 'hiv_prevalence_15_49', 'hiv_new_infections', 'hiv_new_deaths', 'hiv_n_diagnosed', 'hiv_n_on_art']
+    sw_cols = [f'new_{which}_{group}_hiv' for which in ['infections', 'transmissions'] for group in ['fsw', 'client', 'non_fsw', 'non_client']]
+
+    figs = [
+        Figure(
+            name='hiv_calib',
+            plot_fn=plot_hiv_sims,
+            summaries=dict(df=Summary('results/zam_hiv_calib_stats.df', columns=calib_cols, window=(1985, 2025))),
+            filename=f'{figfolder}/hiv_calib1985_multi.png',
+            kwargs=dict(start_year=1985, end_year=2025, which='multi', percentile_pairs=percentile_pairs, title='hiv_calib'),
+        ),
+        Figure(
+            name='pn_scens',
+            plot_fn=plot_scens,
+            summaries=dict(df=Summary('results/pn_scens.df', columns=['hiv.new_infections', 'hiv.prevalence'], window=(2020, 2040))),
+            filename=f'{figfolder}/pn_scens.png',
+        ),
+        Figure(
+            name='hiv_epi',
+            plot_fn=plot_epi,
+            summaries=dict(
+                sw_df=Summary('results/sw_df.df', columns=sw_cols, window=(2010, 2030)),
+                epi_df=Summary('results/epi_df.df', columns=['age', 'sex', 'prevalence', 'new_infections']),
+                dx=Summary('results/zambia.sim', extract=get_dx_summary),
+            ),
+            filename=f'{figfolder}/hiv_epi.png',
+        ),
+        Figure(
+            name='network',
+            plot_fn=plot_network,
+            summaries=dict(nw=Summary('results/zambia.sim', extract=get_network_summary)),
+            filename=f'{figfolder}/figS_network.png',
+        ),
+    ]
+    return figs
+
+
+def extract_summaries(figs):
+    """ Extract every summary that isn't already cached, loading each results file once """
+    os.makedirs(sumfolder, exist_ok=True)
+    missing = sc.ddict(list)
+    for fig in figs:
+        for summary in fig.summaries.values():
+            if not summary.path().exists():
+                missing[summary.source].append(summary)
+
+    for source, summaries in missing.items():
+        print(f'Extracting {len(summaries)} summaries from {source}')
+        obj = sc.loadobj(source)
+        for summary in summaries:
+            sc.saveobj(summary.path(), summary.from_obj(obj))
+    return
+
+
+def load_manifest():
+    """ Keys of the figures as they were last built """
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            return json.load(f)
+    return dict()
+
+
+def build_figure(fig):
+    """ Make a figure from its cached summaries """
+    import matplotlib
+    matplotlib.use('agg')  # Never show figures, especially from worker processes
+    import matplotlib.pyplot as pl
+    summaries = {k: s.load() for k, s in fig.summaries.items()}
+    fig.plot_fn(**summaries, **fig.kwargs)
+    pl.close('all')
+    return fig.name
+
+
+def build(figs=None, force=False, parallel=True):
+    """
+    Bring figures up to date, rebuilding only those whose inputs have changed
+
+    Figures whose results files don't exist are skipped.
+
+    Args:
+        figs (list): figures to build (default: all of get_figures())
+        force (bool): rebuild every figure, even if it's up to date
+        parallel (bool): build stale figures in parallel
+
+    Returns:
+        built (list): names of the figures that were rebuilt
+    """
+    figs = sc.ifelse(figs, get_figures())
+    available = []
+    for fig in figs:
+        if fig.available():
+            available.append(fig)
+        else:
+            missing = [s.source for s in fig.summaries.values() if not s.available()]
+            print(f'Skipping {fig.name}: missing {sc.strjoin(sorted(set(missing)))}')
+
+    extract_summaries(available)
+    manifest = load_manifest()
+    keys = {fig.name: fig.key() for fig in available}
+    stale = [fig for fig in available if force or manifest.get(fig.name) != keys[fig.name] or not os.path.exists(fig.filename)]
+    print(f'Building {len(stale)} of {len(available)} figures ({len(available)-len(stale)} up to date)')
+
+    os.makedirs(figfolder, exist_ok=True)
+    if parallel and len(stale) > 1:
+        built = sc.parallelize(build_figure, stale)
+    else:
+        built = [build_figure(fig) for fig in stale]
+
+    manifest.update({name: keys[name] for name in built})
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return built
+
+
+def clear_summaries():
+    """ Remove every cached summary """
+    for path in sc.path(sumfolder).glob('*.obj'):
+        path.unlink()
+    return
+
+
+if __name__ == '__main__':
+
+    # SETTINGS
+    force = False  # Rebuild every figure, even if its inputs haven't changed
+    parallel = True
+
+    T = sc.timer()
+    built = build(force=force, parallel=parallel)
+    T.toc(f'Built {len(built)} figures')
+
+    print('Done!')
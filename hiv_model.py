@@ -3,11 +3,14 @@ Create HIV model and interventions
 """
 
 # %% Imports and settings
+import numpy as np
 import sciris as sc
 import pandas as pd
 import stisim as sti
 import starsim as ss
 from interventions import make_hiv_intvs
+from ledger import PartnerLedger
+from strata import StrataTensor
 # ss.options.warnings = 'error'
 
 
@@ -19,7 +22,8 @@ def make_sim_pars(sim, calib_pars):
     # Apply the calibration parameters
     for k, pars in calib_pars.items():  # Loop over the calibration parameters
         if k == 'rand_seed':
-            sim.pars.rand_seed = v
+            sim.pars.rand_seed = int(pars['value'] if isinstance(pars, dict) else pars)
+            sim.dists.init(base_seed=sim.pars.rand_seed, force=True)  # Reseed the already-initialized sim
             continue
 
         elif k in ['index', 'mismatch']:
@@ -47,7 +51,8 @@ def make_sim_pars(sim, calib_pars):
     return sim
 
 
-def make_sim(seed=1, stop=2030, verbose=1/12, analyzers=None, use_calib=True, pn_pars=None, analyze_network=False, par_idx=0):
+def make_sim(seed=1, stop=2030, verbose=1/12, analyzers=None, use_calib=True, pn_pars=None, analyze_network=False, par_idx=0, test_scale=1, n_agents=10e3, start=1985, precision=None, dt=None,
+             location='zambia', pop_share=1, art_scale=1, init_prev_scale=1, stratify=True, calib_pars=None, interventions=None):
 
     nw = sti.StructuredSexual(
         prop_f0=0.79,
@@ -63,14 +68,21 @@ def make_sim(seed=1, stop=2030, verbose=1/12, analyzers=None, use_calib=True, pn
         beta_m2f=0.012,
         eff_condom=0.5,
         init_prev_data=pd.read_csv('data/init_prev_hiv.csv'),
-        rel_init_prev=.5,
+        rel_init_prev=.5*init_prev_scale,
     )
 
-    intvs = make_hiv_intvs(pn_pars=pn_pars)
+    # The ART data are national numbers on treatment, so scale them to the share of the population modeled
+    intvs = make_hiv_intvs(pn_pars=pn_pars, test_scale=test_scale, art_scale=art_scale*pop_share)
+    intvs += sc.tolist(interventions)  # Any others, e.g. provinces.ImportedInfections
 
     # Add network analyzers
     analyzers = sc.autolist(analyzers)
     analyzers += sti.sw_stats(diseases=['hiv'])
+    if stratify:
+        analyzers += StrataTensor(age_bins=hiv.age_bins)  # Results by age and sex, as one array
+        hiv.age_bins = np.array([hiv.age_bins[0], hiv.age_bins[-1]])  # So stisim only keeps its results for all ages
+    if pn_pars is not None:
+        analyzers += PartnerLedger()  # Used by partner notification to look up partners
     if analyze_network:
         analyzers += sti.NetworkDegree(relationship_types=['partners', 'stable', 'casual'])
         analyzers += sti.RelationshipDurations()
@@ -78,40 +90,65 @@ def make_sim(seed=1, stop=2030, verbose=1/12, analyzers=None, use_calib=True, pn
         analyzers += sti.partner_age_diff()
 
     sim = sti.Sim(
-        n_agents=10e3,
-        start=1985,
+        n_agents=n_agents,
+        start=start,
         stop=stop,
         datafolder='data/',
-        demographics='zambia',
+        demographics=location,
         diseases=hiv,
         rand_seed=seed,
         networks=[nw, priorpartners, ss.MaternalNet()],
         interventions=intvs,
         analyzers=analyzers,
         verbose=verbose,
+        **(dict(dt=dt) if dt is not None else dict()),  # Default: monthly
+        **(dict(age_scale=pop_share) if pop_share != 1 else dict()),  # Default age_scale is 1: the whole population in the age data
     )
 
-    # If using calibration parameters, update the simulation
-    if use_calib:
+    # If using calibration parameters, update the simulation; calib_pars gives their values directly, e.g. for sensitivity analysis
+    if calib_pars is not None:
+        sim.init()
+        sim = make_sim_pars(sim, calib_pars)
+    elif use_calib:
         calib = sc.loadobj('results/zam_hiv_calib.obj')
         calib_pars = calib.df.iloc[par_idx].to_dict()
         sim.init()
         sim = make_sim_pars(sim, calib_pars)
         print(f'Using calibration parameters for index {par_idx}')
 
-    return sim
+    # Optionally change the precision of the agent states: 'compact' or 'full'
+    if precision is not None:
+        from compact import set_precision
+        if not sim.initialized: sim.init()
+        set_precision(sim, precision)
 
+    return sim
 
-def run_msim(use_calib=True, n_pars=1, do_save=True):
-
-    # Mave individual sims
-    sims = sc.autolist()
 
-    for par_idx in range(n_pars):
-        sim = make_sim(use_calib=use_calib, par_idx=par_idx, verbose=-1)
-        sim.par_idx = par_idx
-        sims += sim
-    sims = ss.parallel(sims).sims
+def run_msim(use_calib=True, n_pars=1, do_save=True, use_cache=True, telemetry=True):
+
+    # Make individual sims
+    if use_cache:
+        from cache import run_sims
+        sims = run_sims([dict(use_calib=use_calib, par_idx=par_idx, verbose=-1) for par_idx in range(n_pars)], telemetry=telemetry)
+        for par_idx, sim in enumerate(sims):
+            sim.par_idx = par_idx
+
+    else:
+        from templates import make_sim as make_template_sim  # Every parameter set starts from the same initialized population
+        sims = sc.autolist()
+        for par_idx in range(n_pars):
+            sim = make_template_sim(use_calib=use_calib, par_idx=par_idx, verbose=-1)
+            sim.par_idx = par_idx
+            sims += sim
+        if telemetry:
+            from telemetry import Monitor, add_telemetry
+            with Monitor(logfile=telemetry if isinstance(telemetry, str) else None, n_tasks=len(sims)) as monitor:
+                for sim in sims:
+                    add_telemetry(sim, monitor.address, task=sim.par_idx, info=dict(par_idx=sim.par_idx))
+                sims = ss.parallel(sims).sims
+        else:
+            sims = ss.parallel(sims).sims
 
     if do_save:
         dfs = sc.autolist()
@@ -128,28 +165,19 @@ def run_msim(use_calib=True, n_pars=1, do_save=True):
 
 def save_stats(sims, resfolder='results'):
 
-    # Epi stats: save for all runs
+    # Epi stats by age and sex, from the stratified results: save for all runs
+    sex_labels = {'f': 'Female', 'm': 'Male'}
     dfs = sc.autolist()
     for sim in sims:
-
-        par_idx = sim.par_idx
-
-        # Save age/sex epi results
-        age_bins = sim.diseases.hiv.age_bins
-        sex_labels = {'f': 'Female', 'm': 'Male'}
-        disease = 'hiv'
+        strata = sim.analyzers.strata
         for sex in ['f', 'm']:
-            dd = dict()
-            for ab1, ab2 in zip(age_bins[:-1], age_bins[1:]):
-                age = str(ab1) + '-' + str(ab2)
-                if ab1 == 65:
-                    age = '65+'  # Combine the last two age groups
-                dd['age'] = [age]
-                dd['sex'] = sex_labels[sex]
-                dd['prevalence'] = sim.results[disease][f'prevalence_{sex}_{ab1}_{ab2}'][-1]
-                dd['new_infections'] = sim.results[disease][f'new_infections_{sex}_{ab1}_{ab2}'][-120:].mean()
-                dd['par_idx'] = par_idx
-                dfs += pd.DataFrame(dd)
+            dfs += pd.DataFrame(dict(
+                age=strata.age_labels,  # The last age group is labeled 65+
+                sex=sex_labels[sex],
+                prevalence=strata.get('prevalence', ti=-1, sex=sex, age=slice(None)),
+                new_infections=strata.get('new_infections', ti=slice(-120, None), sex=sex, age=slice(None)).mean(axis=0),
+                par_idx=sim.par_idx,
+            ))
     epi_df = pd.concat(dfs)
     sc.saveobj(f'{resfolder}/epi_df.df', epi_df)
 
@@ -172,6 +200,8 @@ if __name__ == '__main__':
     do_run = True
     do_plot = True
     use_calib = True
+    use_cache = True  # Reuse previous runs with identical inputs, code and data
+    checkpoint_every = 5  # Simulated years between checkpoints; if the run is interrupted, running this again resumes it
 
     to_run = [
         'run_sim',
@@ -183,8 +213,16 @@ if __name__ == '__main__':
         if do_run:
             from run_pn_scens import make_pn_pars
             pn_pars = make_pn_pars(pnc=0.1, pnp=0, pac=0.1, pap=0)
-            sim = make_sim(use_calib=use_calib, analyze_network=True, pn_pars=pn_pars, verbose=1/12)
-            sim.run()
+            if use_cache:
+                from cache import run_sim
+                sim = run_sim(use_calib=use_calib, analyze_network=True, pn_pars=pn_pars, verbose=1/12, shrink=False, checkpoint_every=checkpoint_every)
+            else:
+                sim = make_sim(use_calib=use_calib, analyze_network=True, pn_pars=pn_pars, verbose=1/12)
+                if checkpoint_every:
+                    from checkpoint import run_checkpointed
+                    sim = run_checkpointed(sim, folder='results/checkpoints/zambia_sim', every=checkpoint_every)  # To resume after an interruption, use checkpoint.resume() on this folder
+                else:
+                    sim.run()
             df = sim.to_df(resample='year', use_years=True, sep='_')  # Use dots to separate columns
             df.index = df['timevec']
             if do_save:
@@ -200,7 +238,7 @@ if __name__ == '__main__':
     if 'run_msim' in to_run:
         n_pars = 50 if not debug else 2
         if do_run:
-            sims = run_msim(use_calib=use_calib, n_pars=n_pars, do_save=do_save)
+            sims = run_msim(use_calib=use_calib, n_pars=n_pars, do_save=do_save, use_cache=use_cache)
         else:
             sims = None
 
@@ -10,9 +10,35 @@ import stisim as sti
 import sciris as sc
 
 
-def get_testing_products():
+# Eligibility for testing and partner notification; defined at module level so that sims can be pickled without dill
+def fsw_eligibility(sim):
+    """ FSW agents who haven't been diagnosed or treated yet """
+    return sim.networks.structuredsexual.fsw & ~sim.diseases.hiv.diagnosed & ~sim.diseases.hiv.on_art
+
+
+def other_eligibility(sim):
+    """ Non-FSW agents who haven't been diagnosed or treated yet """
+    return ~sim.networks.structuredsexual.fsw & ~sim.diseases.hiv.diagnosed & ~sim.diseases.hiv.on_art
+
+
+def low_cd4_eligibility(sim):
+    """ Agents whose CD4 count is below 200 """
+    return (sim.diseases.hiv.cd4 < 200) & ~sim.diseases.hiv.diagnosed
+
+
+def just_diagnosed(sim):
+    """ Return UIDs of people who have just been diagnosed - could add recency test here too  """
+    new_diagnoses = (sim.diseases.hiv.ti_diagnosed == sim.diseases.hiv.ti).uids
+    # previous_index = ... # Exclude people who were the original index case
+    return new_diagnoses
+
+
+def get_testing_products(test_scale=1):
     """
     Define HIV products and testing interventions
+
+    Args:
+        test_scale (float): multiplier applied to the testing scale-up curves (capped at a probability of 1)
     """
     scaleup_years = np.arange(1990, 2021)  # Years for testing
     years = np.arange(1990, 2051)  # Years for simulation
@@ -20,11 +46,9 @@ def get_testing_products():
     fsw_prob = np.concatenate([np.linspace(0, 0.75, n_years), np.linspace(0.75, 0.85, len(years) - n_years)])
     low_cd4_prob = np.concatenate([np.linspace(0, 0.85, n_years), np.linspace(0.85, 0.95, len(years) - n_years)])
     gp_prob = np.concatenate([np.linspace(0, 0.1, n_years), np.linspace(0.1, 0.1, len(years) - n_years)])
+    fsw_prob, low_cd4_prob, gp_prob = [np.minimum(prob*test_scale, 1) for prob in [fsw_prob, low_cd4_prob, gp_prob]]
 
     # FSW agents who haven't been diagnosed or treated yet
-    def fsw_eligibility(sim):
-        return sim.networks.structuredsexual.fsw & ~sim.diseases.hiv.diagnosed & ~sim.diseases.hiv.on_art
-
     fsw_testing = sti.HIVTest(
         years=years,
         test_prob_data=fsw_prob,
@@ -34,9 +58,6 @@ def get_testing_products():
     )
 
     # Non-FSW agents who haven't been diagnosed or treated yet
-    def other_eligibility(sim):
-        return ~sim.networks.structuredsexual.fsw & ~sim.diseases.hiv.diagnosed & ~sim.diseases.hiv.on_art
-
     other_testing = sti.HIVTest(
         years=years,
         test_prob_data=gp_prob,
@@ -46,9 +67,6 @@ def get_testing_products():
     )
 
     # Agents whose CD4 count is below 200.
-    def low_cd4_eligibility(sim):
-        return (sim.diseases.hiv.cd4 < 200) & ~sim.diseases.hiv.diagnosed
-
     low_cd4_testing = sti.HIVTest(
         years=years,
         test_prob_data=low_cd4_prob,
@@ -107,31 +125,34 @@ class PartnerNotification(ss.Intervention):
             previous=sim.networks.priorpartners,  # Prior sexual network
         )
 
+    @property
+    def ledger(self):
+        """ Partnerships of each agent, from the PartnerLedger analyzer (see make_sim) """
+        return self.sim.analyzers.partner_ledger
+
     def identify_contacts(self, uids):
         # Return UIDs of people that have been identified as contacts and should be notified
 
         # Find contacts
-        for nwtype, nw in self.nws.items():
-            m_edge_inds = np.isin(nw.p1, uids).nonzero()[-1]
-            f_edge_inds = np.isin(nw.p2, uids).nonzero()[-1]
-            m_idx = nw.p1[m_edge_inds]
-            f_partners = nw.p2[m_edge_inds]
-            f_idx = nw.p2[f_edge_inds]
-            m_partners = nw.p1[f_edge_inds]
+        for nwtype in self.nws.keys():
+            index, partners, edge_inds = self.ledger.neighbors(uids, nwtype)
+            is_f = self.ledger.edges[nwtype].p2[edge_inds] == partners  # p1 is male and p2 female
+            f_partners = partners[is_f].unique()
+            m_partners = partners[~is_f].unique()
 
             # Females notified and attending
             notified_f = self.pars.p_notify[nwtype].filter(f_partners)
             attending_f = self.pars.p_attends[nwtype].filter(notified_f)
-            fp_edge_inds = np.isin(nw.p2, attending_f).nonzero()[-1]
-            successful_m_idx = nw.p1[fp_edge_inds] & m_idx
-            mf_pairs = list(zip(successful_m_idx, attending_f))
 
             # Males notified and attending
             notified_m = self.pars.p_notify[nwtype].filter(m_partners)
             attending_m = self.pars.p_attends[nwtype].filter(notified_m)
-            mp_edge_inds = np.isin(nw.p1, attending_m).nonzero()[-1]
-            successful_f_idx = nw.p2[mp_edge_inds] & f_idx
-            fm_pairs = list(zip(successful_f_idx, attending_m))
+
+            # Pairs of index cases and their partners who attend
+            mf = is_f & np.isin(partners, attending_f)
+            fm = ~is_f & np.isin(partners, attending_m)
+            mf_pairs = list(zip(index[mf], partners[mf]))
+            fm_pairs = list(zip(index[fm], partners[fm]))
 
             # Store contacts
             self.ti_notified[attending_m | attending_f] = self.ti
@@ -163,11 +184,11 @@ class PartnerNotification(ss.Intervention):
         return
 
 
-def make_hiv_intvs(pn_pars=None):
+def make_hiv_intvs(pn_pars=None, test_scale=1, art_scale=1):
 
-    n_art = pd.read_csv(f'data/n_art.csv').set_index('year')
+    n_art = pd.read_csv(f'data/n_art.csv').set_index('year')*art_scale
     # n_vmmc = pd.read_csv(f'data/n_vmmc.csv').set_index('year')
-    fsw_testing, other_testing, low_cd4_testing, partner_testing = get_testing_products()
+    fsw_testing, other_testing, low_cd4_testing, partner_testing = get_testing_products(test_scale=test_scale)
     art = sti.ART(coverage_data=n_art, future_coverage={'year': 2024, 'prop': 0.97})
     # vmmc = sti.VMMC(coverage_data=n_vmmc)
     prep = sti.Prep(
@@ -182,14 +203,7 @@ def make_hiv_intvs(pn_pars=None):
     ]
 
     if pn_pars is not None:
-        # Optionally add partner notification
-        # Partner treatment eligibility
-        def just_diagnosed(sim):
-            """ Return UIDs of people who have just been diagnosed - could add recency test here too  """
-            new_diagnoses = (sim.diseases.hiv.ti_diagnosed == sim.diseases.hiv.ti).uids
-            # previous_index = ... # Exclude people who were the original index case
-            return new_diagnoses
-
+        # Optionally add partner notification, for people who were just diagnosed
         pn = PartnerNotification(
             **pn_pars,
             eligibility=just_diagnosed,
@@ -0,0 +1,149 @@
+"""
+Partnership ledger: a per-agent view of the sexual networks for interventions
+
+PartnerLedger is an analyzer that keeps a struct-of-arrays copy of the
+partnerships in the current (structuredsexual) and previous (priorpartners)
+networks: both partners, the partnership type and the timestep it started.
+Start times are tracked by comparing each timestep's edges against the last
+ones by their (p1, p2) key, since the networks don't record them. On top of
+this it builds, lazily and at most once per timestep, a compressed sparse row
+(CSR) index of each agent's partnerships, so interventions can look up the
+partners of a set of agents in time proportional to their number of
+partnerships, rather than scanning every edge.
+
+The copy, the sorted keys and the CSR index are rebuilt from the networks each
+timestep rather than patched in place. The networks themselves rebuild their
+edge arrays every timestep (dissolved partnerships are masked out and new ones
+concatenated), and finding which partnerships are new or dissolved needs the
+same sort or search of the keys, so patching wouldn't change the cost, which
+is O(E log E) in the number of partnerships E.
+
+This costs more per timestep than the pairing code it replaced, which scanned
+every edge with np.isin() for each lookup (O(E) per lookup, four lookups per
+network) and only ran once partner notification had started. Measured at the
+end of a 10,000-agent run to 2027, with about 7,000 current partnerships:
+    - ledger update and both CSR builds: 2.7 ms, every timestep from the start
+      of the sim, since start times have to be tracked from the beginning;
+    - ledger lookups for the index cases: 0.2 ms, once notification has started;
+    - old pairing code: 0.4 ms for the 5 index cases of a typical month, and
+      0.6 ms for 100, once notification has started.
+So the ledger adds about 2.5 ms, or 4% of a 63 ms timestep. What it buys is the
+type and start of each partnership, and lookups whose cost doesn't grow with
+the size of the network.
+
+In the sexual networks, p1 is always the male partner and p2 the female one.
+"""
+
+# %% Imports and settings
+import numpy as np
+import sciris as sc
+import starsim as ss
+
+default_networks = dict(current='structuredsexual', previous='priorpartners')
+key_base = np.int64(2**32)  # Larger than any UID, so (p1, p2) pairs can be packed into one int64 key
+
+
+class PartnerLedger(ss.Analyzer):
+    """
+    Partnerships of each agent, for interventions to query
+
+    Args:
+        networks (dict): networks to track, by the name used to query them (default: 'current' and 'previous')
+
+    **Example**::
+
+        ledger = sim.analyzers.partner_ledger
+        index, partners, edges = ledger.neighbors(uids, 'current')  # One entry per partnership
+        types = ledger.edges.current.edge_type[edges]  # E.g. 0 for stable; see sim.networks.structuredsexual.edge_types
+        started = ledger.edges.current.ti_start[edges]
+    """
+    def __init__(self, networks=None, name='partner_ledger', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.networks = sc.mergedicts(default_networks, networks)
+        self.edges = sc.objdict()  # Struct of arrays for each network: p1, p2, edge_type, ti_start
+        self._keys = sc.objdict()  # Sorted edge keys, and the index of each in edges
+        self._csr = sc.objdict()  # Offsets, partners and edge indices by agent
+        self._ti = None  # Timestep the edges were last updated
+        return
+
+    def init_post(self):
+        super().init_post()
+        for name in self.networks.keys():
+            self.edges[name] = sc.objdict(p1=ss.uids(), p2=ss.uids(), edge_type=np.zeros(0, dtype=np.int8), ti_start=np.zeros(0))
+            self._keys[name] = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        return
+
+    def update(self):
+        """ Copy the edges of each network if they haven't been copied this timestep, carrying over the start of continuing partnerships """
+        if self._ti == self.ti:
+            return
+        for name, nwname in self.networks.items():
+            nw = self.sim.networks[nwname]
+            p1, p2 = np.asarray(nw.p1, dtype=np.int64), np.asarray(nw.p2, dtype=np.int64)  # Plain arrays, since + joins uids
+            keys = p1*key_base + p2
+            prev_keys, prev_inds = self._keys[name]
+
+            # Partnerships present last time keep their start; new ones start now. Partnerships
+            # present when the ledger starts have an unknown start (NaN), unless that's the first timestep.
+            pos = np.clip(np.searchsorted(prev_keys, keys), 0, max(len(prev_keys) - 1, 0))
+            found = (prev_keys[pos] == keys) if len(prev_keys) else np.zeros(len(keys), dtype=bool)
+            ti_start = np.full(len(keys), float(self.ti) if (self._ti is not None or self.ti == 0) else np.nan)
+            ti_start[found] = self.edges[name].ti_start[prev_inds[pos[found]]]
+
+            edge_type = nw.edges.edge_type.astype(np.int8) if 'edge_type' in nw.edges else np.full(len(keys), -1, dtype=np.int8)
+            self.edges[name] = sc.objdict(p1=ss.uids(p1), p2=ss.uids(p2), edge_type=edge_type, ti_start=ti_start)
+            order = np.argsort(keys, kind='stable')
+            self._keys[name] = (keys[order], order)
+            self._csr.pop(name, None)  # Rebuilt when next queried
+        self._ti = self.ti
+        return
+
+    def csr(self, network='current'):
+        """ Index of each agent's partnerships: agent i's are at offsets[i]:offsets[i+1] of partners and edge_inds """
+        self.update()
+        if network not in self._csr:
+            edges = self.edges[network]
+            n_edges = len(edges.p1)
+            src = np.concatenate([edges.p1, edges.p2])
+            order = np.argsort(src, kind='stable')
+            n_agents = len(self.sim.people.uid.raw)
+            offsets = np.zeros(n_agents + 1, dtype=np.int64)
+            np.cumsum(np.bincount(src, minlength=n_agents), out=offsets[1:])
+            self._csr[network] = sc.objdict(
+                offsets=offsets,
+                partners=np.concatenate([edges.p2, edges.p1])[order],
+                edge_inds=np.tile(np.arange(n_edges), 2)[order],
+            )
+        return self._csr[network]
+
+    def degree(self, uids=None, network='current'):
+        """ Number of partnerships of each agent (or of the given agents) """
+        offsets = self.csr(network).offsets
+        degree = np.diff(offsets)
+        return degree if uids is None else degree[uids]
+
+    def neighbors(self, uids, network='current'):
+        """
+        Partnerships of a set of agents, one entry per partnership
+
+        Returns:
+            index (uids): the agent from uids in each partnership
+            partners (uids): their partner
+            edge_inds (array): index of the partnership in ledger.edges[network]
+        """
+        csr = self.csr(network)
+        uids = np.asarray(uids, dtype=np.int64)
+        starts = csr.offsets[uids]
+        lens = csr.offsets[uids + 1] - starts
+        if lens.sum() == 0:
+            return ss.uids(), ss.uids(), np.zeros(0, dtype=np.int64)
+        inds = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())  # Concatenated ranges
+        return ss.uids(np.repeat(uids, lens)), ss.uids(csr.partners[inds]), csr.edge_inds[inds]
+
+    def partners(self, uids, network='current'):
+        """ Unique partners of a set of agents """
+        return self.neighbors(uids, network)[1].unique()
+
+    def step(self):
+        self.update()  # Keep track of when partnerships start, even if no intervention queries them this timestep
+        return
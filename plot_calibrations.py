@@ -17,8 +17,11 @@ from utils import percentile_pairs
 # %% Run as a script
 if __name__ == '__main__':
 
+    # SETTINGS
+    use_ppc = False  # Plot the posterior predictive bands from posterior.py rather than the best calibration trials
+
     # Load files - these should all be committed to the repository
-    df_filename = f'results/zam_hiv_calib_stats.df'
+    df_filename = ['results/zam_hiv_calib_stats.df', 'results/zam_hiv_ppc_stats.df'][use_ppc]
     par_filename = f'results/zam_hiv_par_stats.df'
     df_stats = sc.loadobj(df_filename)
     par_stats = sc.loadobj(par_filename)
@@ -7,7 +7,7 @@ If updates are needed:
     3. Run run_plot_data.py to generate the epi result files:
             epi_df = 'results/epi_df.df'
             sw_df = 'results/sw_df.df'
-    4. Run this script to generate the figure
+    4. Run this script to generate the figure, or run figures.py to rebuild only the figures whose inputs changed
 
 """
 
@@ -54,19 +54,28 @@ def plot_infections_by_sw(df, disease='hiv', ax=None, start_year=2010, end_year=
     ax.set_xlabel('')
     ax.set_ylabel('')
 
-    total_trans_hiv = sw_df[f'new_transmissions_fsw_hiv'][si:ei].mean()+sw_df[f'new_transmissions_client_hiv'][10:30].mean()+sw_df[f'new_transmissions_non_fsw_hiv'][10:30].mean()+sw_df[f'new_transmissions_non_client_hiv'][10:30].mean()
-    print(f'HIV SW share: {(sw_df[f"new_transmissions_fsw_hiv"][si:ei].mean()+sw_df[f"new_transmissions_client_hiv"][10:30].mean())/total_trans_hiv}')
+    trans = {group: df[f'new_transmissions_{group}_{disease}'][si:ei].mean() for group in groups}
+    print(f'{disease.upper()} SW share: {(trans["fsw"] + trans["client"])/sum(trans.values())}')
 
     # ax.set_ylim(bottom=0)
     return ax
 
 
-# %% Run as a script
-if __name__ == '__main__':
+def get_dx_summary(sim):
+    """ Extract the per-agent values used by the histograms from a sim, so the sim itself doesn't need to be kept """
+    hiv = sim.people.hiv
+    dx_uids = hiv.diagnosed.uids
+    inf_uids = hiv.infected.uids
+    summary = dict(
+        dx_times=np.asarray(hiv.ti_diagnosed[dx_uids] - hiv.ti_exposed[dx_uids]),
+        cd4_dx=np.asarray(hiv.cd4_preart[dx_uids]),
+        cd4_plhiv=np.asarray(hiv.cd4[inf_uids]),
+    )
+    return summary
 
-    show = False
-    epi_df = sc.loadobj(f'results/epi_df.df')
-    sw_df = sc.loadobj(f'results/sw_df.df')
+
+def plot_epi(sw_df, epi_df, dx):
+    """ Plot infections by sex work, prevalence and infections by age, and diagnosis histograms """
 
     # Initialize plot
     set_font(size=20)
@@ -98,34 +107,39 @@ if __name__ == '__main__':
     ax.set_ylim(bottom=0)
 
     # Plot a histogram of the time from exposure to diagnosis
-    sim = sc.loadobj('results/zambia.sim')
-    dx_uids = sim.people.hiv.diagnosed.uids
-    dx_times = sim.people.hiv.ti_diagnosed[dx_uids] - sim.people.hiv.ti_exposed[dx_uids]
     ax = axes[3]
-    ax.hist(dx_times/12, bins=30, color=color, edgecolor='k', alpha=0.7)
+    ax.hist(dx['dx_times']/12, bins=30, color=color, edgecolor='k', alpha=0.7)
     ax.set_title('Time from HIV exposure to diagnosis')
     ax.set_xlabel('Years')
     ax.set_ylabel('')
     ax.set_xlim(left=0)
 
     # Histogram of CD4 count at diagnosis
-    cd4_counts = sim.people.hiv.cd4_preart[dx_uids]
     ax = axes[4]
-    ax.hist(cd4_counts, bins=30, color=color, edgecolor='k', alpha=0.7)
+    ax.hist(dx['cd4_dx'], bins=30, color=color, edgecolor='k', alpha=0.7)
     ax.set_title('CD4 count at HIV diagnosis')
     ax.set_xlabel('CD4 count (cells/µL)')
     ax.set_ylabel('')
 
     # Histogram of current CD4 counts across infected people
-    inf_uids = sim.people.hiv.infected.uids
-    cd4_counts = sim.people.hiv.cd4[inf_uids]
     ax = axes[5]
-    ax.hist(cd4_counts, bins=30, color=color, edgecolor='k', alpha=0.7)
+    ax.hist(dx['cd4_plhiv'], bins=30, color=color, edgecolor='k', alpha=0.7)
     ax.set_title('CD4 counts among PLHIV')
     ax.set_xlabel('CD4 count (cells/µL)')
     ax.set_ylabel('')
 
     sc.figlayout()
     sc.savefig("figures/hiv_epi.png", dpi=100)
+    return fig
+
+
+# %% Run as a script
+if __name__ == '__main__':
+
+    show = False
+    epi_df = sc.loadobj(f'results/epi_df.df')
+    sw_df = sc.loadobj(f'results/sw_df.df')
+    dx = get_dx_summary(sc.loadobj('results/zambia.sim'))
+    plot_epi(sw_df, epi_df, dx)
 
     print('Done.')
@@ -12,10 +12,28 @@ from matplotlib.gridspec import GridSpec
 from utils import set_font
 
 
-# %% Run as a script
-if __name__ == '__main__':
+def get_network_summary(sim):
+    """ Extract the analyzer arrays used by the network figure from a sim, so the sim itself doesn't need to be kept """
+    relationship_type = 'lifetime_partners'
+    debut = sim.analyzers.debutage
+    degree = sim.analyzers.networkdegree
+    agediff = sim.analyzers.partner_age_diff
+    summary = dict(
+        debut_bins=np.asarray(debut.bins),
+        prop_active_f=np.asarray(debut.prop_active_f),
+        prop_active_m=np.asarray(debut.prop_active_m),
+        relationship_type=relationship_type,
+        degree_bins=np.asarray(degree.bins),
+        degree_counts={sex: np.asarray(degree.results[f'{relationship_type}_{sex}'].values) for sex in ['f', 'm']},
+        partner_counts={sex: np.array(getattr(degree, f'{relationship_type}_{sex}')) for sex in ['f', 'm']},
+        age_diffs={k: np.asarray(v) for k, v in agediff.age_diffs.items()},
+        age_diff_year=agediff.year,
+    )
+    return summary
 
-    sim = sc.loadobj('results/zambia.sim')
+
+def plot_network(nw):
+    """ Plot debut ages, partner count distributions and partner age differences """
 
     # Initialize plot
     set_font(size=25)
@@ -27,47 +45,45 @@ if __name__ == '__main__':
     gs3 = pl.GridSpec(1, 1, left=0.65, right=0.99, bottom=0.1, top=0.91)
 
     # Debut age
-    a = sim.analyzers.debutage
     data = dict(
         f=dict(bins = [15, 18, 20, 22, 25], props = [0.057, 0.401, 0.66, 0.819, 0.929]),
         m=dict(bins = [15, 18, 20, 22, 25], props = [0.044, 0.244, 0.441, 0.639, 0.816])
     )
     # Females
     ax = fig.add_subplot(gs1[0])
-    for row in a.prop_active_f:
-        ax.plot(a.bins, row, color=scolors[0], alpha=0.5)
+    for row in nw['prop_active_f']:
+        ax.plot(nw['debut_bins'], row, color=scolors[0], alpha=0.5)
     ax.scatter(data['f']['bins'], data['f']['props'], color='k')
     ax.set_xlabel('Age')
     ax.set_ylabel('Share')
     ax.set_title('Proportion of females\nwho are sexually active')
 
     ax = fig.add_subplot(gs1[1])
-    for row in a.prop_active_m:
-        ax.plot(a.bins, row, color=scolors[1], alpha=0.5)
+    for row in nw['prop_active_m']:
+        ax.plot(nw['debut_bins'], row, color=scolors[1], alpha=0.5)
     ax.scatter(data['m']['bins'], data['m']['props'], color='k')
     ax.set_xlabel('Age')
     ax.set_ylabel('Share')
     ax.set_title('Proportion of males\nwho are sexually active')
 
     # Network degree
-    a = sim.analyzers.networkdegree
-    relationship_type = 'lifetime_partners'
+    relationship_type = nw['relationship_type']
     for ai, sex in enumerate(['f', 'm']):
         ax = fig.add_subplot(gs2[ai])
-        counts = a.results[f'{relationship_type}_{sex}'].values
-        bins = a.bins
+        counts = nw['degree_counts'][sex].copy()
+        bins = nw['degree_bins']
 
         total = sum(counts)
         counts = counts / total
         counts[-2] = counts[-2:].sum()
-        counts = counts[:-1] 
+        counts = counts[:-1]
 
         ax.bar(bins[:-1], counts, color=scolors[ai])
         ax.set_xlabel(f'Number of {relationship_type}')
         ax.set_title(f'Distribution of partners, {sex}')
         ax.set_ylim([0, 1])
 
-        sex_counts = np.array(getattr(a, f'{relationship_type}_{sex}'))
+        sex_counts = nw['partner_counts'][sex]
         stats = f"Mean: {np.mean(sex_counts):.1f}\n"
         stats += f"Median: {np.median(sex_counts):.1f}\n"
         stats += f"Std: {np.std(sex_counts):.1f}\n"
@@ -76,15 +92,23 @@ if __name__ == '__main__':
 
     # Plot age differences
     ax = fig.add_subplot(gs3[0])
-    a = sim.analyzers.partner_age_diff
-    ax.hist(list(a.age_diffs.values()), label=list(a.age_diffs.keys()), bins=30, edgecolor='black', alpha=0.7)
+    age_diffs = nw['age_diffs']
+    ax.hist(list(age_diffs.values()), label=list(age_diffs.keys()), bins=30, edgecolor='black', alpha=0.7)
     ax.legend()
     ax.set_xlabel('Age Difference (years)')
     ax.set_ylabel('Frequency')
-    ax.set_title(f'Age Differences Between Partners\n in {a.year} (Male Age - Female Age)')
+    ax.set_title(f'Age Differences Between Partners\n in {nw["age_diff_year"]} (Male Age - Female Age)')
 
     # Save
     fig.tight_layout()
     pl.savefig(f"figures/figS_network.png", dpi=100)
+    return fig
+
+
+# %% Run as a script
+if __name__ == '__main__':
+
+    sim = sc.loadobj('results/zambia.sim')
+    plot_network(get_network_summary(sim))
 
     print('Done.')
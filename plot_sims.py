@@ -1,4 +1,5 @@
 # %% Imports and settings
+import functools
 import sciris as sc
 import pylab as pl
 import numpy as np
@@ -8,6 +9,12 @@ from utils import set_font, get_y
 location = 'zambia'
 
 
+@functools.lru_cache
+def load_hiv_data(location=location):
+    """ Load the HIV data for a location; cached, since every figure uses the same file """
+    return pd.read_csv(f'data/{location}_hiv_data.csv')
+
+
 def plot_hiv_sims(df, start_year=2000, end_year=2025, which='single', percentile_pairs=[[.1, .99]], title='hiv_plots'):
     """ Create quantile or individual plots of HIV epi dynamics """
     set_font(size=20)
@@ -15,7 +22,7 @@ def plot_hiv_sims(df, start_year=2000, end_year=2025, which='single', percentile
     axes = axes.ravel()
     alphas = np.linspace(0.2, 0.5, len(percentile_pairs))
 
-    hiv_data = pd.read_csv(f'data/{location}_hiv_data.csv')
+    hiv_data = load_hiv_data()
     hiv_data = hiv_data.loc[(hiv_data.year >= start_year) & (hiv_data.year <= end_year)]
     dfplot = df.loc[(df.index >= start_year) & (df.index <= end_year)]
 
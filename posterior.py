@@ -0,0 +1,321 @@
+"""
+Streaming posterior predictive sampling from the stored calibration
+
+Rather than running the best n_pars rows of calib.df once each, this samples
+(parameter row, seed) pairs: rows are drawn with importance weights derived
+from their mismatch, and each draw gets its own seed, so the bands include
+both parameter and stochastic uncertainty. Each finished run is reduced to its
+yearly results (with reducers.CalibReducer) and streamed into running
+estimators of the mean, standard deviation, extremes and quantiles (the P²
+algorithm), so the full set of runs is never kept. Sampling stops once the
+bands plotted by plot_calibrations.py stop changing.
+
+The output has the same layout as results/zam_hiv_calib_stats.df, so it can be
+plotted in the same way.
+"""
+
+# %% Imports and settings
+import numpy as np
+import pandas as pd
+import sciris as sc
+import multiprocess as mp
+from utils import percentiles, percentile_pairs
+
+resnames = ['n_alive', 'hiv_n_infected', 'hiv_prevalence_15_49', 'hiv_new_infections', 'hiv_new_deaths', 'hiv_n_diagnosed', 'hiv_n_on_art']
+
+
+def get_weights(mismatch, ess=50, temperature=None):
+    """
+    Importance weights of calibration rows, proportional to exp(-(mismatch - min mismatch)/temperature)
+
+    Args:
+        mismatch (array): mismatch of each row
+        ess (float): if no temperature is given, choose it so the weights have this effective sample size
+        temperature (float): scale of the mismatch differences between rows
+
+    Returns:
+        weights (array): weights summing to 1
+    """
+    mismatch = np.asarray(mismatch, dtype=float)
+    delta = mismatch - mismatch.min()
+
+    def get(temp):
+        w = np.exp(-delta/temp)
+        return w/w.sum()
+
+    if temperature is None:
+        ess = min(ess, len(mismatch))
+        lo, hi = 1e-9, max(delta.max(), 1e-9)*1e3
+        for _ in range(100):  # Bisect on a log scale: the ESS increases with the temperature
+            temperature = np.sqrt(lo*hi)
+            w = get(temperature)
+            if 1/np.sum(w**2) < ess:
+                lo = temperature
+            else:
+                hi = temperature
+    return get(temperature)
+
+
+def sample_draws(weights, n, seed=0):
+    """ Sample n (row, seed) pairs: rows by weight, each with its own seed """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(weights), size=n, p=weights)
+    seeds = rng.choice(1_000_000, size=n, replace=False)
+    return pd.DataFrame(dict(par_idx=rows, seed=seeds))
+
+
+class P2Quantile:
+    """
+    Running estimate of a quantile with the P² algorithm (Jain & Chlamtac, 1985), for every element of an array
+
+    Keeps five markers per element rather than the observations, so it uses constant memory
+    however many observations are added. Until five have been added, the quantile is exact.
+
+    Args:
+        p (float): the quantile, between 0 and 1
+    """
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self.first = []  # The first five observations
+        self.q = None  # Marker heights
+        self.n = None  # Marker positions
+        self.desired = np.array([0, 2*p, 4*p, 2 + 2*p, 4])  # Desired marker positions
+        self.dn = np.array([0, p/2, p, (1 + p)/2, 1])  # Increments of the desired positions
+        return
+
+    def add(self, x):
+        x = np.asarray(x, dtype=float)
+        self.count += 1
+        if self.count <= 5:
+            self.first.append(x)
+            if self.count == 5:
+                self.q = np.sort(np.stack(self.first), axis=0)
+                self.n = np.broadcast_to(np.arange(5.0).reshape((5,) + (1,)*x.ndim), self.q.shape).copy()
+            return
+
+        # Find the cell containing each observation, and move the markers above it
+        q, n = self.q, self.n
+        q[0] = np.minimum(q[0], x)
+        q[4] = np.maximum(q[4], x)
+        k = (x >= q[1:4]).sum(axis=0)  # 0 to 3
+        for i in range(1, 5):
+            n[i] += i > k
+        self.desired = self.desired + self.dn
+
+        # Adjust the middle markers if they're too far from their desired positions
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            move = ((d >= 1) & (n[i+1] - n[i] > 1)) | ((d <= -1) & (n[i-1] - n[i] < -1))
+            if not move.any():
+                continue
+            d = np.where(move, np.sign(d), 0)
+            with np.errstate(divide='ignore', invalid='ignore'):  # Only where the marker doesn't move
+                parabolic = q[i] + d/(n[i+1] - n[i-1])*(
+                    (n[i] - n[i-1] + d)*(q[i+1] - q[i])/(n[i+1] - n[i]) +
+                    (n[i+1] - n[i] - d)*(q[i] - q[i-1])/(n[i] - n[i-1]))
+                j = (i + d).astype(int)
+                linear = q[i] + d*(np.take_along_axis(q, j[None], 0)[0] - q[i])/(np.take_along_axis(n, j[None], 0)[0] - n[i])
+            new = np.where((q[i-1] < parabolic) & (parabolic < q[i+1]), parabolic, linear)
+            q[i] = np.where(move, new, q[i])
+            n[i] = np.where(move, n[i] + d, n[i])
+        return
+
+    @property
+    def value(self):
+        if self.count < 5:
+            return np.quantile(np.stack(self.first), self.p, axis=0)
+        return self.q[2].copy()
+
+
+class RunningStats:
+    """
+    Running summary statistics of arrays added one at a time: the same statistics as DataFrame.describe()
+
+    Args:
+        percentiles (list): quantiles to estimate, between 0 and 1; the median is always included, as in describe()
+    """
+    def __init__(self, percentiles=percentiles):
+        self.percentiles = sorted(set(percentiles) | {0.5})
+        self.quantiles = [P2Quantile(p) for p in self.percentiles]
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        return
+
+    def add(self, x):
+        x = np.asarray(x, dtype=float)
+        self.count += 1
+        if self.count == 1:
+            self.mean = x.copy()
+            self.m2 = np.zeros_like(x)
+            self.min = x.copy()
+            self.max = x.copy()
+        else:
+            delta = x - self.mean  # Welford's algorithm
+            self.mean += delta/self.count
+            self.m2 += delta*(x - self.mean)
+            self.min = np.minimum(self.min, x)
+            self.max = np.maximum(self.max, x)
+        for quantile in self.quantiles:
+            quantile.add(x)
+        return
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2/(self.count - 1)) if self.count > 1 else np.full_like(self.mean, np.nan)
+
+    def get(self, label):
+        """ Current value of a statistic, labeled as in DataFrame.describe() """
+        if label.endswith('%'):
+            return self.quantiles[[f'{p:.0%}' for p in self.percentiles].index(label)].value
+        elif label == 'count':
+            return np.full_like(self.mean, self.count)
+        return getattr(self, label)
+
+    def labels(self):
+        return ['count', 'mean', 'std', 'min'] + [f'{p:.0%}' for p in self.percentiles] + ['max']
+
+    def to_df(self, index, columns):
+        """ Statistics of 2D arrays with the given index and columns, in the layout of df.groupby(index).describe() """
+        labels = self.labels()
+        data = np.stack([self.get(label) for label in labels], axis=-1)  # index x columns x statistics
+        cols = pd.MultiIndex.from_product([columns, labels])
+        return pd.DataFrame(data.reshape(len(index), -1), index=index, columns=cols)
+
+
+def run_draw(par_idx, seed, stop=2030, resnames=resnames):
+    """ Run one posterior draw and reduce it to the yearly results """
+    from hiv_model import make_sim
+    from reducers import CalibReducer
+    start = 1985
+    years = np.arange(start, stop + 1)
+    sim = make_sim(use_calib=True, par_idx=int(par_idx), seed=int(seed), start=start, stop=stop, verbose=-1)  # Every draw has its own seed, so a template would never be reused
+    sim.add_module(CalibReducer(extra_results=resnames, years=years))
+    sim.run()
+    df = sim.analyzers.calib_reducer.df.set_index('time')
+    return df[resnames]
+
+
+def _run_draw(draw):
+    """ Run a draw in a worker """
+    i, kwargs = draw
+    return i, run_draw(**kwargs)
+
+
+def band_change(prev, curr, window=(1985, 2025), pairs=percentile_pairs):
+    """ Largest change in the plotted bands (and medians) between two sets of stats, relative to the size of each result """
+    years = curr.index[(curr.index >= window[0]) & (curr.index <= window[1])]
+    labels = ['50%'] + [f'{p:.0%}' for pair in pairs for p in pair]
+    change = 0
+    for res in curr.columns.get_level_values(0).unique():
+        scale = np.abs(curr.loc[years, (res, '50%')]).max()
+        if scale > 0:
+            diff = np.abs(curr.loc[years, [(res, l) for l in labels]].values - prev.loc[years, [(res, l) for l in labels]].values)
+            change = max(change, diff.max()/scale)
+    return change
+
+
+def run_posterior(calib_file='results/zam_hiv_calib.obj', ess=50, temperature=None, min_runs=20, max_runs=500, check_every=10,
+                  tol=0.02, patience=2, n_workers=None, seed=0, stop=2030, verbose=True):
+    """
+    Sample posterior predictive runs until the plotted bands converge
+
+    All draws are queued on the pool at once and results are accumulated as they arrive. Every check_every
+    completed runs (after at least min_runs), the current bands are compared against those at the previous check; sampling stops when the largest change, relative to the size of each result, has been
+    below tol for patience checks in a row, or after max_runs.
+
+    Args:
+        calib_file (str): the stored (shrunk) calibration, whose df is sorted by mismatch
+        ess (float): effective sample size of the importance weights over calibration rows (see get_weights())
+        temperature (float): if given, use this temperature for the weights instead of choosing it from ess
+        min_runs (int): minimum number of runs before checking for convergence
+        max_runs (int): maximum number of runs
+        check_every (int): number of completed runs between convergence checks; the workers keep running in between
+        tol (float): convergence tolerance on the change in the bands
+        patience (int): number of consecutive checks that must be within tol
+        n_workers (int): number of workers; if None, as many as fit in memory (see runners.pick_n_workers())
+        seed (int): random seed for sampling the draws
+        stop (float): year to stop each run
+
+    Returns:
+        stats (DataFrame): statistics of each result by year, in the layout of results/zam_hiv_calib_stats.df
+        draws (DataFrame): the (row, seed) pairs that were run, with the row's calibration index and weight
+        history (DataFrame): band change at each check
+    """
+    calib = sc.loadobj(calib_file)
+    weights = get_weights(calib.df.mismatch.values, ess=ess, temperature=temperature)
+    draws = sample_draws(weights, max_runs, seed=seed)
+    draws['index'] = calib.df['index'].values[draws.par_idx]
+    draws['weight'] = weights[draws.par_idx]
+    if verbose:
+        print(f'Sampling from {len(weights)} calibration rows with an effective sample size of {1/np.sum(weights**2):.0f}')
+
+    if n_workers is None:
+        from runners import probe_memory, pick_n_workers
+        n_workers = pick_n_workers(probe_memory(dict(use_calib=True, stop=stop)))
+
+    stats = RunningStats()
+    history = []
+    prev = None
+    n_within = 0
+    done = []
+    tasks = [(i, dict(par_idx=row.par_idx, seed=row.seed, stop=stop)) for i, row in enumerate(draws.itertuples())]
+    pool = mp.Pool(n_workers) if n_workers > 1 else None
+    try:
+        outputs = pool.imap_unordered(_run_draw, tasks) if pool else map(_run_draw, tasks) # All tasks are queued so the workers never wait on a check
+        for i, df in outputs:
+            stats.add(df.values)
+            index, columns = df.index, df.columns
+            done.append(i)
+
+            n_done = len(done)
+            if n_done < min_runs or n_done % check_every:
+                continue
+            curr = stats.to_df(index, columns)
+            if prev is not None:
+                change = band_change(prev, curr)
+                n_within = n_within + 1 if change < tol else 0
+                history.append(dict(n_runs=n_done, change=change))
+                if verbose:
+                    print(f'  {n_done} runs: bands changed by {change:.2%}')
+                if n_within >= patience:
+                    break # Runs still in progress are discarded when the pool is terminated
+            prev = curr
+    finally:
+        if pool:
+            pool.terminate()
+
+    n_done = len(done)
+    stats = stats.to_df(index, columns)
+    stats.index.name = 'time'
+    draws = draws.iloc[sorted(done)]
+    history = pd.DataFrame(history)
+    converged = n_within >= patience
+    if verbose:
+        print(f'{"Converged" if converged else "Did not converge"} after {n_done} runs')
+    stats.attrs = dict(n_runs=n_done, converged=converged)
+    return stats, draws, history
+
+
+if __name__ == '__main__':
+
+    # SETTINGS
+    debug = False
+    max_runs = [500, 4][debug]
+    min_runs = [20, 2][debug]
+    check_every = [10, 2][debug]
+    n_workers = [None, 1][debug]
+    tol = 0.02  # Stop when no band changes by more than 2% of the size of its result...
+    patience = 2  # ...for this many checks in a row
+
+    T = sc.timer()
+    stats, draws, history = run_posterior(max_runs=max_runs, min_runs=min_runs, check_every=check_every, n_workers=n_workers, tol=tol, patience=patience)
+    T.toc()
+
+    sc.saveobj('results/zam_hiv_ppc_stats.df', stats)
+    sc.saveobj('results/zam_hiv_ppc_draws.df', draws)
+
+    print('Done!')
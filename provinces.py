@@ -0,0 +1,365 @@
+"""
+Sub-national (province) metapopulation model
+
+Each province is its own sim, with its own share of the population, its own
+demographic data (optionally) and its own testing, ART and initial prevalence
+inputs. Provinces are grouped onto worker processes and advanced together in
+lockstep, exchanging infection pressure at a low frequency (once a year by
+default). A share (mixing) of each province's partnerships are with people
+from other provinces: transmission within the province is reduced by that
+share, and its susceptible, sexually active agents are infected from outside
+(ImportedInfections) at a rate proportional to mixing times the
+population-weighted prevalence of the other provinces. The rate per unit of
+prevalence is the within-province transmission rate over the last interval,
+pooled across provinces (see import_rates()), so a province with no infections
+can still be seeded from its neighbours, and a province with few infections
+doesn't amplify its own. Between exchanges the provinces run independently,
+so the work parallelizes across workers with little communication. National
+results are the sums of the provinces'.
+
+Province inputs are read from a CSV file (data/zambia_provinces.csv by
+default, which isn't supplied with the repository), with a row per province and
+the columns:
+    province: name of the province
+    pop_share: share of the national population (normalized to sum to 1)
+    location: (optional) prefix of the demographic data files in data/ (default 'zambia', i.e. national rates)
+    test_scale: (optional) multiplier on the testing scale-up curves (default 1)
+    art_scale: (optional) numbers on ART relative to the province's share of the national numbers (default 1)
+    init_prev_scale: (optional) multiplier on the initial HIV prevalence (default 1)
+uniform_provinces() makes inputs for identical provinces, e.g. for testing the scaling.
+"""
+
+# %% Imports and settings
+import os
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+import multiprocess as mp
+
+provinces_file = 'data/zambia_provinces.csv'
+province_inputs = dict(location='zambia', test_scale=1, art_scale=1, init_prev_scale=1)  # Defaults for the optional columns
+count_results = ['n_alive', 'hiv_n_infected', 'hiv_new_infections', 'imports_new_infections', 'hiv_new_deaths', 'hiv_n_diagnosed', 'hiv_n_on_art', 'n_15_49']  # Summed across provinces
+
+
+def load_provinces(filename=provinces_file):
+    """ Read the province inputs, filling in the optional columns and normalizing the population shares """
+    if not os.path.exists(filename):
+        errormsg = f'Province inputs not found at {filename}; see the docstring of provinces.py for the format, or use uniform_provinces()'
+        raise FileNotFoundError(errormsg)
+    return check_provinces(pd.read_csv(filename))
+
+
+def uniform_provinces(n=10):
+    """ Inputs for n identical provinces with national rates """
+    return check_provinces(pd.DataFrame(dict(province=[f'province{i}' for i in range(n)], pop_share=1/n)))
+
+
+def check_provinces(df):
+    df = df.copy()
+    for col, default in province_inputs.items():
+        if col not in df.columns:
+            df[col] = default
+    df['pop_share'] = df.pop_share/df.pop_share.sum()
+    return df.reset_index(drop=True)
+
+
+class Pop1549(ss.Analyzer):
+    """ Number of people aged 15-49, so that prevalence among them can be aggregated across provinces """
+    def __init__(self, name='pop_15_49', **kwargs):
+        super().__init__(name=name, **kwargs)
+        return
+
+    def init_results(self):
+        super().init_results()
+        self.define_results(ss.Result('n', dtype=int, scale=True, label='Population aged 15-49'))
+        return
+
+    def step(self):
+        age = self.sim.people.age
+        self.results.n[self.ti] = np.count_nonzero((age >= 15) & (age < 50))
+        return
+
+
+class ImportedInfections(ss.Intervention):
+    """
+    HIV infections acquired from partners in other provinces
+
+    Each step, susceptible agents who have started having sex are infected with probability 1 - exp(-rate*dt),
+    where rate (per person per year) is set at each exchange by Group.run(); see import_rates().
+    """
+    def __init__(self, name='imports', **kwargs):
+        super().__init__(name=name)
+        self.define_pars(p_import=ss.bernoulli(p=0))
+        self.update_pars(**kwargs)
+        self.rate = 0.0
+        return
+
+    def init_results(self):
+        super().init_results()
+        self.define_results(ss.Result('new_infections', dtype=int, scale=True, label='Infections from other provinces'))
+        return
+
+    def step(self):
+        hiv = self.sim.diseases.hiv
+        eligible = (hiv.susceptible & self.sim.networks.structuredsexual.over_debut).uids
+        self.pars.p_import.set(p=1 - np.exp(-self.rate*self.t.dt_year))
+        uids = self.pars.p_import.filter(eligible)
+        if len(uids):
+            hiv.set_prognoses(uids)
+        self.results.new_infections[self.ti] = len(uids)
+        return
+
+
+def make_province_sim(row, n_agents=10e3, seed=1, mixing=0, **kwargs):
+    """ Make the sim for one province, from its row of the province inputs; a share (mixing) of its partnerships are with other provinces """
+    from hiv_model import make_sim
+    sim = make_sim(
+        n_agents=max(int(round(n_agents*row['pop_share'])), 100),
+        seed=seed,
+        location=row['location'],
+        pop_share=row['pop_share'],
+        test_scale=row['test_scale'],
+        art_scale=row['art_scale'],
+        init_prev_scale=row['init_prev_scale'],
+        analyzers=Pop1549(),
+        interventions=ImportedInfections(),
+        verbose=-1,
+        **kwargs,
+    )
+    if not sim.initialized:
+        sim.init()
+    sim.label = row['province']
+    sim.diseases.hiv.pars.beta_m2f *= 1 - mixing  # Only the partnerships within the province; the rest are ImportedInfections
+    sim.np_state = np.random.get_state()  # See Group.run()
+    return sim
+
+
+def get_pressure(sim):
+    """ Population, HIV prevalence, number susceptible and infections within the province so far, for the exchange """
+    hiv = sim.diseases.hiv
+    n = len(sim.people.auids)
+    scale = sim.pars.pop_scale
+    own = hiv.results.new_infections.values.sum() - sim.interventions.imports.results.new_infections.values.sum()  # Unscaled until the sim is finalized
+    return dict(pop=n*scale, prev=hiv.infected.count()/max(n, 1), susceptible=hiv.susceptible.count()*scale, own_infections=own*scale)
+
+
+def get_results(sim):
+    """ Yearly results of a finished province sim """
+    from utils import get_years
+    df = sim.to_df(resample='year', use_years=True, sep='_')
+    df['time'] = get_years(df)
+    df = df.rename(columns={'pop_15_49_n': 'n_15_49'}).set_index('time')
+    return df[count_results + ['hiv_prevalence_15_49']]
+
+
+class Group:
+    """ The province sims run by one worker """
+    def __init__(self, rows, n_agents, seeds, mixing, kwargs):
+        self.sims = [make_province_sim(row, n_agents=n_agents, seed=seed, mixing=mixing, **kwargs) for row, seed in zip(rows, seeds)]
+        return
+
+    def run(self, until, rates):
+        """ Set each province's rate of imported infections, and run it to the next exchange """
+        for sim, rate in zip(self.sims, rates):
+            sim.interventions.imports.rate = rate
+            if not sim.complete:
+                np.random.set_state(sim.np_state)  # Partnership formation also uses NumPy's global random state, so give each sim its own
+                sim.run(until=until)
+                sim.np_state = np.random.get_state()
+        return [get_pressure(sim) for sim in self.sims]
+
+    def pressure(self):
+        return [get_pressure(sim) for sim in self.sims]
+
+    def results(self):
+        return [get_results(sim) for sim in self.sims]
+
+
+def _worker(conn, args):
+    """ Hold a group of provinces in a worker process, and run commands on them from the parent """
+    group = Group(*args)
+    while True:
+        cmd, cmdargs = conn.recv()
+        if cmd == 'stop':
+            break
+        conn.send(getattr(group, cmd)(*cmdargs))
+    conn.close()
+    return
+
+
+class RemoteGroup:
+    """ A Group in a worker process, with the same methods """
+    def __init__(self, *args):
+        self.conn, child = mp.Pipe()
+        self.proc = mp.Process(target=_worker, args=(child, args), daemon=True)
+        self.proc.start()
+        return
+
+    def send(self, cmd, *args):
+        self.conn.send((cmd, args))
+        return
+
+    def recv(self):
+        return self.conn.recv()
+
+    def close(self):
+        self.send('stop')
+        self.proc.join()
+        return
+
+
+def assign_groups(shares, n_workers):
+    """ Assign provinces to workers so that each has a similar number of agents (largest first, each to the least loaded worker) """
+    loads = np.zeros(n_workers)
+    groups = [[] for _ in range(n_workers)]
+    for i in np.argsort(shares)[::-1]:
+        w = np.argmin(loads)
+        groups[w].append(i)
+        loads[w] += shares[i]
+    return [sorted(g) for g in groups if len(g)]
+
+
+def import_rates(before, after, mixing, dt):
+    """
+    Rate of infection from partners in other provinces, per susceptible person per year, for each province
+
+    Infections within the provinces between two exchanges (before and after, dt years apart) give the infection rate
+    per unit of partner prevalence, pooled across provinces so that it's defined even where there are no infections.
+    A share (mixing) of each province's partners are from the other provinces, whose prevalence is their
+    population-weighted mean; provinces' own transmission is already reduced by 1 - mixing.
+    """
+    get = lambda pressure, key: np.array([p[key] for p in pressure])
+    pop, prev = get(after, 'pop'), get(after, 'prev')
+    infected = pop*prev
+    other_prev = (infected.sum() - infected)/np.maximum(pop.sum() - pop, 1)
+    new = get(after, 'own_infections') - get(before, 'own_infections')
+    exposure = (1 - mixing)*get(before, 'prev')*get(before, 'susceptible')*dt
+    rate = new.sum()/exposure.sum() if exposure.sum() > 0 else 0
+    return mixing*rate*other_prev
+
+
+def aggregate(dfs):
+    """ National results: sums of the provinces' counts, and prevalence among 15-49 year olds weighted by their number """
+    national = sum(df[count_results] for df in dfs)
+    infected_1549 = sum(df.hiv_prevalence_15_49*df.n_15_49 for df in dfs)
+    national['hiv_prevalence_15_49'] = infected_1549/national.n_15_49
+    return national
+
+
+def run_provinces(provinces=None, n_agents=10e3, mixing=0.05, exchange_dt=1, n_workers=None, seed=1, verbose=True, **kwargs):
+    """
+    Run the province metapopulation model
+
+    Args:
+        provinces (DataFrame/str): province inputs, or the file to read them from (default: data/zambia_provinces.csv)
+        n_agents (int): total number of agents, divided between the provinces by population share
+        mixing (float): share of partnerships with people from other provinces
+        exchange_dt (float): years between exchanges of infection pressure between provinces
+        n_workers (int): number of worker processes (default: one per province, up to the number of CPUs); 1 to run in this process
+        seed (int): random seed; each province gets its own seed derived from it
+        kwargs (dict): passed to make_sim(), e.g. stop or use_calib
+
+    Returns:
+        national (DataFrame): yearly national results
+        provinces_df (DataFrame): yearly results for each province, with a 'province' column
+    """
+    provinces = load_provinces(provinces) if isinstance(provinces, str) or provinces is None else check_provinces(provinces)
+    n = len(provinces)
+    n_workers = min(sc.ifelse(n_workers, sc.cpu_count()), n)
+    rows = provinces.to_dict('records')
+    seeds = [seed*1000 + i for i in range(n)]
+
+    # Set up the groups of provinces, in worker processes or in this one
+    T = sc.timer()
+    group_inds = assign_groups(provinces.pop_share.values, n_workers)
+    args = [([rows[i] for i in inds], n_agents, [seeds[i] for i in inds], mixing, kwargs) for inds in group_inds]
+    groups = [RemoteGroup(*a) if n_workers > 1 else Group(*a) for a in args]
+
+    def call(cmd, group_args=None):
+        """ Run a command on every group (in parallel, if they're in worker processes), and collect the outputs by province """
+        group_args = sc.ifelse(group_args, [()]*len(groups))
+        if n_workers > 1:
+            for group, ga in zip(groups, group_args):
+                group.send(cmd, *ga)
+            outs = [group.recv() for group in groups]
+        else:
+            outs = [getattr(group, cmd)(*ga) for group, ga in zip(groups, group_args)]
+        out = [None]*n
+        for inds, gout in zip(group_inds, outs):
+            for i, o in zip(inds, gout):
+                out[i] = o
+        return out
+
+    try:
+        pressure = call('pressure')
+        stop = kwargs.get('stop', 2030)
+        start = kwargs.get('start', 1985)
+        exchanges = np.arange(start + exchange_dt, np.ceil(stop) + exchange_dt, exchange_dt)
+        rates = np.zeros(n)  # No imports until there's been an interval to estimate them from
+        last = start
+        for until in exchanges:
+            new_pressure = call('run', [(until, [rates[i] for i in inds]) for inds in group_inds])
+            rates = import_rates(pressure, new_pressure, mixing, until - last)
+            pressure, last = new_pressure, until
+        dfs = call('results')
+    finally:
+        if n_workers > 1:
+            for group in groups:
+                group.close()
+
+    national = aggregate(dfs)
+    provinces_df = pd.concat([df.assign(province=row['province']) for df, row in zip(dfs, rows)])
+    if verbose:
+        T.toc(f'Ran {n} provinces on {n_workers} workers with {len(exchanges)} exchanges')
+    return national, provinces_df
+
+
+def measure_scaling(provinces=None, workers=None, n_agents=100e3, stop=2000, **kwargs):
+    """
+    Run time of the province model on different numbers of workers, and the speedup and efficiency relative to one
+
+    Args:
+        provinces (DataFrame): province inputs (default: 10 identical provinces)
+        workers (list): numbers of workers to time (default: 1, 2, 4, ... up to the number of CPUs and provinces)
+        kwargs (dict): passed to run_provinces()
+    """
+    provinces = sc.ifelse(provinces, uniform_provinces(10))
+    max_workers = min(sc.cpu_count(), len(provinces))
+    workers = sc.ifelse(workers, sorted({min(2**i, max_workers) for i in range(int(np.log2(max_workers)) + 2)}))
+    times = []
+    for n_workers in workers:
+        T = sc.timer()
+        run_provinces(provinces, n_agents=n_agents, n_workers=n_workers, stop=stop, verbose=False, **kwargs)
+        times.append(T.toc(output=True))
+    df = pd.DataFrame(dict(n_workers=workers, time=times))
+    df['speedup'] = df.time.iloc[0]/df.time*df.n_workers.iloc[0]
+    df['efficiency'] = df.speedup/df.n_workers
+    return df
+
+
+if __name__ == '__main__':
+
+    # SETTINGS
+    debug = False
+    n_agents = [100e3, 10e3][debug]
+    mixing = 0.05  # Share of partnerships across provinces
+    n_workers = None  # Default: one per province, up to the number of CPUs
+    stop = 2030
+    check_scaling = False  # Also time the model on 1, 2, 4, ... workers
+
+    if os.path.exists(provinces_file):
+        provinces = load_provinces()
+    else:
+        print(f'{provinces_file} not found; using 10 identical provinces')
+        provinces = uniform_provinces(10)
+
+    national, provinces_df = run_provinces(provinces, n_agents=n_agents, mixing=mixing, n_workers=n_workers, stop=stop)
+    sc.saveobj('results/provinces.df', provinces_df)
+    sc.saveobj('results/provinces_national.df', national)
+
+    if check_scaling:
+        sc.heading('Scaling with the number of workers')
+        print(measure_scaling(provinces, n_agents=n_agents, mixing=mixing).to_string(float_format=lambda x: f'{x:.2f}'))
+
+    print('Done!')
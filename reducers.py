@@ -0,0 +1,248 @@
+"""
+Online reduction of sim results to the values needed for calibration
+
+CalibReducer is an analyzer that, as the sim runs, accumulates the yearly value
+of each calibration target (and any extra results) at the data years only,
+and the running mismatch against the data. ReducedCalibration uses it instead
+of keeping each trial's full result arrays: the yearly values are stored with
+the trial in the Optuna study (a few KB per trial), so keeping every trial is
+cheap and nothing is written to temporary files. Its trials are run with
+runners.run_ensemble(), one trial per task, so workers are replaced after a
+number of trials and each trial's run time and memory use are reported.
+
+Yearly values match sim.to_df(resample='year'): flows (new_*) are summed over
+the year and everything else is averaged. The mismatch matches stisim's
+default eval_fn: the absolute difference from the data, normalized by the
+largest data value of each target, summed over years and targets.
+"""
+
+# %% Imports and settings
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+import stisim as sti
+
+op = sc.importbyname('optuna', lazy=True)
+
+
+def get_result(sim, name):
+    """ Find a result and the module it belongs to from e.g. 'n_alive', 'hiv_n_infected' or 'hiv.n_infected' """
+    res = sim.results.get(name)
+    if isinstance(res, ss.Result):
+        return res, sim
+    for mod in sim.modules:
+        for sep in ['.', '_']:
+            prefix = mod.name + sep
+            if name.startswith(prefix) and isinstance(mod.results.get(name[len(prefix):]), ss.Result):
+                return mod.results[name[len(prefix):]], mod
+    errormsg = f'Could not find result "{name}"'
+    raise KeyError(errormsg)
+
+
+class CalibReducer(ss.Analyzer):
+    """
+    Accumulate the yearly values of calibration targets at the data years, and the running mismatch
+
+    Args:
+        data (DataFrame/str): calibration data, with a 'time' column of years and a column per target (or the path to it)
+        extra_results (list): other results to keep, without contributing to the mismatch
+        weights (dict): weight of each target in the mismatch (default 1)
+        years (list): years to keep values for (default: the data years)
+
+    After the run, reducer.df has the yearly values and reducer.mismatch the total mismatch.
+    """
+    def __init__(self, data='data/zambia_hiv_calib.csv', extra_results=None, weights=None, years=None, name='calib_reducer', **kwargs):
+        super().__init__(name=name, **kwargs)
+        data = pd.read_csv(data) if isinstance(data, str) else data
+        self.data = data.set_index('time')
+        self.targets = list(self.data.columns)
+        self.extra_results = [r for r in sc.tolist(extra_results) if r not in self.targets]
+        self.weights = sc.mergedicts({t: 1 for t in self.targets}, weights)
+        self.years = np.array(sorted(sc.ifelse(years, self.data.index.values)), dtype=float)
+        self.norm = {t: np.abs(self.data[t]).max() for t in self.targets}  # As in sti.compute_gof(normalize=True)
+        return
+
+    def init_pre(self, sim):
+        super().init_pre(sim)
+        self.resnames = self.targets + self.extra_results
+        self.values = {name: np.full(len(self.years), np.nan) for name in self.resnames}
+        self.mismatches = {t: 0.0 for t in self.targets}
+        self._cursor = {name: 0 for name in self.resnames}  # Next index of each result to accumulate
+        self._acc = {name: [None, 0.0, 0] for name in self.resnames}  # Year, total and count being accumulated
+        return
+
+    @property
+    def mismatch(self):
+        return float(sum(self.mismatches.values()))
+
+    def _close_year(self, name):
+        """ Store the value of a result for the year just completed, and update its mismatch """
+        year, total, count = self._acc[name]
+        if year is None or count == 0:
+            return
+        res, _ = get_result(self.sim, name)
+        value = total if (res.summarize_by or res.summary_method()) == 'sum' else total/count
+        yi = np.searchsorted(self.years, year)
+        if yi < len(self.years) and self.years[yi] == year:
+            self.values[name][yi] = value
+            if name in self.mismatches and year in self.data.index and np.isfinite(self.data.loc[year, name]) and self.norm[name] > 0:
+                self.mismatches[name] += self.weights[name]*abs(self.data.loc[year, name] - value)/self.norm[name]
+        return
+
+    def step(self):
+        sim = self.sim
+        for name in self.resnames:
+            res, mod = get_result(sim, name)
+            scale = sim.result_scale(mod) if res.scale else 1  # Results are only scaled at the end of the run, so scale them here
+            yearvec = mod.t.yearvec
+            for i in range(self._cursor[name], mod.ti + 1):  # Modules can have more timesteps than this analyzer
+                year = np.floor(yearvec[i] + 1e-9)
+                acc = self._acc[name]
+                if year != acc[0]:
+                    self._close_year(name)
+                    self._acc[name] = acc = [year, 0.0, 0]
+                if year in self.years:
+                    acc[1] += float(res.values[i])*(scale[i] if np.ndim(scale) else scale)
+                    acc[2] += 1
+            self._cursor[name] = mod.ti + 1
+        return
+
+    def finalize(self):
+        super().finalize()
+        for name in self.resnames:
+            self._close_year(name)
+        return
+
+    @property
+    def df(self):
+        """ Yearly values in the same layout as make_df() in stisim, with a 'time' column """
+        df = pd.DataFrame(self.values)
+        df['time'] = self.years.astype(int)
+        return df
+
+    def to_json(self):
+        """ Compact, JSON-compatible form of the yearly values, e.g. to store with an Optuna trial """
+        return dict(time=self.years.astype(int).tolist(), **{k: [None if np.isnan(v) else float(v) for v in vals] for k, vals in self.values.items()})
+
+
+def from_json(values):
+    """ Convert the output of CalibReducer.to_json() back to a DataFrame """
+    df = pd.DataFrame(values).astype(float)
+    df['time'] = df['time'].astype(int)
+    return df
+
+
+class ReducedCalibration(sti.Calibration):
+    """
+    sti.Calibration that keeps only the reduced yearly values of each trial, stored with the trial in the study
+
+    Adds a CalibReducer to the sim if it doesn't already have one. The mismatch of each trial is the
+    reducer's running mismatch, so the full results are never assembled into DataFrames. After
+    calibration, calib.sim_results has each trial's values in the same order as calib.df (best first),
+    so calib.shrink() keeps the values of the best trials.
+
+    Args:
+        extra_results (list): other results to keep, e.g. for plotting
+        years (list): years to keep values for (default: the data years)
+        max_tasks_per_worker (int): replace each worker after this many trials (None to never replace)
+        kwargs (dict): passed to sti.Calibration; save_results is ignored
+
+    After calibration, calib.report has the time and memory use of each trial (see runners.run_ensemble()).
+
+    **Example**::
+
+        calib = ReducedCalibration(calib_pars=calib_pars, build_fn=make_sim_pars, sim=sim, data=data,
+                                   extra_results=['hiv_n_diagnosed'], total_trials=1000, n_workers=8)
+        calib.calibrate()
+        calib = calib.shrink(n_results=500)
+    """
+    def __init__(self, sim, calib_pars, data=None, weights=None, extra_results=None, years=None, max_tasks_per_worker=10, **kwargs):
+        kwargs.pop('save_results', None)
+        super().__init__(sim, calib_pars, data=data, weights=weights, **kwargs)
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.report = None
+        if not any(isinstance(a, CalibReducer) for a in self.sim.analyzers.values()):
+            reducer = CalibReducer(data=data, extra_results=extra_results, weights=weights, years=years)
+            if self.sim.initialized:
+                self.sim.add_module(reducer)
+            else:
+                self.sim.pars.analyzers = sc.tolist(self.sim.pars.analyzers) + [reducer]
+        self.eval_fn = self.eval_reduced
+        self.eval_kw = dict()
+        return
+
+    @staticmethod
+    def get_reducer(sim):
+        return [a for a in sim.analyzers.values() if isinstance(a, CalibReducer)][0]
+
+    def eval_reduced(self, sim):
+        """ The mismatch accumulated while the sim ran """
+        return self.get_reducer(sim).mismatch
+
+    def save_trial(self, trial, sim):
+        """ Store the reduced values with the trial """
+        trial.set_user_attr('reduced', self.get_reducer(sim).to_json())
+        return
+
+    def run_trial(self, trial):
+        """ As sti.Calibration.run_trial(), but storing the reduced values with the trial rather than in a file """
+        pars = self._sample_from_trial(self.calib_pars, trial) if self.calib_pars is not None else None
+        if self.reseed:
+            pars['rand_seed'] = trial.suggest_int('rand_seed', 0, 1_000_000)
+        if self.prune_fn is not None and self.prune_fn(pars):
+            raise op.exceptions.TrialPruned()
+
+        sim = self.run_sim(pars)
+        if sim is not None and self.check_fn is not None and not self.check_fn(sim):
+            return np.inf
+
+        fit = self.eval_fn(sim, **self.eval_kw)
+        self.save_trial(trial, sim)
+        return fit
+
+    def run_one(self):
+        """ Run one trial of the study, catching exceptions as sti.Calibration.worker() does """
+        op.logging.set_verbosity(op.logging.DEBUG if self.verbose else op.logging.ERROR)
+        study = op.load_study(storage=self.run_args.storage, study_name=self.run_args.study_name, sampler=self.run_args.sampler)
+        try:
+            study.optimize(self.run_trial, n_trials=1)
+        except Exception as E:
+            print(f'Trial failed with error: {E}')
+        return
+
+    def run_workers(self):
+        """ Run n_trials trials for each of n_workers workers, as sti.Calibration does, but one trial per task with run_ensemble() """
+        from runners import run_ensemble
+        n_trials = self.run_args.n_trials*self.run_args.n_workers
+        _, report = run_ensemble(self.run_one, [dict()]*n_trials, n_workers=self.run_args.n_workers,
+                                 max_tasks_per_worker=self.max_tasks_per_worker, verbose=self.verbose, schedule=False)
+        self.report = report
+        return report
+
+    def parse_study(self, study):
+        """ Parse the study, collecting the reduced values of each completed trial in the same order as calib.df """
+        super().parse_study(study)
+        reduced = {trial.number: trial.user_attrs.get('reduced') for trial in study.trials}
+        self.df = self.df.loc[[reduced.get(i) is not None for i in self.df['index']]]
+        self.sim_results = [from_json(reduced[i]) for i in self.df['index']]
+        return
+
+
+if __name__ == '__main__':
+
+    # Compare the reducer against the full results of a short run
+    import pickle
+    from hiv_model import make_sim
+    from utils import get_targets
+
+    sim = make_sim(stop=2000, analyzers=CalibReducer(extra_results=['hiv_n_diagnosed']), verbose=-1)
+    sim.run()
+    reducer = sim.analyzers.calib_reducer
+    full = get_targets(sim)
+    reduced = reducer.df.set_index('time')[full.columns].loc[full.index]
+    print(f'Max relative difference from full results: {np.nanmax(np.abs(reduced - full)/np.abs(full)):.2e}')
+    print(f'Mismatch: {reducer.mismatch:.4f}')
+    print(f'Size of the stored values: {len(pickle.dumps(reducer.to_json()))/1e3:.1f} KB, '
+          f'vs {len(pickle.dumps(sim.to_df()))/1e3:.1f} KB for the full results')
+    print('Done!')
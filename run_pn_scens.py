@@ -4,17 +4,19 @@ Run partner notification scenarios
 import numpy as np
 
 # %% Imports and settings
-import pandas as pd
 import sciris as sc
-import starsim as ss
 
-# From this repo
-from hiv_model import make_sim
+# Imported when first used, so that e.g. importing make_pn_pars() or processing saved runs starts quickly
+pd = sc.importbyname('pandas', lazy=True)
+ss = sc.importbyname('starsim', lazy=True)
 
+scen_results = ['new_infections', 'n_infected', 'prevalence']  # HIV results to summarize
+block_file = 'results/pn_scens_block.npy'
 
-def make_pn_pars(pnc=None, pnp=None, pac=None, pap=None):
+
+def make_pn_pars(pnc=None, pnp=None, pac=None, pap=None, start=None):
     """
-    Make partner notification parameters
+    Make partner notification parameters; if start is supplied, it sets the year that partner notification begins
     """
     pn_pars = dict(
         p_notify=dict(
@@ -26,12 +28,20 @@ def make_pn_pars(pnc=None, pnp=None, pac=None, pap=None):
             previous=ss.bernoulli(p=pap),  # Probability that previous partners will attend
         ),
     )
+    if start is not None:
+        pn_pars['start'] = start
     return pn_pars
 
 
-def run_pn_scens(stop=2051, parallel=True):
+def run_pn_scens(stop=2051, parallel=True, use_cache=True, telemetry=True, block_file=None, checkpoint_every=None, store_runs=True):
     """
-    Run analyses
+    Run analyses; if use_cache is True, scenarios that have already been run with the same inputs are loaded instead.
+    If telemetry is True (or the name of a JSONL log), show the live progress of parallel runs; see telemetry.py.
+    If block_file is given, the yearly results of each sim are written to a ResultBlock in that file by the worker
+    that ran it, and the block is returned instead of the sims; see blocks.py. With a block, store_runs=False (or
+    use_cache=False) doesn't store the runs in the cache, so nothing but the block is written. If checkpoint_every
+    is given (with use_cache or a block), each run saves a checkpoint every this many simulated years, and running
+    again after an interruption resumes; see checkpoint.py.
     """
     sc.heading("Making sims... ")
 
@@ -41,6 +51,29 @@ def run_pn_scens(stop=2051, parallel=True):
     pndict['PN - med'] = make_pn_pars(pnc=0.2, pnp=0.05, pac=0.2, pap=0.1)  # Medium partner notification
     pndict['PN - high'] = make_pn_pars(pnc=0.5, pnp=0.1, pac=0.5, pap=0.2)  # High partner notification
 
+    block = None
+    if block_file is not None:
+        from blocks import ResultBlock
+        block = ResultBlock(block_file, scenarios=list(pndict.keys()), runs=list(range(n_scen_runs)),
+                            years=list(range(1985, int(stop) + 1)), metrics=[f'hiv.{res}' for res in scen_results])
+
+    if use_cache or block is not None:
+        from cache import run_sims
+        scens = [(pnlabel, pn_pars, i) for pnlabel, pn_pars in pndict.items() for i in range(n_scen_runs)]
+        sc.heading(f"Running {len(scens)} sims... ")
+        sims = run_sims([dict(seed=i, pn_pars=pn_pars, stop=stop, verbose=-1) for _, pn_pars, i in scens], parallel=parallel, telemetry=telemetry,
+                        block=block, block_inds=[(pnlabel, i) for pnlabel, _, i in scens], checkpoint_every=checkpoint_every,
+                        use_cache=use_cache, store=use_cache and store_runs)
+        if block is not None:
+            return block
+        for sim, (pnlabel, pn_pars, i) in zip(sims, scens):
+            sim.label = f'{pnlabel}--{str(i)}'
+            sim.pn_scen = pnlabel
+            sim.pn_pars = pn_pars
+            sim.parset = i
+        return sims
+
+    from templates import make_sim  # Initializes each population once, then starts from the stored template
     sims = sc.autolist()
     for pnlabel, pn_pars in pndict.items():
 
@@ -56,7 +89,13 @@ def run_pn_scens(stop=2051, parallel=True):
             sims += sim
 
     sc.heading(f"Running {len(sims)} sims... ")
-    if parallel:
+    if parallel and telemetry:
+        from telemetry import Monitor, add_telemetry
+        with Monitor(logfile=telemetry if isinstance(telemetry, str) else None, n_tasks=len(sims)) as monitor:
+            for i, sim in enumerate(sims):
+                add_telemetry(sim, monitor.address, task=i, info=dict(scenario=sim.pn_scen, parset=sim.parset))
+            sims = ss.parallel(sims).sims
+    elif parallel:
         sims = ss.parallel(sims).sims
     else:
         for sim in sims:
@@ -69,6 +108,7 @@ def process_scens(sims=None):
     """
     Process the scenarios
     """
+    from utils import get_years
     if sims is None:
         sims = sc.loadobj('results/pn_scens.obj')
 
@@ -76,14 +116,14 @@ def process_scens(sims=None):
     sc.heading(f"Processing sims... ")
     dfs = []
     disease = 'hiv'
-    results = ['new_infections', 'n_infected', 'prevalence']
 
     for s, sim in enumerate(sims):
         print(f"Processing sim {s+1}/{len(sims)}")
         sdfs = sc.autolist()
-        for res in results:
+        for res in scen_results:
             colname = f'{disease}.{res}'
             thisdf = sim.results[disease][res].to_df(resample='year', use_years=True, col_names=colname)
+            thisdf = thisdf.set_index(get_years(thisdf))[[colname]]  # Index by year, whether or not timevec is a column
             sdfs += thisdf
 
         sdf = pd.concat(sdfs, axis=1)
@@ -107,6 +147,9 @@ if __name__ == '__main__':
     debug = False
     seed = 1
     n_scen_runs = [2, 1][debug]  # Number of parameter sets to run per scenario
+    telemetry = True  # Show the live progress of the runs and log it to results/telemetry/
+    use_block = True  # Workers write yearly results to a shared block (results/pn_scens_block.npy) rather than returning whole sims
+    checkpoint_every = 5  # Simulated years between checkpoints; if the runs are interrupted, running this again resumes them
     to_run = [
         'run_pn_scens',
         'process_scens',  # Process the scenarios
@@ -115,12 +158,20 @@ if __name__ == '__main__':
 
     if 'run_pn_scens' in to_run:
         # Run analyses
-        sims = run_pn_scens(parallel=True, stop=2051)
-        sc.saveobj('results/pn_scens.obj', sims)  # Don't commit to repo
+        if use_block:
+            run_pn_scens(parallel=True, stop=2051, telemetry=telemetry, block_file=block_file, checkpoint_every=checkpoint_every)
+        else:
+            sims = run_pn_scens(parallel=True, stop=2051, telemetry=telemetry, checkpoint_every=checkpoint_every)
+            sc.saveobj('results/pn_scens.obj', sims)  # Don't commit to repo
 
     if 'process_scens' in to_run:
         # Process the scenarios
-        df_stats = process_scens()
+        if use_block:
+            from blocks import ResultBlock
+            from utils import percentiles
+            df_stats = ResultBlock(block_file).describe(percentiles=percentiles)
+        else:
+            df_stats = process_scens()
         sc.saveobj('results/pn_scens.df', df_stats)  # Don't commit to repo
 
     if 'plot_scenarios' in to_run:
@@ -0,0 +1,204 @@
+"""
+Memory-budgeted parallel runner for ensembles of sims
+
+Rather than using a fixed number of workers, run_ensemble() runs a short probe
+sim to measure how much memory each sim needs, and picks as many workers as
+fit within a memory budget (by default 80% of the currently available RAM).
+Workers are replaced after a fixed number of tasks so that memory
+fragmentation doesn't accumulate, and each task's memory use and the overall
+throughput are reported. A task's peak memory is sampled while it runs (see
+PeakRSS), since the operating system only keeps each process's lifetime peak.
+"""
+
+# %% Imports and settings
+import os
+import inspect
+import resource
+import threading
+import numpy as np
+import pandas as pd
+import sciris as sc
+import psutil
+import multiprocess as mp  # Like multiprocessing but uses dill, so sims with local functions can be pickled
+
+default_budget = 0.8  # Share of available memory to use if no budget is given
+
+
+def peak_rss():
+    """ Peak resident memory of this process over its lifetime so far, in bytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024  # ru_maxrss is in KB on Linux
+
+
+def current_rss():
+    """ Current resident memory of this process, in bytes """
+    return psutil.Process().memory_info().rss
+
+
+class PeakRSS:
+    """
+    Peak resident memory of this process while a block of code runs, sampled in a background thread
+
+    **Example**::
+
+        with PeakRSS() as mem:
+            sim.run()
+        print(mem.peak)
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval  # Seconds between samples
+        self.peak = 0
+        return
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        proc = psutil.Process()
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, proc.memory_info().rss)
+        return
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+        return
+
+
+def _probe(kwargs, probe_years):
+    """ Run a shortened sim in this (fresh) process and report its memory use """
+    from hiv_model import make_sim
+    defaults = {k: p.default for k, p in inspect.signature(make_sim).parameters.items()}
+    kwargs = sc.mergedicts(defaults, {k: v for k, v in kwargs.items() if k in defaults}, dict(verbose=-1))  # Tasks can have other arguments, e.g. for the cache
+    full_years = kwargs['stop'] - kwargs['start']
+    kwargs['stop'] = min(kwargs['start'] + probe_years, kwargs['stop'])
+    sim = make_sim(**kwargs)
+    if not sim.initialized:
+        sim.init()
+    base = current_rss()
+    sim.run()
+    return dict(base=base, end=current_rss(), peak=peak_rss(), probe_years=kwargs['stop'] - kwargs['start'], full_years=full_years)
+
+
+def probe_memory(kwargs=None, probe_years=5, safety=1.2):
+    """
+    Estimate the peak memory needed by one worker to run a sim made by make_sim(**kwargs)
+
+    The probe runs for probe_years in a separate process. Memory that grows during the
+    run (results, population growth, network edges) is extrapolated linearly to the full
+    run length, and the total is multiplied by a safety factor.
+
+    Returns:
+        mem (float): estimated peak memory per worker, in bytes
+    """
+    kwargs = sc.ifelse(kwargs, dict())
+    ctx = mp.get_context('spawn')  # A fresh process, so the parent's memory isn't counted
+    with ctx.Pool(1) as pool:
+        stats = pool.apply(_probe, (kwargs, probe_years))
+    growth = max(stats['end'] - stats['base'], 0)*(stats['full_years']/max(stats['probe_years'], 1) - 1)
+    mem = (stats['peak'] + growth)*safety
+    return mem
+
+
+def pick_n_workers(mem_per_task, mem_budget=None, max_workers=None):
+    """
+    Number of workers that fit in a memory budget
+
+    Args:
+        mem_per_task (float): peak memory per worker, in bytes
+        mem_budget (float): total memory to use in bytes, or a fraction (<=1) of the currently available memory
+        max_workers (int): upper limit (default: number of CPUs)
+    """
+    available = psutil.virtual_memory().available
+    mem_budget = sc.ifelse(mem_budget, default_budget)
+    if mem_budget <= 1:
+        mem_budget *= available
+    max_workers = sc.ifelse(max_workers, sc.cpu_count())
+    n_workers = int(np.clip(mem_budget//mem_per_task, 1, max_workers))
+    return n_workers
+
+
+def _run_task(task):
+    """ Run one task in a worker, recording its time and memory use, and whether it built a template (see templates.py) """
+    import templates
+    i, fn, kwargs = task
+    n_built = templates.n_built
+    t0 = sc.tic()
+    with PeakRSS() as mem:
+        out = fn(**kwargs)
+    stats = dict(task=i, pid=os.getpid(), time=sc.toc(t0, output=True), rss=current_rss(), peak_rss=mem.peak, worker_peak_rss=peak_rss(),
+                 new_template=templates.n_built > n_built)
+    return i, out, stats
+
+
+def run_ensemble(fn, kwargs_list, n_workers=None, mem_budget=None, max_tasks_per_worker=10, probe_kwargs=None, verbose=True, telemetry=None, schedule=True):
+    """
+    Run fn(**kwargs) for every entry in kwargs_list in a pool of workers sized to fit in memory
+
+    Args:
+        fn (func): function to run, e.g. cache.run_sim
+        kwargs_list (list): keyword arguments for each task
+        n_workers (int): number of workers; if None, chosen from a probe run and the memory budget
+        mem_budget (float): memory budget in bytes, or as a fraction of available memory (see pick_n_workers())
+        max_tasks_per_worker (int): replace each worker after this many tasks (None to never replace)
+        probe_kwargs (dict): make_sim() arguments for the probe run (default: those of the first task)
+        verbose (bool): whether to print progress and the final report
+        telemetry (bool/str): if True (or the name of a JSONL log), show live progress from the running sims; fn must take a telemetry argument (see telemetry.py)
+        schedule (bool): start the tasks with the longest predicted run time first, and log their run times to refine the predictions (see scheduler.py); kwargs_list must be run_sim() arguments
+
+    Returns:
+        outputs (list): the output of each task, in the same order as kwargs_list
+        report (DataFrame): time, memory at the end (rss) and peak memory (peak_rss) of each task, and the peak memory of its worker over its lifetime so far (worker_peak_rss); throughput is in report.attrs
+    """
+    n_tasks = len(kwargs_list)
+    if n_workers is None:
+        probe_kwargs = sc.ifelse(probe_kwargs, kwargs_list[0])
+        mem = probe_memory(probe_kwargs)
+        n_workers = min(pick_n_workers(mem, mem_budget), n_tasks)
+        if verbose:
+            print(f'Estimated {mem/1e9:.2f} GB per sim; using {n_workers} workers')
+
+    t0 = sc.tic()
+    outputs = [None]*n_tasks
+    stats = []
+    tasks = [(i, fn, kwargs) for i, kwargs in enumerate(kwargs_list)]
+    model = None
+    if schedule:
+        from scheduler import CostModel, order_tasks
+        model = CostModel()
+        order, predicted = order_tasks(kwargs_list, model=model, telemetry=bool(telemetry))
+        tasks = [tasks[i] for i in order]  # Idle workers take the next task, so short tasks fill in at the end
+        if verbose:
+            print(f'Starting the longest of {n_tasks} tasks first (cost model fitted to {model.n_records} previous runs)')
+    monitor = None
+    if telemetry:
+        from telemetry import Monitor
+        monitor = Monitor(logfile=telemetry if isinstance(telemetry, str) else None, n_tasks=n_tasks)
+        monitor.start()
+        tasks = [(i, fn, sc.mergedicts(kwargs, dict(telemetry=dict(address=monitor.address, task=i)))) for i, fn, kwargs in tasks]
+    try:
+        with mp.Pool(n_workers, maxtasksperchild=max_tasks_per_worker) as pool:
+            for i, out, taskstats in pool.imap_unordered(_run_task, tasks):
+                outputs[i] = out
+                stats.append(taskstats)
+                if model is not None:
+                    model.record(kwargs_list[i], taskstats['time'], predicted=predicted[i], telemetry=bool(telemetry), new_template=taskstats['new_template'])
+                    taskstats['predicted'] = predicted[i]
+                if verbose:
+                    print(f'  Task {len(stats)}/{n_tasks} done ({taskstats["time"]:.1f} s, peak {taskstats["peak_rss"]/1e9:.2f} GB)')
+    finally:
+        if monitor is not None:
+            monitor.stop()
+
+    elapsed = sc.toc(t0, output=True)
+    report = pd.DataFrame(stats).sort_values('task').set_index('task')
+    report.attrs = dict(n_workers=n_workers, elapsed=elapsed, sims_per_hour=n_tasks/elapsed*3600)
+    if verbose:
+        print(f'Ran {n_tasks} sims on {n_workers} workers in {elapsed:.1f} s: {report.attrs["sims_per_hour"]:.1f} sims/hour, '
+              f'peak RSS {report.peak_rss.max()/1e9:.2f} GB per task')
+
+    return outputs, report
@@ -0,0 +1,188 @@
+"""
+Longest-expected-first scheduling of ensemble runs
+
+How long a sim takes depends on its size and length, and also on its
+parameters: more partnerships (higher nw_p_pair_form, nw_f1_conc, nw_m1_conc)
+and more infections (higher hiv_beta_m2f) mean more work per timestep. If the
+slowest sims happen to start last, most workers sit idle while they finish.
+
+How it's run matters as much: the timestep, compact precision, stratified
+results, starting from a template (and whether the template had to be built
+first), checkpointing and telemetry all change the run time.
+
+CostModel predicts the run time of a task from its run_sim() arguments: the
+time per agent-timestep is modeled as log-linear in the parameters (those of
+the calibration row it uses, if any), in whether partner notification is on,
+and in the run settings above, fitted by least squares to the timings of
+previous runs. Logged timings without the run settings, from before they were
+recorded, aren't comparable and aren't used. runners.run_ensemble()
+uses it to start the tasks with the longest predicted run time first; idle
+workers take the next task as soon as they finish one, so the short tasks
+fill in around the long ones. The actual run time of each task is appended to
+a timings log, so the predictions improve with every ensemble.
+"""
+
+# %% Imports and settings
+import os
+import json
+import socket
+import inspect
+import numpy as np
+import pandas as pd
+import sciris as sc
+
+timings_file = 'results/timings.jsonl'
+par_features = ['hiv_beta_m2f', 'nw_prop_f0', 'nw_prop_m0', 'nw_f1_conc', 'nw_m1_conc', 'nw_p_pair_form']
+run_features = ['log_dt', 'compact', 'stratify', 'use_template', 'new_template', 'checkpoint', 'telemetry']
+features = ['log_n_agents', 'pn'] + run_features + par_features
+default_dt = 1/12  # make_sim()'s timestep if dt is None
+
+
+def get_features(kwargs, telemetry=False, new_template=None):
+    """
+    Features of a task for the cost model, from its run_sim() arguments
+
+    Args:
+        kwargs (dict): the task's arguments for cache.run_sim(), i.e. make_sim() arguments and run options
+        telemetry (bool): whether the task reports its progress (added to the arguments by runners.run_ensemble())
+        new_template (bool): whether the task built its template; if None, whether the template isn't stored yet
+    """
+    from hiv_model import make_sim
+    from cache import calib_row, run_sim
+    defaults = {k: p.default for k, p in inspect.signature(make_sim).parameters.items()}
+    runopts = {k: p.default for k, p in inspect.signature(run_sim).parameters.items() if k != 'kwargs'}
+    opts = sc.mergedicts(runopts, {k: v for k, v in kwargs.items() if k in runopts})
+    kwargs = sc.mergedicts(defaults, {k: v for k, v in kwargs.items() if k in defaults})
+    if kwargs['calib_pars'] is not None:
+        row = kwargs['calib_pars']
+    else:
+        row = calib_row(kwargs['par_idx']) if kwargs['use_calib'] else dict()
+    if new_template is None:
+        from templates import template_path
+        new_template = opts['use_template'] and not template_path(**kwargs).exists()
+    dt = sc.ifelse(kwargs['dt'], default_dt)
+    feats = dict(
+        n_agents=float(kwargs['n_agents']),
+        years=float(kwargs['stop'] - kwargs['start']),
+        steps=float(kwargs['stop'] - kwargs['start'])/dt,
+        log_n_agents=np.log(kwargs['n_agents']),
+        pn=float(kwargs['pn_pars'] is not None),
+        log_dt=np.log(dt),
+        compact=float(kwargs['precision'] == 'compact'),
+        stratify=float(kwargs['stratify']),
+        use_template=float(opts['use_template']),
+        new_template=float(opts['use_template'] and new_template),
+        checkpoint=float(bool(opts['checkpoint_every'])),
+        telemetry=float(bool(telemetry)),
+    )
+    for k in par_features:
+        feats[k] = float(row.get(k, np.nan))  # Unknown without calibration; filled in with the mean when fitting and predicting
+    return feats
+
+
+class CostModel:
+    """
+    Predict the run time of tasks from their run_sim() arguments
+
+    Args:
+        filename (str): timings log to fit to and append to
+        min_records (int): fewest timings needed to fit the effect of the features; with fewer, the cost is proportional to agent-timesteps
+        ridge (float): ridge penalty on the (standardized) feature coefficients, to keep the fit stable with few timings
+        this_host (bool): only use timings from this machine, if it has at least min_records of them
+    """
+    def __init__(self, filename=timings_file, min_records=20, ridge=1.0, this_host=True):
+        self.filename = filename
+        self.min_records = min_records
+        self.ridge = ridge
+        self.this_host = this_host
+        self.coef = None
+        self.fit()
+        return
+
+    def load(self):
+        """ Timings of previous runs with all the run settings logged, i.e. comparable with new ones """
+        columns = ['host', 'time', 'n_agents', 'years', 'steps'] + features
+        if not os.path.exists(self.filename):
+            return pd.DataFrame(columns=columns)
+        with open(self.filename) as f:
+            df = pd.DataFrame([json.loads(line) for line in f if line.strip()])
+        df = df.reindex(columns=df.columns.union(columns, sort=False))
+        df = df.dropna(subset=['time', 'steps'] + run_features).reset_index(drop=True)
+        if self.this_host and (df.host == socket.gethostname()).sum() >= self.min_records:
+            df = df[df.host == socket.gethostname()]
+        return df
+
+    def design(self, df):
+        """ Standardized feature matrix, with missing parameters set to their mean """
+        X = df[features].astype(float).values
+        X = np.where(np.isnan(X), self.mean, X)
+        return (X - self.mean)/self.std
+
+    def fit(self):
+        """ Fit log(time per agent-timestep) to the features of the logged timings """
+        df = self.load()
+        df = df[df.time > 0]
+        self.n_records = len(df)
+        if not len(df):
+            self.intercept = 0.0
+            return self
+        y = np.log((df.time/(df.n_agents*df.steps)).astype(float)).values
+        self.intercept = np.median(y)
+        if len(df) < self.min_records:
+            return self
+
+        X = df[features].astype(float).values
+        self.mean = np.nan_to_num(np.nanmean(X, axis=0))
+        self.std = np.nan_to_num(np.nanstd(X, axis=0))
+        self.std[self.std == 0] = 1  # Features that never vary have no effect
+        X = self.design(df)
+        A = np.vstack([np.column_stack([np.ones(len(X)), X]), np.sqrt(self.ridge)*np.eye(len(features) + 1)[1:]])  # Don't penalize the intercept
+        b = np.concatenate([y, np.zeros(len(features))])
+        coef = np.linalg.lstsq(A, b, rcond=None)[0]
+        self.intercept, self.coef = coef[0], coef[1:]
+        return self
+
+    def predict(self, kwargs_list, telemetry=False):
+        """ Predicted run time of each task in seconds (or relative to each other, if there are no timings yet) """
+        df = pd.DataFrame([get_features(kwargs, telemetry=telemetry) for kwargs in kwargs_list])
+        logcost = np.full(len(df), self.intercept)
+        if self.coef is not None:
+            logcost += self.design(df) @ self.coef
+        return np.exp(logcost)*df.n_agents.values*df.steps.values
+
+    def effects(self):
+        """ Relative change in run time per standard deviation of each feature """
+        if self.coef is None:
+            return None
+        return pd.Series(np.exp(self.coef) - 1, index=features).sort_values()
+
+    def record(self, kwargs, time, predicted=None, telemetry=False, new_template=None, **kwargs_extra):
+        """ Append the actual run time of a task to the timings log, with whether it built its template """
+        entry = dict(host=socket.gethostname(), time=time, predicted=predicted, **get_features(kwargs, telemetry=telemetry, new_template=new_template), **kwargs_extra)
+        entry = {k: (None if sc.isnumber(v) and not np.isfinite(v) else v) for k, v in entry.items()}
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        return
+
+
+def order_tasks(kwargs_list, model=None, telemetry=False):
+    """ Indices of the tasks, longest predicted run time first, and the predictions """
+    model = sc.ifelse(model, CostModel())
+    predicted = model.predict(kwargs_list, telemetry=telemetry)
+    return np.argsort(-predicted, kind='stable'), predicted
+
+
+if __name__ == '__main__':
+
+    # How well the logged timings are predicted, and which parameters make runs slower
+    model = CostModel()
+    df = model.load()
+    print(f'{model.n_records} timings in {model.filename}')
+    if model.coef is not None:
+        pred = np.exp(model.intercept + model.design(df) @ model.coef)*df.n_agents*df.steps
+        r2 = 1 - np.var(np.log(df.time) - np.log(pred))/np.var(np.log(df.time))
+        print(f'R² of log run time: {r2:.2f}')
+        print('Change in run time per standard deviation of each feature:')
+        print(model.effects().to_string(float_format=lambda x: f'{x:+.1%}'))
+    print('Done!')
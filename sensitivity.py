@@ -0,0 +1,517 @@
+"""
+Global sensitivity analysis of the calibrated and partner notification parameters
+
+Which inputs drive the outputs, e.g. the infections averted by partner
+notification? Sobol indices answer this: the first-order index of a parameter
+is the share of the output variance explained by that parameter alone, and
+the total-order index also includes its interactions with the others. Morris
+elementary effects are a cheaper screen that ranks parameters without
+apportioning variance.
+
+There are three ways to get them here, from cheapest to most expensive:
+    - calib_sensitivity() fits a surrogate to the trials already stored by
+      run_hiv_calibration.py, with no new runs (calibrated parameters only,
+      since the calibration doesn't include partner notification);
+    - surrogate_sensitivity() fits a surrogate to a few hundred runs of a
+      Latin hypercube over all the parameters;
+    - sobol_design() and morris_design() give the designs for estimating the
+      indices directly, which takes n*(k+2) and r*(k+1) runs for k parameters.
+
+A surrogate is a quadratic polynomial chaos expansion of the output, fitted by
+ridge regression; its Sobol indices follow exactly from its coefficients, and
+the confidence intervals come from refitting it to bootstrap resamples of the
+runs. Its cross-validated R² is reported with the indices: if it's below
+min_r2, the surrogate misses much of the variation, so the indices are NaN
+(with a warning), and the direct designs should be used instead.
+
+Designs are run by run_design(), which runs each point with and without
+partner notification through cache.run_sims(), so runs are cached and shared:
+every point with the same calibrated parameters and seed shares one base run,
+and rerunning a design, or one that overlaps it, only runs the new points.
+
+Indices are for independent inputs, uniformly distributed between the bounds,
+except those from calib_sensitivity(), which are over the calibration trials
+themselves, since the best-fitting trials are correlated.
+"""
+
+# %% Imports and settings
+import os
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+from sweeps import lhs
+
+calib_file = 'results/zam_hiv_calib.obj'
+block_file = 'results/sensitivity_block.npy'
+pn_names = ['pnc', 'pnp', 'pac', 'pap']
+pn_bounds = dict(  # Spanning the low to high partner notification scenarios in run_pn_scens.py
+    pnc=dict(low=0.05, high=0.6),  # Probability of notifying current partners
+    pnp=dict(low=0.0, high=0.2),  # Probability of notifying previous partners
+    pac=dict(low=0.05, high=0.6),  # Probability that current partners attend
+    pap=dict(low=0.0, high=0.3),  # Probability that previous partners attend
+)
+pn_defaults = dict(pnc=0.2, pnp=0.05, pac=0.2, pap=0.1)  # The medium scenario, for points that don't vary them
+ridges = [1e-6, 1e-4, 1e-2, 1]  # Surrogate ridge penalties to choose from by cross-validation
+min_r2 = 0.5  # Lowest cross-validated R² of a surrogate for its indices to be reported
+
+
+def get_calib_bounds():
+    """ Ranges of the calibrated parameters, as used for calibration """
+    from run_hiv_calibration import calib_pars
+    return {k: dict(low=v['low'], high=v['high']) for k, v in calib_pars.items()}
+
+
+def scale(unit, bounds):
+    """ Convert points in the unit hypercube (columns in the order of bounds) to parameter values """
+    low = np.array([b['low'] for b in bounds.values()])
+    high = np.array([b['high'] for b in bounds.values()])
+    return pd.DataFrame(low + np.asarray(unit)*(high - low), columns=list(bounds.keys()))
+
+
+def unscale(df, bounds):
+    """ Convert parameter values to the unit hypercube """
+    low = np.array([b['low'] for b in bounds.values()])
+    high = np.array([b['high'] for b in bounds.values()])
+    return (df[list(bounds.keys())].values - low)/(high - low)
+
+
+# %% Designs and estimators
+
+def sobol_design(bounds, n, seed=0):
+    """
+    Saltelli design for estimating first- and total-order Sobol indices
+
+    Two independent Latin hypercubes A and B of n points each, plus, for each parameter, A with that parameter's
+    column taken from B: n*(k+2) points in all. The 'matrix' column says which of these each point is in ('A', 'B' or
+    the name of the parameter), and 'row' its row.
+    """
+    names = list(bounds.keys())
+    k = len(names)
+    unit = lhs({i: dict(low=0, high=1) for i in range(2*k)}, n, seed=seed).values
+    A, B = unit[:, :k], unit[:, k:]
+    mats = dict(A=A, B=B)
+    for i, name in enumerate(names):
+        AB = A.copy()
+        AB[:, i] = B[:, i]
+        mats[name] = AB
+    dfs = []
+    for label, mat in mats.items():
+        df = scale(mat, bounds)
+        df['matrix'] = label
+        df['row'] = np.arange(n)
+        dfs.append(df)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def sobol_indices(design, y, n_boot=1000, conf=0.95, seed=0):
+    """
+    First-order (Saltelli 2010) and total-order (Jansen 1999) Sobol indices from the outputs of a sobol_design()
+
+    Args:
+        design (DataFrame): the design
+        y (array): the output at each point of the design
+        n_boot (int): bootstrap resamples of the rows for the confidence intervals
+        conf (float): confidence level
+
+    Returns:
+        DataFrame with a row per parameter and the columns S1, S1_low, S1_high, ST, ST_low and ST_high
+    """
+    names, yA, yB, yAB = split_outputs(design, y)
+    n = len(yA)
+    rng = np.random.default_rng(seed)
+    S1, ST = saltelli(yA, yB, yAB)
+    boots = [saltelli(yA[rows], yB[rows], yAB[:, rows]) for rows in rng.integers(n, size=(n_boot, n))]
+    return summarize_indices(names, S1, ST, np.array([b[0] for b in boots]), np.array([b[1] for b in boots]), conf)
+
+
+def split_outputs(design, y):
+    """ Outputs of a sobol_design() for matrices A, B and each AB, in row order """
+    y = np.asarray(y, dtype=float)
+    order = np.argsort(design.row.values, kind='stable')
+    mats = {label: y[order][design.matrix.values[order] == label] for label in design.matrix.unique()}
+    names = [label for label in mats if label not in ['A', 'B']]
+    return names, mats['A'], mats['B'], np.array([mats[name] for name in names])
+
+
+def saltelli(yA, yB, yAB):
+    """ First- and total-order indices of each parameter (rows of yAB) """
+    var = np.var(np.concatenate([yA, yB]), ddof=1)
+    S1 = np.mean(yB*(yAB - yA), axis=1)/var
+    ST = 0.5*np.mean((yA - yAB)**2, axis=1)/var
+    return S1, ST
+
+
+def summarize_indices(names, S1, ST, S1_boot, ST_boot, conf):
+    """ Indices and their bootstrap percentile intervals, as a DataFrame """
+    q = [(1 - conf)/2, (1 + conf)/2]
+    df = pd.DataFrame(dict(S1=S1, ST=ST), index=pd.Index(names, name='par'))
+    df['S1_low'], df['S1_high'] = np.nanquantile(S1_boot, q, axis=0)
+    df['ST_low'], df['ST_high'] = np.nanquantile(ST_boot, q, axis=0)
+    return df[['S1', 'S1_low', 'S1_high', 'ST', 'ST_low', 'ST_high']].sort_values('ST', ascending=False)
+
+
+def morris_design(bounds, r, levels=4, seed=0):
+    """
+    Morris design: r trajectories, each changing one parameter at a time by delta = levels/(2*(levels - 1)) of its range
+
+    Each trajectory has k+1 points; the 'trajectory' column gives its index, and 'moved' the parameter changed since the
+    previous point (empty for the first point).
+    """
+    names = list(bounds.keys())
+    k = len(names)
+    rng = np.random.default_rng(seed)
+    delta = levels/(2*(levels - 1))
+    grid = np.arange(levels)/(levels - 1)
+    grid = grid[grid <= 1 - delta + 1e-9]  # Starting levels from which every parameter can move up by delta
+    dfs = []
+    for t in range(r):
+        x = rng.choice(grid, size=k)
+        points, moved = [x.copy()], ['']
+        for i in rng.permutation(k):
+            x[i] += delta
+            points.append(x.copy())
+            moved.append(names[i])
+        df = scale(np.array(points), bounds)
+        df['trajectory'] = t
+        df['moved'] = moved
+        dfs.append(df)
+    design = pd.concat(dfs, ignore_index=True)
+    design.attrs['delta'] = delta
+    return design
+
+
+def morris_indices(design, y, bounds, n_boot=1000, conf=0.95, seed=0):
+    """
+    Morris indices from the outputs of a morris_design(): the mean (mu), mean absolute value (mu_star) and standard
+    deviation (sigma) of each parameter's elementary effects, the change in the output when the parameter moves across
+    its whole range, with a bootstrap interval for mu_star over trajectories
+    """
+    names = list(bounds.keys())
+    unit = unscale(design, bounds)
+    y = np.asarray(y, dtype=float)
+    traj = design.trajectory.values
+    effects = {name: [] for name in names}
+    for t in np.unique(traj):
+        inds = np.flatnonzero(traj == t)
+        for prev, this in zip(inds[:-1], inds[1:]):
+            i = names.index(design.moved.values[this])
+            effects[names[i]].append((y[this] - y[prev])/(unit[this, i] - unit[prev, i]))
+    ee = np.array([effects[name] for name in names])  # Parameter, trajectory
+
+    rng = np.random.default_rng(seed)
+    r = ee.shape[1]
+    boots = np.array([np.abs(ee[:, rng.integers(r, size=r)]).mean(axis=1) for _ in range(n_boot)])
+    q = [(1 - conf)/2, (1 + conf)/2]
+    df = pd.DataFrame(dict(mu=ee.mean(axis=1), mu_star=np.abs(ee).mean(axis=1), sigma=ee.std(axis=1, ddof=1)), index=pd.Index(names, name='par'))
+    df['mu_star_low'], df['mu_star_high'] = np.quantile(boots, q, axis=0)
+    return df[['mu_star', 'mu_star_low', 'mu_star_high', 'mu', 'sigma']].sort_values('mu_star', ascending=False)
+
+
+# %% Surrogate
+
+class Surrogate:
+    """
+    Quadratic polynomial chaos surrogate of an output, fitted by ridge regression
+
+    The output is expanded in Legendre polynomials of the parameters scaled to the unit hypercube: the linear and
+    quadratic polynomial of each parameter and the product of the linear polynomials of each pair. These are orthonormal
+    for uniform inputs, so the Sobol indices of the surrogate follow exactly from its coefficients.
+
+    Args:
+        bounds (dict): name: dict(low=, high=) of each parameter
+        ridge (float): ridge penalty on the coefficients other than the intercept
+    """
+    def __init__(self, bounds, ridge=1e-6):
+        self.bounds = bounds
+        self.ridge = ridge
+        self.coef = None
+        k = len(bounds)
+        self.pairs = np.array([(i, j) for i in range(k) for j in range(i + 1, k)]).reshape(-1, 2)
+        return
+
+    def features(self, unit):
+        """ Intercept, then the linear and quadratic Legendre polynomial of each parameter, then the products of pairs """
+        u = 2*np.asarray(unit) - 1
+        p1 = np.sqrt(3)*u
+        p2 = np.sqrt(5)*(3*u**2 - 1)/2
+        return np.column_stack([np.ones(len(u)), p1, p2, p1[:, self.pairs[:, 0]]*p1[:, self.pairs[:, 1]]])
+
+    def fit(self, X, y):
+        """ Fit to parameter values X (a DataFrame with a column per parameter) and outputs y """
+        F = self.features(unscale(X, self.bounds))
+        y = np.asarray(y, dtype=float)
+        self.mean, self.std = y.mean(), y.std() or 1.0  # Standardize, so the penalty doesn't depend on the output's units
+        penalty = np.sqrt(self.ridge*len(y))*np.eye(F.shape[1])[1:]
+        A = np.vstack([F, penalty])
+        b = np.concatenate([(y - self.mean)/self.std, np.zeros(len(penalty))])
+        self.coef = np.linalg.lstsq(A, b, rcond=None)[0]
+        return self
+
+    def predict(self, X):
+        return self.mean + self.std*(self.features(unscale(X, self.bounds)) @ self.coef)
+
+    def cv_r2(self, X, y, folds=5, seed=0):
+        """ Cross-validated R² of the surrogate """
+        y = np.asarray(y, dtype=float)
+        fold = np.random.default_rng(seed).permutation(len(y)) % folds
+        pred = np.zeros(len(y))
+        for f in range(folds):
+            test = fold == f
+            model = Surrogate(self.bounds, ridge=self.ridge).fit(X[~test], y[~test])
+            pred[test] = model.predict(X[test])
+        return 1 - np.sum((y - pred)**2)/np.sum((y - y.mean())**2)
+
+    def sobol(self):
+        """ First- and total-order Sobol indices of the surrogate: each term's share of the variance is its squared coefficient """
+        k = len(self.bounds)
+        sq = self.coef[1:]**2
+        main = sq[:k] + sq[k:2*k]
+        inter = sq[2*k:]
+        var = sq.sum()
+        S1 = main/var
+        ST = S1 + (np.bincount(self.pairs[:, 0], weights=inter, minlength=k) + np.bincount(self.pairs[:, 1], weights=inter, minlength=k))/var
+        return S1, ST
+
+    def ancova(self, X):
+        """
+        First- and total-order indices of the surrogate over the points X, e.g. correlated calibration trials
+
+        Each term's contribution is its covariance with the surrogate's prediction over the points, as a share of the
+        prediction's variance (the ANCOVA decomposition of Li et al. 2010). For independent uniform points this gives
+        the same indices as sobol(), but it only uses the region the points cover. With correlated points an index
+        includes the share of variance a parameter carries through its correlations, and it can be negative.
+        """
+        k = len(self.bounds)
+        terms = self.features(unscale(X, self.bounds))[:, 1:]*self.coef[1:]
+        pred = terms.sum(axis=1)
+        var = pred.var()
+        cov = ((terms - terms.mean(axis=0))*(pred - pred.mean())[:, None]).mean(axis=0)/var
+        S1 = cov[:k] + cov[k:2*k]
+        inter = cov[2*k:]
+        ST = S1 + np.bincount(self.pairs[:, 0], weights=inter, minlength=k) + np.bincount(self.pairs[:, 1], weights=inter, minlength=k)
+        return S1, ST
+
+
+def surrogate_indices(X, y, bounds, n_boot=1000, conf=0.95, ridge=None, seed=0, min_r2=min_r2, over_runs=False):
+    """
+    Sobol indices of an output from a surrogate fitted to runs at arbitrary points, e.g. calibration trials or an LHS
+
+    Args:
+        X (DataFrame): parameter values of each run
+        y (array): output of each run
+        bounds (dict): ranges of the parameters over which to compute the indices; keep them within the runs' range
+        n_boot (int): bootstrap resamples of the runs, refitting the surrogate to each, for the confidence intervals
+        conf (float): confidence level
+        ridge (float): ridge penalty of the surrogate (default: whichever of ridges cross-validates best)
+        min_r2 (float): if the surrogate's cross-validated R² is below this, warn and return NaN indices
+        over_runs (bool): compute the indices over the runs themselves (see Surrogate.ancova()) rather than over
+            independent uniform inputs between the bounds; use this when the runs aren't a design, e.g. calibration trials
+
+    Returns:
+        DataFrame of indices as from sobol_indices(), with the surrogate's cross-validated R² in df.attrs['cv_r2'],
+        its ridge penalty in df.attrs['ridge'] and the distribution they're over in df.attrs['over']
+    """
+    X = X.reset_index(drop=True)
+    y = np.asarray(y, dtype=float)
+    ok = np.isfinite(y)
+    X, y = X[ok].reset_index(drop=True), y[ok]
+    if ridge is None:
+        ridge = max(ridges, key=lambda r: Surrogate(bounds, ridge=r).cv_r2(X, y, seed=seed))
+    indices = lambda model, X: model.ancova(X) if over_runs else model.sobol()
+    surrogate = Surrogate(bounds, ridge=ridge).fit(X, y)
+    S1, ST = indices(surrogate, X)
+    cv_r2 = surrogate.cv_r2(X, y, seed=seed)
+
+    if cv_r2 < min_r2:  # The indices would describe the surrogate rather than the model
+        warnmsg = f'The surrogate only explains {cv_r2:.2f} of the variance of held-out runs (min_r2={min_r2}); returning NaN indices'
+        ss.warn(warnmsg)
+        columns = ['S1', 'S1_low', 'S1_high', 'ST', 'ST_low', 'ST_high']
+        df = pd.DataFrame(np.nan, index=pd.Index(list(bounds.keys()), name='par'), columns=columns)
+    else:
+        rng = np.random.default_rng(seed)
+        boots = [indices(Surrogate(bounds, ridge=ridge).fit(X.iloc[rows], y[rows]), X.iloc[rows]) for rows in rng.integers(len(y), size=(n_boot, len(y)))]
+        df = summarize_indices(list(bounds.keys()), S1, ST, np.array([b[0] for b in boots]), np.array([b[1] for b in boots]), conf)
+    df.attrs['cv_r2'] = cv_r2
+    df.attrs['ridge'] = ridge
+    df.attrs['n_runs'] = len(y)
+    df.attrs['over'] = 'runs' if over_runs else 'uniform'
+    return df
+
+
+# %% Running designs
+
+def point_kwargs(point, stop=2051, pn_start=2026, pn=True):
+    """
+    make_sim() arguments for a design point, with or without partner notification
+
+    Calibrated parameters missing from the point take their values from the best calibration row; a 'par_idx' column
+    selects a calibration row instead. Partner notification probabilities missing from the point take the values of the
+    medium scenario.
+    """
+    from cache import calib_row
+    from run_pn_scens import make_pn_pars
+    bounds = get_calib_bounds()
+    kwargs = dict(seed=int(point.get('seed', 1)), stop=stop, verbose=-1)
+    if 'par_idx' in point:
+        kwargs['par_idx'] = int(point['par_idx'])
+    else:
+        row = calib_row(0)
+        kwargs['calib_pars'] = {k: float(point.get(k, row[k])) for k in bounds}
+    if pn:
+        probs = {k: float(point.get(k, pn_defaults[k])) for k in pn_names}
+        kwargs['pn_pars'] = make_pn_pars(**probs, start=pn_start)
+    return kwargs
+
+
+def run_design(design, stop=2051, pn_start=2026, seeds=None, block_file=block_file, **kwargs):
+    """
+    Run each point of a design with and without partner notification, and add the outcomes to it
+
+    Args:
+        design (DataFrame): one row per point, with columns for any of the calibrated parameters and pnc, pnp, pac and pap
+        stop (int): year to stop each sim
+        pn_start (int): year partner notification starts
+        seeds (list): random seeds to run each point with (default [1]); the outcomes are averaged over them
+        block_file (str): file for the yearly results of the runs (see blocks.py)
+        kwargs (dict): passed to cache.run_sims(), e.g. n_workers or telemetry
+
+    Returns:
+        design with the columns new_infections_base and new_infections (from pn_start to stop) and infections_averted
+    """
+    from cache import run_sims, sim_key
+    from blocks import ResultBlock
+    seeds = sc.ifelse(seeds, [1])
+
+    # Work out the unique runs: points with the same calibrated parameters and seed share their base run
+    tasks = dict()
+    point_keys = []
+    for point in design.to_dict('records'):
+        keys = []
+        for seed in seeds:
+            for pn in [False, True]:
+                runkw = point_kwargs({**point, 'seed': seed}, stop=stop, pn_start=pn_start, pn=pn)
+                key = sim_key(shrink=True, **runkw)
+                tasks[key] = runkw
+                keys.append((pn, key))
+        point_keys.append(keys)
+
+    sc.heading(f'Running {len(tasks)} sims for {len(design)} design points... ')
+    years = list(range(int(pn_start), int(stop)))
+    block = ResultBlock(block_file, scenarios=['runs'], runs=list(tasks.keys()), years=years, metrics=['hiv.new_infections'])
+    run_sims(list(tasks.values()), block=block, block_inds=[('runs', key) for key in tasks], **kwargs)
+    totals = pd.Series(np.asarray(block.data)[0, :, :, 0].sum(axis=1), index=block.runs)  # Cumulative new infections of each run
+
+    design = design.copy()
+    for pn, col in [(False, 'new_infections_base'), (True, 'new_infections')]:
+        design[col] = [np.mean([totals[key] for is_pn, key in keys if is_pn == pn]) for keys in point_keys]
+    design['infections_averted'] = design.new_infections_base - design.new_infections
+    return design
+
+
+# %% Analyses
+
+def calib_trials(outcome='hiv_new_infections', years=(2020, 2030), filename=calib_file):
+    """
+    Parameters and an outcome of each stored calibration trial
+
+    Args:
+        outcome (str): 'mismatch', or one of the yearly results stored with the trials (e.g. 'hiv_prevalence_15_49')
+        years (tuple): first and last year of the outcome to sum (for flows, i.e. new_*) or average (otherwise)
+
+    Returns:
+        X (DataFrame): the calibrated parameters of each trial
+        y (array): the outcome of each trial
+    """
+    calib = sc.loadobj(filename)
+    names = list(get_calib_bounds().keys())
+    X = calib.df[names].reset_index(drop=True)
+    if outcome == 'mismatch':
+        return X, calib.df.mismatch.values
+    df = calib.resdf
+    df = df[(df.time >= years[0]) & (df.time <= years[1])]
+    how = 'sum' if outcome.split('_', 1)[-1].startswith('new_') else 'mean'
+    y = df.groupby('res_no')[outcome].agg(how).reindex(range(len(X))).values
+    return X, y
+
+
+def trial_bounds(X):
+    """ The range of each parameter over a set of runs, e.g. calibration trials """
+    return {k: dict(low=X[k].min(), high=X[k].max()) for k in X.columns}
+
+
+def calib_sensitivity(outcome='hiv_new_infections', years=(2020, 2030), filename=calib_file, **kwargs):
+    """
+    Sensitivity of an outcome to the calibrated parameters, from a surrogate fitted to the stored calibration trials
+
+    No sims are run. The stored trials are the best-fitting ones, so their parameters are correlated and only cover
+    part of the box between their ranges; the indices are therefore averaged over the trials themselves (see
+    Surrogate.ancova()) rather than over independent uniform inputs. kwargs are passed to surrogate_indices().
+    """
+    X, y = calib_trials(outcome=outcome, years=years, filename=filename)
+    return surrogate_indices(X, y, trial_bounds(X), over_runs=True, **kwargs)
+
+
+def surrogate_sensitivity(n_points=200, outcome='infections_averted', pn=True, calib_bounds=None, seed=0, run_kw=None, **kwargs):
+    """
+    Sensitivity of an outcome to the calibrated and partner notification parameters, from a surrogate fitted to an LHS of runs
+
+    Args:
+        n_points (int): number of points in the Latin hypercube
+        outcome (str): new_infections_base, new_infections or infections_averted
+        pn (bool): include the partner notification probabilities as parameters
+        calib_bounds (dict): ranges of the calibrated parameters (default: the range of the stored calibration trials)
+        seed (int): seed for drawing the design
+        run_kw (dict): passed to run_design(), e.g. stop, seeds or n_workers
+        kwargs (dict): passed to surrogate_indices()
+
+    Returns:
+        indices (DataFrame): as from surrogate_indices()
+        design (DataFrame): the runs and their outcomes
+    """
+    calib_bounds = sc.ifelse(calib_bounds, trial_bounds(calib_trials()[0]))
+    bounds = sc.mergedicts(calib_bounds, pn_bounds if pn else None)
+    design = run_design(lhs(bounds, n_points, seed=seed), **sc.mergedicts(run_kw))
+    indices = surrogate_indices(design[list(bounds.keys())], design[outcome].values, bounds, seed=seed, **kwargs)
+    return indices, design
+
+
+if __name__ == '__main__':
+
+    # SETTINGS
+    debug = False
+    to_run = [
+        'calib',  # Which calibrated parameters drive new infections and the fit, from the calibration trials (no new runs)
+        'surrogate',  # Which parameters drive the infections averted by partner notification, from a surrogate fitted to an LHS of runs
+        # 'morris',  # Morris screening of the same parameters, run directly
+    ]
+    n_points = [200, 12][debug]  # Runs for the surrogate
+    n_traj = [20, 2][debug]  # Morris trajectories, each of k+1 points
+    run_kw = dict(stop=[2051, 2033][debug], n_workers=[None, 1][debug])  # Partner notification starts in 2026
+    resfolder = 'results/sensitivity'
+    os.makedirs(resfolder, exist_ok=True)
+    fmt = lambda x: f'{x:.3f}'
+
+    if 'calib' in to_run:
+        for outcome in ['hiv_new_infections', 'hiv_prevalence_15_49', 'mismatch']:
+            df = calib_sensitivity(outcome)
+            sc.heading(f'Sensitivity of {outcome} to the calibrated parameters over the {df.attrs["n_runs"]} calibration trials (surrogate R² {df.attrs["cv_r2"]:.2f})')
+            print(df.to_string(float_format=fmt))
+            sc.saveobj(f'{resfolder}/calib_{outcome}.df', df)
+
+    if 'surrogate' in to_run:
+        df, design = surrogate_sensitivity(n_points=n_points, run_kw=run_kw)
+        sc.heading(f'Sensitivity of infections averted (surrogate R² {df.attrs["cv_r2"]:.2f}, {df.attrs["n_runs"]} design points)')
+        print(df.to_string(float_format=fmt))
+        sc.saveobj(f'{resfolder}/surrogate_infections_averted.df', df)
+        sc.saveobj(f'{resfolder}/surrogate_design.df', design)
+
+    if 'morris' in to_run:
+        bounds = sc.mergedicts(trial_bounds(calib_trials()[0]), pn_bounds)
+        design = run_design(morris_design(bounds, r=n_traj), **run_kw)
+        df = morris_indices(design, design.infections_averted, bounds)
+        sc.heading('Morris screening of infections averted')
+        print(df.to_string(float_format=fmt))
+        sc.saveobj(f'{resfolder}/morris_infections_averted.df', df)
+
+    print('Done!')
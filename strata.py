@@ -0,0 +1,203 @@
+"""
+Stratified HIV results as one dense tensor
+
+stisim records HIV results by sex and age as separate named results
+(prevalence_f_15_20, new_infections_m_20_25, ...): one result per (measure,
+sex, age bin), each filled from its own masked count every step. StrataTensor
+instead records counts in a single array with dimensions (time, sex, age bin,
+[group, ...], measure). Each step, every agent gets one combined index from
+their sex, age bin and groups (e.g. whether they're a female sex worker or a
+client), and each measure is counted with one np.bincount() over that index,
+so finer bins or extra groups add no per-bin work.
+
+Ratios (prevalence and incidence) are computed from the counts when asked for,
+so they stay correct when bins are combined. get() returns a slice, summed over
+any dimensions that aren't specified, and to_df() the long format.
+
+make_sim(stratify=True) adds this analyzer with stisim's age bins and keeps
+only the whole-population results in stisim's HIV module.
+"""
+
+# %% Imports and settings
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+
+sexes = ['f', 'm']
+ratios = dict(prevalence=('n_infected', 'n_alive'), incidence=('new_infections', 'n_susceptible'))  # Numerator and denominator
+
+
+class StrataTensor(ss.Analyzer):
+    """
+    HIV counts by sex, age bin and optional groups, as one (time, sex, age, *groups, measure) array
+
+    Args:
+        age_bins (list): age bin edges; as in stisim, ages at the last edge are included in the last bin, and agents outside the bins (including unborn agents, whose ages are negative) are not counted
+        groups (list): boolean agent states to also stratify by, from the sexual network or HIV module, e.g. ['fsw', 'client']
+        measures (list): counts to record: any of n_alive, n_susceptible, n_infected, new_infections, n_diagnosed and n_on_art
+
+    **Example**::
+
+        sim = make_sim(analyzers=StrataTensor(age_bins=np.arange(0, 105, 5), groups=['fsw']))
+        sim.run()
+        strata = sim.analyzers.strata
+        prev = strata.get('prevalence', sex='f', fsw=True)  # Over time, for female sex workers of all ages
+        df = strata.to_df(['prevalence', 'new_infections'])
+    """
+    def __init__(self, pars=None, name='strata', **kwargs):
+        super().__init__(name=name)
+        self.define_pars(
+            age_bins=[0, 15, 20, 25, 30, 35, 50, 65, 100],  # As in stisim
+            groups=[],
+            measures=['n_alive', 'n_susceptible', 'n_infected', 'new_infections', 'n_diagnosed', 'n_on_art'],
+        )
+        self.update_pars(pars, **kwargs)
+        return
+
+    def init_post(self):
+        super().init_post()
+        self.age_bins = np.array(self.pars.age_bins, dtype=float)
+        self.groups = sc.tolist(self.pars.groups)
+        self.measures = sc.tolist(self.pars.measures)
+        self.shape = (2, len(self.age_bins) - 1) + (2,)*len(self.groups)  # Sex, age, groups
+        self.n_cells = int(np.prod(self.shape))
+        self.data = np.zeros((len(self.t), self.n_cells, len(self.measures)))
+        self.years = np.array(self.t.yearvec)  # Kept for get() and to_df() after the sim is shrunk
+        return
+
+    def group_state(self, name):
+        """ A boolean agent state from the sexual network or the HIV module """
+        for mod in [self.sim.networks.structuredsexual, self.sim.diseases.hiv]:
+            if isinstance(getattr(mod, name, None), ss.BoolArr):
+                return getattr(mod, name)
+        errormsg = f'Could not find the boolean state "{name}" to stratify by'
+        raise AttributeError(errormsg)
+
+    def step(self):
+        sim = self.sim
+        hiv = sim.diseases.hiv
+        uids = sim.people.auids
+
+        # Combined index of each agent's stratum
+        age = sim.people.age.raw[uids]
+        bins = self.age_bins
+        age_ind = np.searchsorted(bins, age, side='right') - 1
+        age_ind[age == bins[-1]] = len(bins) - 2  # As in np.histogram(), the last bin includes its right edge
+        counted = (age_ind >= 0) & (age_ind < len(bins) - 1)
+        index = sim.people.male.raw[uids].astype(np.int64)*(len(bins) - 1) + age_ind
+        for group in self.groups:
+            index = index*2 + self.group_state(group).raw[uids]
+        index = index[counted]
+
+        # One count per measure over the index
+        masks = dict(
+            n_alive=None,
+            n_susceptible=hiv.susceptible,
+            n_infected=hiv.infected,
+            new_infections=hiv.ti_infected,
+            n_diagnosed=hiv.diagnosed,
+            n_on_art=hiv.on_art,
+        )
+        for m, measure in enumerate(self.measures):
+            state = masks[measure]
+            if state is None:
+                weights = None
+            elif measure == 'new_infections':
+                weights = (state.raw[uids] == hiv.ti)[counted]  # HIV has its own timestep
+            else:
+                weights = state.raw[uids][counted]
+            self.data[self.ti, :, m] = np.bincount(index, weights=weights, minlength=self.n_cells)
+        return
+
+    def finalize(self):
+        super().finalize()
+        scale = self.sim.result_scale(self)
+        self.data *= scale[:, None, None] if np.ndim(scale) else scale  # Scale to the population, as for results
+        return
+
+    @property
+    def tensor(self):
+        """ Counts as a (time, sex, age, *groups, measure) array """
+        return self.data.reshape((len(self.years),) + self.shape + (len(self.measures),))
+
+    @property
+    def age_labels(self):
+        bins = self.age_bins
+        labels = [f'{a:g}-{b:g}' for a, b in zip(bins[:-1], bins[1:])]
+        if bins[-1] >= 100:
+            labels[-1] = f'{bins[-2]:g}+'
+        return labels
+
+    def get(self, measure, ti=None, sex=None, age=None, **groups):
+        """
+        A measure by time, summed over any dimensions that aren't specified
+
+        Args:
+            measure (str): a recorded count, or 'prevalence' or 'incidence'
+            ti (int/slice): timestep(s) to return (default all)
+            sex (str): 'f' or 'm' (default both)
+            age (int/str/slice): age bin(s), by index or label (default all)
+            groups (dict): True or False for any of the groups (default both)
+
+        Returns:
+            array with the selected timesteps first, then any dimensions that were given as slices
+        """
+        if measure in ratios:
+            num, den = [self.get(m, ti=ti, sex=sex, age=age, **groups) for m in ratios[measure]]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(den > 0, num/np.where(den > 0, den, 1), 0)  # As stisim: 0 where there's no one to count
+
+        unknown = set(groups) - set(self.groups)
+        if unknown:
+            errormsg = f'Not stratified by {unknown}; the groups are {self.groups}'
+            raise KeyError(errormsg)
+        sel = [sc.ifelse(ti, slice(None)), None if sex is None else sexes.index(sex)]
+        sel.append(self.age_labels.index(age) if isinstance(age, str) else age)
+        sel += [None if groups.get(group) is None else int(groups[group]) for group in self.groups]
+
+        out = self.tensor[..., self.measures.index(measure)]
+        for axis in reversed(range(out.ndim)):  # From the last, so the earlier axes keep their positions
+            if sel[axis] is None:
+                out = out.sum(axis=axis)  # Not specified: sum over it
+            else:
+                out = out[(slice(None),)*axis + (sel[axis],)]
+        return out
+
+    def to_df(self, measures=None):
+        """ Long format: one row per timestep, sex, age bin and group, with a column per measure """
+        measures = sc.ifelse(sc.tolist(measures), self.measures)
+        coords = [self.years, sexes, self.age_labels] + [[False, True]]*len(self.groups)
+        index = pd.MultiIndex.from_product(coords, names=['timevec', 'sex', 'age'] + self.groups)
+        n_time = len(self.years)
+        df = pd.DataFrame(index=index)
+        for measure in measures:
+            if measure in ratios:
+                num, den = [self.data[:, :, self.measures.index(m)] for m in ratios[measure]]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    values = np.where(den > 0, num/np.where(den > 0, den, 1), 0)
+            else:
+                values = self.data[:, :, self.measures.index(measure)]
+            df[measure] = values.reshape(n_time*self.n_cells)
+        return df.reset_index()
+
+
+if __name__ == '__main__':
+
+    # HIV prevalence by 5-year age group, and among female sex workers and male clients
+    from hiv_model import make_sim
+
+    # SETTINGS
+    stop = 2030
+
+    strata = StrataTensor(name='fine', age_bins=np.arange(0, 105, 5), groups=['fsw', 'client'])
+    sim = make_sim(stop=stop, analyzers=strata, verbose=-1)
+    sim.run()
+    strata = sim.analyzers.fine
+
+    df = strata.to_df(['prevalence'])
+    df = df[(df.timevec == df.timevec.max()) & ~df.fsw & ~df.client]
+    print(df.pivot(index='age', columns='sex', values='prevalence').loc[strata.age_labels].to_string(float_format=lambda x: f'{x:.1%}'))
+    print(f'Prevalence among FSW: {strata.get("prevalence", ti=-1, sex="f", fsw=True):.1%}')
+    print(f'Prevalence among clients: {strata.get("prevalence", ti=-1, sex="m", client=True):.1%}')
+    print('Done!')
@@ -0,0 +1,196 @@
+"""
+Declarative scenario sweeps over partner notification and testing parameters
+
+A design is a DataFrame with one row per point, built by make_design() from a
+spec of parameter values (for a full grid) or bounds (for a Latin hypercube).
+run_sweep() deduplicates the points, runs the missing ones in parallel, caches
+each finished point under a hash of its contents, and returns a single tidy
+long-format DataFrame with the design parameters as columns.
+"""
+
+# %% Imports and settings
+import json
+import itertools
+import numpy as np
+import pandas as pd
+import sciris as sc
+from cache import RunCache, canonical, data_version, source_version, hash_str
+
+# Design parameters understood by run_point(), and the values used if a design omits them
+design_defaults = dict(
+    pnc=np.nan,  # Probability of notifying current partners; NaN means no partner notification
+    pnp=0,  # Probability of notifying previous partners
+    pac=0,  # Probability that current partners attend
+    pap=0,  # Probability that previous partners attend
+    pn_start=2026,  # Year that partner notification begins
+    test_scale=1,  # Multiplier on the testing scale-up curves
+)
+default_results = ['new_infections', 'n_infected', 'prevalence']
+cachefolder = 'results/sweep_cache'
+
+
+def lhs(bounds, n_samples, seed=0):
+    """ Latin hypercube sample of n_samples points within bounds, a dict of name: dict(low=, high=) """
+    rng = np.random.default_rng(seed)
+    points = dict()
+    for name, bound in bounds.items():
+        strata = (rng.permutation(n_samples) + rng.random(n_samples)) / n_samples
+        points[name] = bound['low'] + strata*(bound['high'] - bound['low'])
+    return pd.DataFrame(points)
+
+
+def make_design(pars, kind='grid', n_samples=None, n_seeds=1, seed=0):
+    """
+    Make a design of sweep points
+
+    Args:
+        pars (dict): for a grid, name: list of values; for an LHS, name: dict(low=, high=); a scalar is held fixed
+        kind (str): 'grid' or 'lhs'
+        n_samples (int): number of LHS points
+        n_seeds (int): number of random seeds to run for each point
+        seed (int): seed for drawing the LHS
+
+    **Example**::
+
+        design = make_design(dict(pnc=[0.1, 0.5], pac=[0.1, 0.5], pn_start=[2026, 2030]), n_seeds=3)
+    """
+    fixed = {k: v for k, v in pars.items() if sc.isnumber(v)}
+    varied = {k: v for k, v in pars.items() if k not in fixed}
+    unknown = set(pars) - set(design_defaults)
+    if unknown:
+        raise ValueError(f'Design parameters {sc.strjoin(unknown)} not recognized; choices are {sc.strjoin(design_defaults.keys())}')
+
+    if kind == 'grid':
+        df = pd.DataFrame(list(itertools.product(*varied.values())), columns=list(varied.keys()))
+    elif kind == 'lhs':
+        if n_samples is None:
+            raise ValueError('An LHS design requires n_samples')
+        df = lhs(varied, n_samples, seed=seed)
+    else:
+        raise NotImplementedError(f'Design kind {kind} not recognized; choices are grid or lhs')
+
+    # Fill in fixed and default values, then replicate over seeds
+    for k, v in {**design_defaults, **fixed}.items():
+        if k not in df.columns:
+            df[k] = v
+    df = df[list(design_defaults.keys())]
+    df = df.merge(pd.DataFrame(dict(seed=np.arange(n_seeds))), how='cross')
+
+    return df
+
+
+def point_key(point, stop, results):
+    """ Content hash of a design point, the settings it was run with, and the model and data versions """
+    spec = dict(
+        point=canonical(point),
+        stop=stop,
+        results=sorted(results),
+        data=data_version(),
+        version=source_version(),
+    )
+    return hash_str(json.dumps(spec, sort_keys=True))
+
+
+def run_point(point, stop=2051, results=None, cachefolder=cachefolder):
+    """ Run a single design point and save its long-format results to the cache """
+    from hiv_model import make_sim
+    from run_pn_scens import make_pn_pars
+    from utils import get_years
+
+    results = sc.ifelse(results, default_results)
+    key = point_key(point, stop, results)
+
+    if pd.isna(point['pnc']):
+        pn_pars = None
+    else:
+        pn_pars = make_pn_pars(pnc=point['pnc'], pnp=point['pnp'], pac=point['pac'], pap=point['pap'], start=point['pn_start'])
+
+    sim = make_sim(seed=int(point['seed']), pn_pars=pn_pars, stop=stop, test_scale=point['test_scale'], verbose=-1)
+    sim.run()
+
+    dfs = sc.autolist()
+    for res in results:
+        thisdf = sim.results['hiv'][res].to_df(resample='year', use_years=True, col_names='value')
+        thisdf['timevec'] = get_years(thisdf)
+        thisdf['result'] = f'hiv.{res}'
+        dfs += thisdf
+    df = pd.concat(dfs, ignore_index=True)
+    for k, v in point.items():
+        df[k] = v
+    df['key'] = key
+
+    RunCache(cachefolder, max_size=None).set(key, df)
+    return df
+
+
+def run_sweep(design, stop=2051, results=None, n_workers=None, parallel=True, cachefolder=cachefolder, outfile='results/sweep.df'):
+    """
+    Run every point in a design that isn't already cached, and collect all of them into one long DataFrame
+
+    Args:
+        design (DataFrame): design points, as made by make_design()
+        stop (float): year to stop each sim
+        results (list): HIV results to store
+        n_workers (int): number of worker processes (default: all CPUs)
+        parallel (bool): whether to run in parallel
+        cachefolder (str): folder holding one file per completed point
+        outfile (str): where to save the combined results (None to skip saving)
+    """
+    results = sc.ifelse(results, default_results)
+    cache = RunCache(cachefolder, max_size=None)
+
+    # Deduplicate and work out which points still need running
+    design = design.drop_duplicates().reset_index(drop=True)
+    points = design.to_dict('records')
+    keys = [point_key(point, stop, results) for point in points]
+    to_run = [point for point, key in zip(points, keys) if key not in cache]
+
+    sc.heading(f'Running {len(to_run)} of {len(points)} sweep points ({len(points)-len(to_run)} cached)... ')
+    if len(to_run):
+        kwargs = dict(stop=stop, results=results, cachefolder=cachefolder)
+        if parallel:
+            sc.parallelize(run_point, iterarg=to_run, kwargs=kwargs, ncpus=n_workers, progress=True)
+        else:
+            for point in to_run:
+                run_point(point, **kwargs)
+
+    df = pd.concat([cache.get(key) for key in dict.fromkeys(keys)], ignore_index=True)
+    if outfile is not None:
+        sc.saveobj(outfile, df)
+
+    return df
+
+
+def summarize_sweep(df, by=None):
+    """ Summarize a sweep across seeds, in the same form as process_scens() """
+    from utils import percentiles
+    by = sc.ifelse(by, list(design_defaults.keys()))
+    df = df.copy()
+    for k in by:
+        df[k] = df[k].fillna(-1)  # groupby drops NaN keys, so mark the no-PN points explicitly
+    df_stats = df.groupby(by + ['result', 'timevec'])['value'].describe(percentiles=percentiles)
+    return df_stats
+
+
+if __name__ == '__main__':
+
+    # SETTINGS
+    debug = False
+    n_seeds = [5, 1][debug]
+
+    # Base case and a grid over the partner notification probabilities
+    base = make_design(dict(), n_seeds=n_seeds)
+    grid = make_design(dict(
+        pnc=[0.1, 0.2, 0.5],
+        pnp=[0, 0.05, 0.1],
+        pac=[0.1, 0.2, 0.5],
+        pap=[0, 0.1, 0.2],
+        pn_start=[2026, 2030],
+    ), n_seeds=n_seeds)
+    design = pd.concat([base, grid])
+
+    df = run_sweep(design, stop=2051)
+    df_stats = summarize_sweep(df)
+    sc.saveobj('results/sweep_stats.df', df_stats)
+
+    print('Done!')
@@ -0,0 +1,276 @@
+"""
+Live progress and throughput telemetry for ensemble runs
+
+Each sim being run gets a Telemetry analyzer, which sends a short JSON message
+over a local UDP socket to the parent process when it starts, once per
+simulated year and when it finishes: the task, worker process, current year,
+simulated years per second, estimated time remaining and memory use. The
+start message also includes the main model parameters, so slow parameter
+regions can be found afterwards. Sending never blocks, and if nothing is
+listening the messages are simply dropped, so telemetry can't slow down or
+break a run.
+
+In the parent, a Monitor receives the messages in a background thread, writes
+each one to a JSONL log, and regularly prints a console view of the running
+tasks (flagging stragglers), each worker's throughput and the overall ETA.
+summarize_log() reduces a log to one row per task with its parameters and
+speed.
+
+**Example**::
+
+    with Monitor(n_tasks=len(sims)) as monitor:
+        for i, sim in enumerate(sims):
+            add_telemetry(sim, monitor.address, task=i)
+        sims = ss.parallel(sims).sims
+"""
+
+# %% Imports and settings
+import os
+import json
+import time
+import socket
+import threading
+import numpy as np
+import pandas as pd
+import sciris as sc
+import starsim as ss
+
+logfolder = 'results/telemetry'
+_sock = None  # Each worker process opens its own socket when it first sends
+
+
+def send(address, msg):
+    """ Send a message to the monitor, without waiting and ignoring errors """
+    global _sock
+    try:
+        if _sock is None:
+            _sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _sock.setblocking(False)
+        _sock.sendto(json.dumps(msg).encode(), tuple(address))
+    except OSError:
+        pass
+    return
+
+
+def get_pars(sim):
+    """ The calibrated HIV and network parameters of a sim, to log with its progress """
+    pars = dict()
+    hiv = sim.diseases.get('hiv')
+    nw = sim.networks.get('structuredsexual')
+    if hiv is not None:
+        pars['hiv_beta_m2f'] = hiv.pars.beta_m2f
+    if nw is not None:
+        for k in ['prop_f0', 'prop_m0', 'f1_conc', 'm1_conc', 'p_pair_form']:
+            v = nw.pars.get(k)
+            v = v.pars.p if isinstance(v, ss.Dist) else v  # p_pair_form is a Bernoulli distribution
+            if sc.isnumber(v):
+                pars[f'nw_{k}'] = v
+    return {k: float(v) for k, v in pars.items()}
+
+
+class Telemetry(ss.Analyzer):
+    """
+    Report the progress of a sim to a Monitor
+
+    Args:
+        address (tuple): (host, port) of the monitor, i.e. monitor.address
+        task (int/str): identifier of the task, e.g. its index in the ensemble
+        info (dict): other JSON-compatible information to include with the start message, e.g. the scenario
+        every (float): years between progress messages
+    """
+    def __init__(self, address, task=None, info=None, every=1, name='telemetry', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.address = tuple(address)
+        self.task = task
+        self.info = sc.ifelse(info, dict())
+        self.every = every
+        self._t0 = None
+        self._next = None
+        return
+
+    def message(self, event, year, **kwargs):
+        from runners import current_rss
+        start, stop = self.t.yearvec[0], self.t.yearvec[-1]
+        elapsed = time.time() - self._t0
+        rate = (year - start)/elapsed if elapsed > 0 else np.nan
+        eta = (stop - year)/rate if rate > 0 else np.nan
+        msg = dict(event=event, task=self.task, label=self.sim.label, pid=os.getpid(), time=time.time(), year=float(year), start=float(start),
+                   stop=float(stop), elapsed=elapsed, rate=rate, eta=eta, rss=current_rss(), **kwargs)
+        return {k: (None if sc.isnumber(v) and not np.isfinite(v) else v) for k, v in msg.items()}  # Valid JSON
+
+    def step(self):
+        year = self.t.yearvec[self.ti]
+        if self._t0 is None:  # First step: the run has started
+            self._t0 = time.time()
+            self._next = year + self.every
+            send(self.address, self.message('start', year, pars=get_pars(self.sim), info=self.info))
+        elif year >= self._next - 1e-9:
+            self._next += self.every
+            send(self.address, self.message('progress', year))
+        return
+
+    def finalize(self):
+        super().finalize()
+        if self._t0 is not None:
+            send(self.address, self.message('done', self.t.yearvec[-1]))
+        return
+
+
+def add_telemetry(sim, address, task=None, info=None, every=1):
+    """ Add a Telemetry analyzer to a sim, whether or not it's been initialized """
+    tel = Telemetry(address, task=task, info=info, every=every)
+    if sim.initialized:
+        sim.add_module(tel)
+    else:
+        sim.pars.analyzers = sc.tolist(sim.pars.analyzers) + [tel]
+    return sim
+
+
+class Monitor:
+    """
+    Receive telemetry from running sims, log it and show a live console view
+
+    Args:
+        logfile (str): JSONL file to append each message to (default: a new file in results/telemetry/); False to not log
+        n_tasks (int): total number of tasks, for the overall progress and ETA
+        interval (float): seconds between console views; None to not print
+        straggler (float): flag running tasks with an ETA this many times the median of the running tasks
+    """
+    def __init__(self, logfile=None, n_tasks=None, interval=10, straggler=2):
+        if logfile is None:
+            logfile = f'{logfolder}/{sc.getdate(dateformat="%Y-%m-%d_%H%M%S")}.jsonl'
+        self.logfile = logfile
+        self.n_tasks = n_tasks
+        self.interval = interval
+        self.straggler = straggler
+        self.tasks = dict()  # Latest message for each task, with the parameters from its start message
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_show = 0
+        return
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        return
+
+    @property
+    def address(self):
+        return self._sock.getsockname()
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(('127.0.0.1', 0))  # Any free port
+        self._sock.settimeout(0.2)
+        self._log = None
+        if self.logfile:
+            os.makedirs(os.path.dirname(os.path.abspath(self.logfile)), exist_ok=True)
+            self._log = open(self.logfile, 'a')
+        self.t0 = time.time()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sock.close()
+        if self._log is not None:
+            self._log.close()
+        if self.interval is not None:
+            self.show()
+            if self.logfile:
+                print(f'Telemetry saved to {self.logfile}')
+        return
+
+    def _loop(self):
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except socket.timeout:
+                data = None
+            if data is not None:
+                self.receive(json.loads(data))
+            elif self._stop.is_set():
+                break  # Only once every pending message has been received
+            if self.interval is not None and time.time() - self._last_show > self.interval:
+                try:
+                    self.show()
+                except Exception as E:  # Never let the view stop the thread, which would stop the log too
+                    print(f'Could not show telemetry: {E}')
+        return
+
+    def receive(self, msg):
+        """ Log a message and update the state of its task """
+        if self._log is not None:
+            self._log.write(json.dumps(msg) + '\n')
+            self._log.flush()
+        key = (msg['task'], msg['pid'])
+        self.tasks[key] = sc.mergedicts(self.tasks.get(key), msg)
+        return
+
+    def df(self):
+        """ Latest state of each task, with unknown numbers (e.g. the ETA in start messages) as NaN """
+        df = pd.DataFrame(list(self.tasks.values())) if len(self.tasks) else pd.DataFrame()
+        for col in ['year', 'start', 'stop', 'elapsed', 'rate', 'eta', 'rss']:
+            if col in df:
+                df[col] = pd.to_numeric(df[col], errors='coerce')
+        return df
+
+    def show(self):
+        """ Print the running tasks, each worker's throughput and the overall progress """
+        self._last_show = time.time()
+        df = self.df()
+        if not len(df):
+            return
+        elapsed = time.time() - self.t0
+        running = df[df.event != 'done']
+        n_done = (df.event == 'done').sum()
+        n_tasks = sc.ifelse(self.n_tasks, len(df))
+
+        lines = [f'--- {elapsed/60:.1f} min: {n_done}/{n_tasks} tasks done, {len(running)} running ---']
+        if len(running):
+            median_eta = running.eta.median()
+            for row in running.sort_values('eta', ascending=False, na_position='last').itertuples():
+                flag = '  <- straggler' if len(running) > 2 and row.eta > self.straggler*median_eta else ''  # False for NaN
+                rate = f'{row.rate:.2f}' if np.isfinite(row.rate) else '?'
+                eta = f'{row.eta:.0f}' if np.isfinite(row.eta) else '?'
+                lines.append(f'  task {row.task} (pid {row.pid}): year {row.year:.0f}, {rate} sim-years/s, '
+                             f'ETA {eta} s, {row.rss/1e9:.2f} GB{flag}')
+
+        # Throughput of each worker: simulated years per second of wall time since the first message
+        years = (df.year - df.start).groupby(df.pid).sum()
+        rates = ', '.join(f'{pid}: {y/elapsed:.2f}' for pid, y in years.items())
+        lines.append(f'  Sim-years/s by worker: {rates}')
+
+        # Overall ETA: the years left (assuming unstarted tasks are as long as the started ones) at the current throughput
+        total_rate = running.rate.sum() if len(running) else years.sum()/elapsed
+        years_left = (running.stop - running.year).sum() + (n_tasks - len(df))*(df.stop - df.start).mean()
+        if total_rate > 0 and n_done < n_tasks:
+            lines.append(f'  Overall ETA: {years_left/total_rate/60:.1f} min')
+        print('\n'.join(lines), flush=True)
+        return
+
+
+def load_log(filename):
+    """ Read a telemetry log into a DataFrame with one row per message """
+    with open(filename) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+
+def summarize_log(filename):
+    """
+    One row per finished task: its parameters, run time and speed, slowest first
+
+    For example, summary.plot.scatter('nw_p_pair_form', 'rate') shows whether runs slow down with more partnerships.
+    """
+    df = load_log(filename)
+    starts = df[df.event == 'start'].set_index(['task', 'pid'])
+    done = df[df.event == 'done'].set_index(['task', 'pid'])
+    summary = done[['label', 'elapsed', 'rate', 'rss']].join(pd.DataFrame(list(starts.pars), index=starts.index))
+    if 'info' in starts:
+        summary = summary.join(pd.DataFrame(list(starts['info']), index=starts.index))
+    return summary.sort_values('rate').reset_index()
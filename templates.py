@@ -0,0 +1,200 @@
+"""
+Fast start from pre-initialized population templates
+
+Initializing a sim (building the 1985 population, seeding HIV and forming the
+initial partnerships) takes most of the time it takes to start a run, and it's
+the same for every run with the same inputs. make_sim() here gives the same
+initialized sim as hiv_model.make_sim() followed by sim.init(), but initializes
+it only once: the first time, the initialized sim is stored as a template, and
+later calls load it. The agent states, which are most of its size, are stored
+in one flat array that is memory-mapped copy-on-write, so workers starting from
+the same template share its pages until they change them; the rest of the sim
+is a small pickle.
+
+The calibration parameters are applied after initialization (as make_sim()
+does), so they aren't part of the template: one template, i.e. one (n_agents,
+seed, ...) combination, serves every row of the calibration.
+
+As in the run cache, the least recently used templates are removed once the
+folder is over max_size bytes or max_entries templates.
+"""
+
+# %% Imports and settings
+import os
+import shutil
+import inspect
+import numpy as np
+import sciris as sc
+import starsim as ss
+
+templatefolder = 'results/templates'
+skip_args = ['use_calib', 'par_idx', 'calib_pars', 'verbose']  # make_sim() arguments applied after initialization
+align = 64  # Byte alignment of each state in the flat array
+max_size = 10e9  # Maximum total size of the stored templates in bytes
+max_entries = None  # Maximum number of templates to keep (default no limit)
+n_built = 0  # Templates built by this process, so callers can tell whether a run had to build one
+
+
+def get_arrs(sim):
+    """ Every agent state (ss.Arr) of an initialized sim, in a fixed order """
+    people = sim.people
+    return [people.uid, people.slot, people.parent] + list(people._states.values())
+
+
+def template_key(**kwargs):
+    """ Key of the template for make_sim(**kwargs): everything except the arguments in skip_args """
+    from cache import sim_key
+    kwargs = {k: v for k, v in kwargs.items() if k not in skip_args}
+    return sim_key(template=True, use_calib=False, **kwargs)
+
+
+def template_path(folder=templatefolder, **kwargs):
+    """ Path of the template for make_sim(**kwargs), whether or not it's stored yet """
+    from hiv_model import make_sim as build
+    defaults = {k: p.default for k, p in inspect.signature(build).parameters.items()}
+    initkw = {k: v for k, v in sc.mergedicts(defaults, kwargs).items() if k not in skip_args}
+    return sc.path(folder)/template_key(**initkw)
+
+
+def save_template(sim, folder):
+    """ Store an initialized sim: its agent states in a flat array, and the rest as a pickle """
+    arrs = get_arrs(sim)
+    raws = [arr.raw for arr in arrs]
+    offsets = np.cumsum([0] + [-(-raw.nbytes//align)*align for raw in raws])
+    flat = np.zeros(offsets[-1], dtype=np.uint8)
+    for raw, offset in zip(raws, offsets):
+        flat[offset:offset + raw.nbytes] = np.ascontiguousarray(raw).view(np.uint8).ravel()
+
+    os.makedirs(folder, exist_ok=True)
+    np.save(sc.path(folder)/'states.npy', flat)
+    sim.template_layout = [(int(offset), raw.dtype.str, raw.shape) for raw, offset in zip(raws, offsets)]
+    try:
+        for arr in arrs:
+            arr.raw = None  # Stored in the flat array instead
+        sc.saveobj(sc.path(folder)/'sim.obj', sim)
+    finally:
+        for arr, raw in zip(arrs, raws):
+            arr.raw = raw
+    return
+
+
+def load_template(folder):
+    """ Load a stored sim, with its agent states memory-mapped copy-on-write """
+    sim = sc.loadobj(sc.path(folder)/'sim.obj')
+    flat = np.load(sc.path(folder)/'states.npy', mmap_mode='c')
+    for arr, (offset, dtype, shape) in zip(get_arrs(sim), sim.template_layout):
+        dtype = np.dtype(dtype)
+        raw = flat[offset:offset + dtype.itemsize*int(np.prod(shape))].view(dtype).reshape(shape)
+        arr.raw = raw.view(ss.uids if isinstance(arr, ss.IndexArr) else np.ndarray)
+    return sim
+
+
+def make_template(folder, **kwargs):
+    """ Make and store the template for make_sim(**kwargs); another process may store the same one first """
+    global n_built
+    from hiv_model import make_sim as build
+    sim = build(use_calib=False, **kwargs)
+    if not sim.initialized:
+        sim.init()
+    sim.np_state = np.random.get_state()  # Initialization seeds NumPy's global random state, which partnership formation uses
+    tmpfolder = sc.path(f'{folder}.tmp{os.getpid()}')
+    save_template(sim, tmpfolder)
+    try:
+        os.rename(tmpfolder, folder)  # Atomic, so other workers never load a partial template
+    except OSError:  # Already stored
+        shutil.rmtree(tmpfolder, ignore_errors=True)
+    n_built += 1
+    return
+
+
+def make_sim(folder=templatefolder, **kwargs):
+    """
+    Make an initialized sim, the same as hiv_model.make_sim(**kwargs) followed by sim.init(), from a stored template
+
+    Args:
+        folder (str): folder to store templates in
+        kwargs (dict): passed to hiv_model.make_sim()
+
+    **Example**::
+
+        from templates import make_sim
+        sim = make_sim(seed=2, par_idx=5, verbose=-1)  # The first call for seed 2 stores a template; later calls load it
+        sim.run()
+    """
+    from hiv_model import make_sim as build, make_sim_pars
+    from cache import calib_row
+    defaults = {k: p.default for k, p in inspect.signature(build).parameters.items()}
+    kwargs = sc.mergedicts(defaults, kwargs)
+    initkw = {k: v for k, v in kwargs.items() if k not in skip_args}
+
+    path = template_path(folder, **initkw)
+    try:
+        os.utime(path)  # Mark it as recently used, as RunCache.get() does
+        sim = load_template(path)
+    except FileNotFoundError:  # Not stored yet, or another process has just evicted it
+        make_template(path, verbose=kwargs['verbose'], **initkw)
+        evict_templates(folder, keep=path)
+        sim = load_template(path)
+    np.random.set_state(sim.np_state)
+    sim.pars.verbose = kwargs['verbose']
+
+    if kwargs['calib_pars'] is not None:
+        sim = make_sim_pars(sim, kwargs['calib_pars'])
+    elif kwargs['use_calib']:
+        sim = make_sim_pars(sim, calib_row(kwargs['par_idx']))
+        print(f'Using calibration parameters for index {kwargs["par_idx"]}')
+    return sim
+
+
+def template_entries(folder=templatefolder):
+    """ List of (path, size, last used) for every stored template, most recently used first """
+    entries = []
+    for path in sc.path(folder).glob('*'):
+        if not path.is_dir() or '.tmp' in path.name:  # Skip templates still being written
+            continue
+        with sc.tryexcept(die=False, verbose=False):  # Another process may have just evicted it
+            size = sum(f.stat().st_size for f in path.iterdir())
+            entries.append((path, size, path.stat().st_mtime))
+    return sorted(entries, key=lambda e: e[2], reverse=True)
+
+
+def evict_templates(folder=templatefolder, keep=None):
+    """ Remove the least recently used templates until the folder is within max_size and max_entries, but never keep (the template just stored) """
+    total = 0
+    for n, (path, size, _) in enumerate(template_entries(folder)):
+        total += size
+        too_many = max_entries is not None and n >= max_entries
+        too_big = max_size is not None and total > max_size
+        if (too_many or too_big) and path != keep:
+            shutil.rmtree(path, ignore_errors=True)  # Workers that have it memory-mapped keep their pages
+    return
+
+
+def clear_templates(folder=templatefolder):
+    """ Remove every stored template, e.g. after changing the model or the data """
+    shutil.rmtree(folder, ignore_errors=True)
+    return
+
+
+if __name__ == '__main__':
+
+    # Compare starting from a template against making and initializing the sim
+    from hiv_model import make_sim as build
+
+    # SETTINGS
+    n_agents = 100e3
+    stop = 2000
+
+    T = sc.timer()
+    ref = build(n_agents=n_agents, stop=stop, verbose=-1)
+    T.toc('Made and initialized the sim')
+    ref.run()  # Before making other sims, since they reset NumPy's global random state
+    make_sim(n_agents=n_agents, stop=stop, verbose=-1)  # Stores the template if needed
+    T.tic()
+    sim = make_sim(n_agents=n_agents, stop=stop, verbose=-1)
+    T.toc('Loaded the template')
+
+    sim.run()
+    same = np.array_equal(ref.results.hiv.n_infected, sim.results.hiv.n_infected)
+    print(f'Results are {"identical" if same else "DIFFERENT"}')
+    print('Done!')
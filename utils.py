@@ -3,6 +3,7 @@ Utils and defaults
 """
 import sciris as sc
 import numpy as np
+import pandas as pd
 
 
 def set_font(size=None, font='Libertinus Sans'):
@@ -22,3 +23,19 @@ def get_y(df, which, rname):
     elif which == 'multi': y = df[(rname, '50%')]
     return y
 
+
+
+def get_years(df):
+    """ Return the years of a resampled result DataFrame, whether they're stored in the index or in a timevec column """
+    years = df['timevec'] if 'timevec' in df.columns else df.index.to_series()
+    if pd.api.types.is_datetime64_any_dtype(years):
+        years = years.dt.year
+    return np.asarray(years)
+
+
+def get_targets(sim, datafile='data/zambia_hiv_calib.csv'):
+    """ Yearly values of a sim's calibration targets, in the same layout as the calibration data """
+    data = pd.read_csv(datafile)
+    df = sim.to_df(resample='year', use_years=True, sep='_')
+    df['time'] = get_years(df)
+    return df.loc[df.time.isin(data.time), ['time'] + [c for c in data.columns if c != 'time']].set_index('time')